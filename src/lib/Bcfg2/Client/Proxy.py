@@ -2,9 +2,13 @@ import os.path
 import re
 import sys
 import time
+import errno
+import random
+import select
 import socket
 import logging
 import Bcfg2.Options
+from Bcfg2.Utils import Decompressor, compress, content_encodings
 from Bcfg2.Compat import httplib, xmlrpclib, urlparse, quote_plus
 
 # The ssl module is provided by either Python 2.6 or a separate ssl
@@ -37,16 +41,33 @@ class ProxyError(Exception):
     ProtocolError and Fault) """
     def __init__(self, err):
         msg = None
+        #: The number of seconds the server asked the client to wait
+        #: before retrying (with a ``Retry-After`` header on an HTTP
+        #: 503 response), or None
+        self.retry_after = None
+        #: The fault code, if the error is an XML-RPC fault, or None
+        self.fault_code = None
+        #: The HTTP status code, if the error is an XML-RPC protocol
+        #: error, or None.  The server responds with 401 if an ACL
+        #: denies the method.
+        self.status = None
         if isinstance(err, xmlrpclib.ProtocolError):
+            self.status = err.errcode
             # cut out the password in the URL
             url = re.sub(r'([^:]+):(.*?)@([^@]+:\d+/)', r'\1:******@\3',
                          err.url)
             msg = "XML-RPC Protocol Error for %s: %s (%s)" % (url,
                                                               err.errmsg,
                                                               err.errcode)
+            if err.errcode == 503 and hasattr(err.headers, "get"):
+                try:
+                    self.retry_after = int(err.headers.get("Retry-After"))
+                except (TypeError, ValueError):
+                    pass
         elif isinstance(err, xmlrpclib.Fault):
             msg = "XML-RPC Fault: %s (%s)" % (err.faultString,
                                               err.faultCode)
+            self.fault_code = err.faultCode
         else:
             msg = str(err)
         Exception.__init__(self, msg)
@@ -77,6 +98,7 @@ class RetryMethod(xmlrpclib._Method):
             else:
                 final = False
             msg = None
+            delay = self.retry_delay
             try:
                 return _orig_Method.__call__(self, *args)
             except xmlrpclib.ProtocolError:
@@ -85,6 +107,10 @@ class RetryMethod(xmlrpclib._Method):
                     (err.errcode, err.errmsg)
             except xmlrpclib.Fault:
                 msg = sys.exc_info()[1]
+                if msg.faultCode == xmlrpclib.METHOD_NOT_FOUND:
+                    # the server does not have the method, so calling
+                    # it again will not help
+                    final = True
             except socket.error:
                 err = sys.exc_info()[1]
                 if hasattr(err, 'errno') and err.errno == 336265218:
@@ -103,6 +129,12 @@ class RetryMethod(xmlrpclib._Method):
             except ProxyError:
                 err = sys.exc_info()[1]
                 msg = err
+                if err.retry_after is not None:
+                    # the server is busy.  back off, with jitter so
+                    # that clients that were turned away together do
+                    # not all come back together.
+                    delay = err.retry_after * 2 ** retry
+                    delay += random.uniform(0, delay)
             except:
                 etype, err = sys.exc_info()[:2]
                 msg = "Unknown failure: %s (%s)" % (err, etype.__name__)
@@ -112,7 +144,7 @@ class RetryMethod(xmlrpclib._Method):
                     raise ProxyError(msg)
                 else:
                     self.log.info(msg)
-                    time.sleep(self.retry_delay)
+                    time.sleep(delay)
 
 xmlrpclib._Method = RetryMethod
 
@@ -247,9 +279,25 @@ class SSLHTTPConnection(httplib.HTTPConnection):
 
 
 class XMLRPCTransport(xmlrpclib.Transport):
+    """ XML-RPC transport that uses :class:`SSLHTTPConnection`.  A
+    single HTTP/1.1 keep-alive connection is reused for all requests
+    to the same host, so that a client run only pays for one TLS
+    handshake as long as the server keeps the connection open.
+
+    If ``compress`` is True, the server is asked to compress large
+    responses, and large requests are compressed once the server has
+    said (with an ``Accept-Encoding`` response header) that it
+    accepts compressed requests. """
+
+    #: Requests smaller than this many bytes are not compressed
+    encode_threshold = 1400
+
+    #: Responses are read and parsed in pieces of this many bytes
+    read_chunk_size = 64 * 1024
+
     def __init__(self, key=None, cert=None, ca=None,
                  scns=None, use_datetime=0, timeout=90,
-                 protocol='xmlrpc/tlsv1'):
+                 protocol='xmlrpc/tlsv1', compress=False):
         if hasattr(xmlrpclib.Transport, '__init__'):
             xmlrpclib.Transport.__init__(self, use_datetime)
         self.key = key
@@ -258,40 +306,154 @@ class XMLRPCTransport(xmlrpclib.Transport):
         self.scns = scns
         self.timeout = timeout
         self.protocol = protocol
+        self.compress = compress
+        self._connection = (None, None)
+
+        #: The content codings the server accepts for requests
+        self.server_encodings = []
+
+        #: The number of new connections (and so TLS handshakes) made
+        self.handshakes = 0
+
+        #: The number of requests sent over an already open
+        #: connection, i.e., the number of TLS handshakes saved
+        self.reused = 0
+
+    def _connection_dropped(self, conn):
+        """ Determine whether the server has closed an idle
+        connection.  An idle connection should have nothing to read,
+        so if it is readable, the server has closed it (or sent
+        something unexpected), and it cannot be reused. """
+        try:
+            return bool(select.select([conn.sock], [], [], 0)[0])
+        except (select.error, socket.error, ValueError):
+            return True
+
+    def _is_stale(self, err):
+        """ Determine whether an error sending a request over a
+        reused connection means that the server had already closed
+        the connection. """
+        if isinstance(err, httplib.BadStatusLine):
+            return True
+        if isinstance(err, SSL_ERROR):
+            return err.errno in (ssl.SSL_ERROR_EOF, ssl.SSL_ERROR_ZERO_RETURN)
+        return getattr(err, 'errno', None) in (errno.EPIPE, errno.ECONNRESET,
+                                               errno.ECONNABORTED)
 
     def make_connection(self, host):
         host, self._extra_headers = self.get_host_info(host)[0:2]
-        return SSLHTTPConnection(host,
-                                 key=self.key,
-                                 cert=self.cert,
-                                 ca=self.ca,
-                                 scns=self.scns,
-                                 timeout=self.timeout,
-                                 protocol=self.protocol)
+        if self._connection[1] is not None and self._connection[0] == host:
+            conn = self._connection[1]
+            if conn.sock is not None and self._connection_dropped(conn):
+                conn.close()
+        else:
+            self.close()
+            conn = SSLHTTPConnection(host,
+                                     key=self.key,
+                                     cert=self.cert,
+                                     ca=self.ca,
+                                     scns=self.scns,
+                                     timeout=self.timeout,
+                                     protocol=self.protocol)
+            self._connection = (host, conn)
+        if conn.sock is None:
+            # the connection will be (re)opened when the request is
+            # sent
+            self.handshakes += 1
+        else:
+            self.reused += 1
+        return conn
 
     def request(self, host, handler, request_body, verbose=0):
         """Send request to server and return response."""
-        try:
-            conn = self.send_request(host, handler, request_body, False)
-            response = conn.getresponse()
-            errcode = response.status
-            errmsg = response.reason
-            headers = response.msg
-        except (socket.error, SSL_ERROR, httplib.BadStatusLine):
-            err = sys.exc_info()[1]
-            raise ProxyError(xmlrpclib.ProtocolError(host + handler,
-                                                     408,
-                                                     str(err),
-                                                     self._extra_headers))
+        # if the server closed a reused connection, retry once
+        # immediately on a new connection.  all other errors are left
+        # to RetryMethod, which reconnects on its next attempt.
+        for attempt in range(2):
+            handshakes = self.handshakes
+            try:
+                conn = self.send_request(host, handler, request_body, False)
+                response = conn.getresponse()
+                errcode = response.status
+                errmsg = response.reason
+                headers = response.msg
+            except (socket.error, SSL_ERROR, httplib.BadStatusLine):
+                err = sys.exc_info()[1]
+                self.close()
+                if (attempt == 0 and self.handshakes == handshakes and
+                        self._is_stale(err)):
+                    continue
+                raise ProxyError(xmlrpclib.ProtocolError(host + handler,
+                                                         408,
+                                                         str(err),
+                                                         self._extra_headers))
+            break
 
         if errcode != 200:
+            self.close()
             raise ProxyError(xmlrpclib.ProtocolError(host + handler,
                                                      errcode,
                                                      errmsg,
                                                      headers))
 
+        accepted = response.getheader("Accept-Encoding")
+        if accepted:
+            self.server_encodings = [e.strip().lower()
+                                     for e in accepted.split(",")]
+
         self.verbose = verbose
-        return self.parse_response(response)
+        try:
+            return self.parse_response(response)
+        except xmlrpclib.Fault:
+            raise
+        except:
+            # the response may not have been read completely, so the
+            # connection cannot be reused
+            self.close()
+            raise
+
+    def parse_response(self, response):
+        # the response is decompressed and parsed as it is read, so
+        # that large responses are never held in memory all at once
+        encoding = response.getheader("Content-Encoding", "identity")
+        decompressor = None
+        if encoding != "identity":
+            decompressor = Decompressor(encoding)
+        parser, unmarshaller = self.getparser()
+        while True:
+            data = response.read(self.read_chunk_size)
+            if not data:
+                break
+            if decompressor is not None:
+                data = decompressor.decompress(data)
+            parser.feed(data)
+        if decompressor is not None:
+            parser.feed(decompressor.flush())
+        parser.close()
+        return unmarshaller.close()
+
+    def send_headers(self, connection, headers):
+        # replace the Accept-Encoding header that xmlrpclib adds, which
+        # only asks for gzip
+        headers = [(key, val) for key, val in headers
+                   if key.lower() != "accept-encoding"]
+        if self.compress:
+            headers.append(("Accept-Encoding", ", ".join(content_encodings)))
+        xmlrpclib.Transport.send_headers(self, connection, headers)
+
+    def send_content(self, connection, request_body):
+        encoding = None
+        if self.compress and len(request_body) > self.encode_threshold:
+            for encoding in content_encodings:
+                if encoding in self.server_encodings:
+                    break
+            else:
+                encoding = None
+        if encoding is not None:
+            request_body = compress(request_body, encoding)
+            connection.putheader("Content-Encoding", encoding)
+        connection.putheader("Content-Length", str(len(request_body)))
+        connection.endheaders(request_body)
 
     if sys.hexversion < 0x03000000:
         # pylint: disable=E1101
@@ -330,6 +492,9 @@ class ComponentProxy(xmlrpclib.ServerProxy):
             "-y", "--retry-delay", type=int, default=1,
             cf=('communication', 'retry_delay'),
             help='The time in seconds to wait between retries'),
+        Bcfg2.Options.BooleanOption(
+            cf=('communication', 'compress'), default=True,
+            help='Compress large requests to and responses from the server'),
         Bcfg2.Options.Option(
             '--ssl-cns', cf=('communication', 'serverCommonNames'),
             dest="ssl_cns",
@@ -355,6 +520,19 @@ class ComponentProxy(xmlrpclib.ServerProxy):
             ca=Bcfg2.Options.setup.ca,
             scns=Bcfg2.Options.setup.ssl_cns,
             timeout=Bcfg2.Options.setup.client_timeout,
-            protocol=Bcfg2.Options.setup.protocol)
+            protocol=Bcfg2.Options.setup.protocol,
+            compress=Bcfg2.Options.setup.compress)
         xmlrpclib.ServerProxy.__init__(self, url,
                                        allow_none=True, transport=ssl_trans)
+
+        #: The :class:`XMLRPCTransport` used to talk to the server
+        self.transport = ssl_trans
+
+    def close(self):
+        """ Close the connection to the server, and log how many TLS
+        handshakes were saved by reusing it. """
+        self.transport.close()
+        logging.getLogger('xmlrpc').debug(
+            "Sent %d requests over %d connections" %
+            (self.transport.handshakes + self.transport.reused,
+             self.transport.handshakes))
@@ -3,8 +3,12 @@
 import os
 import sys
 import stat
+import time
+import json
 import difflib
 import tempfile
+import threading
+from hashlib import sha256
 from base64 import b64encode, b64decode
 
 import Bcfg2.Options
@@ -16,6 +20,26 @@ class POSIXFile(POSIXTool):
     """ Handle <Path type='file' ...> entries """
     __req__ = ['name', 'mode', 'owner', 'group']
 
+    #: Size of the chunks in which files are read to compute their
+    #: digests
+    chunk_size = 1024 * 1024
+
+    #: Files modified less than this many seconds ago are not added
+    #: to the digest cache, since they may be modified again without
+    #: a change to their modification time
+    digest_cache_min_age = 2
+
+    def __init__(self, config):
+        POSIXTool.__init__(self, config)
+
+        #: Cache of file digests, loaded from the ``digest_cache``
+        #: file.  Keys are filenames, and values are lists of
+        #: ``[<device>, <inode>, <size>, <mtime>, <ctime>, <digest>]``.
+        #: None if the digest cache has not been loaded yet.
+        self._digests = None
+        self._digests_dirty = False
+        self._digest_lock = threading.Lock()
+
     def fully_specified(self, entry):
         return entry.text is not None or entry.get('empty', 'false') == 'true'
 
@@ -38,8 +62,11 @@ class POSIXFile(POSIXTool):
 
     def verify(self, entry, modlist):
         ondisk = self._exists(entry)
-        tempdata, is_binary = self._get_data(entry)
-        tempdatasize = len(tempdata)
+        is_binary = entry.get('encoding', 'ascii') == 'base64'
+        digest = entry.get('digest')
+        size = entry.get('size')
+        if size is not None:
+            size = int(size)
 
         different = False
         content = None
@@ -48,22 +75,38 @@ class POSIXFile(POSIXTool):
             # they're clearly different
             different = True
             content = b''
-        elif tempdatasize != ondisk[stat.ST_SIZE]:
-            # next, see if the size of the target file is different
-            # from the size of the desired content
+        elif (digest is not None and
+              size in [None, ondisk[stat.ST_SIZE]] and
+              self._get_digest(entry.get('name'), ondisk) == digest):
+            # the server has sent a digest of the desired content, and
+            # it matches the file on disk.  this is checked before the
+            # entry data is decoded, so that unchanged files are
+            # verified without decoding their content
+            different = False
+        elif is_binary and digest is not None:
+            # the size and digest of binary content do not depend on
+            # the encoding, so the file is different if they do not
+            # match
             different = True
         else:
-            # finally, read in the target file and compare them
-            # directly. comparison could be done with a checksum,
-            # which might be faster for big binary files, but slower
-            # for everything else
-            try:
-                content = open(entry.get('name'), 'rb').read()
-            except IOError:
-                self.logger.error("POSIX: Failed to read %s: %s" %
-                                  (entry.get("name"), sys.exc_info()[1]))
-                return False
-            different = content != tempdata
+            # the size and digest of text content depend on the
+            # encoding, which may differ between the client and the
+            # server, so compare the content directly
+            tempdata, is_binary = self._get_data(entry)
+            if len(tempdata) != ondisk[stat.ST_SIZE]:
+                # see if the size of the target file is different
+                # from the size of the desired content
+                different = True
+            else:
+                # finally, read in the target file and compare them
+                # directly
+                try:
+                    content = open(entry.get('name'), 'rb').read()
+                except IOError:
+                    self.logger.error("POSIX: Failed to read %s: %s" %
+                                      (entry.get("name"), sys.exc_info()[1]))
+                    return False
+                different = content != tempdata
 
         if different:
             self.logger.debug("POSIX: %s has incorrect contents" %
@@ -74,6 +117,88 @@ class POSIXFile(POSIXTool):
                 is_binary=is_binary, content=content)
         return POSIXTool.verify(self, entry, modlist) and not different
 
+    def _load_digest_cache(self):
+        """ Load the digest cache from the ``digest_cache`` file, if
+        it is set.  This must be called with ``_digest_lock`` held. """
+        self._digests = dict()
+        path = Bcfg2.Options.setup.posix_digest_cache
+        if not path or not os.path.exists(path):
+            return
+        try:
+            self._digests = json.load(open(path))
+        except (IOError, ValueError):
+            self.logger.warning("POSIX: Failed to load digest cache %s: %s" %
+                                (path, sys.exc_info()[1]))
+
+    def save_digest_cache(self):
+        """ Save the digest cache to the ``digest_cache`` file, if it
+        is set and the cache has changed. """
+        path = Bcfg2.Options.setup.posix_digest_cache
+        if not path:
+            return
+        with self._digest_lock:
+            if not self._digests_dirty:
+                return
+            data = json.dumps(self._digests)
+            self._digests_dirty = False
+        try:
+            (newfd, newfile) = tempfile.mkstemp(
+                prefix=os.path.basename(path), dir=os.path.dirname(path))
+            try:
+                os.write(newfd, data.encode('utf-8'))
+            finally:
+                os.close(newfd)
+            os.rename(newfile, path)
+        except (IOError, OSError):
+            self.logger.warning("POSIX: Failed to save digest cache %s: %s" %
+                                (path, sys.exc_info()[1]))
+
+    def _get_digest(self, path, ondisk):
+        """ Get the digest of a file, in the same ``<algorithm>:<hex
+        digest>`` form that the server uses.  The file is read in
+        chunks, so that it does not all need to be in memory at once,
+        and the result is cached by device, inode, size, modification
+        time, and change time if ``digest_cache`` is set.
+
+        :param path: The path to the file
+        :type path: string
+        :param ondisk: The result of ``os.lstat()`` on the file
+        :type ondisk: os.stat_result
+        :returns: string, or None if the file cannot be read
+        """
+        if not stat.S_ISREG(ondisk.st_mode):
+            return None
+        key = [ondisk.st_dev, ondisk.st_ino, ondisk.st_size,
+               ondisk.st_mtime, ondisk.st_ctime]
+        use_cache = bool(Bcfg2.Options.setup.posix_digest_cache)
+        if use_cache:
+            with self._digest_lock:
+                if self._digests is None:
+                    self._load_digest_cache()
+                cached = self._digests.get(path)
+            if cached is not None and cached[:-1] == key:
+                return cached[-1]
+
+        digest = sha256()
+        try:
+            fileobj = open(path, 'rb')
+            try:
+                for chunk in iter(lambda: fileobj.read(self.chunk_size), b''):
+                    digest.update(chunk)
+            finally:
+                fileobj.close()
+        except IOError:
+            self.logger.debug("POSIX: Failed to read %s: %s" %
+                              (path, sys.exc_info()[1]))
+            return None
+        rv = "sha256:%s" % digest.hexdigest()
+        if (use_cache and
+                time.time() - ondisk.st_mtime > self.digest_cache_min_age):
+            with self._digest_lock:
+                self._digests[path] = key + [rv]
+                self._digests_dirty = True
+        return rv
+
     def _write_tmpfile(self, entry):
         """ Write the file data to a temp file """
         filedata = self._get_data(entry)[0]
@@ -155,8 +280,9 @@ class POSIXFile(POSIXTool):
                                   (entry.get("name"), sys.exc_info()[1]))
                 return False
 
-        content_new = self._get_data(entry)[0]
         if not is_binary:
+            # the new content is only decoded if a diff is needed
+            content_new = self._get_data(entry)[0]
             try:
                 text_content = content.decode(Bcfg2.Options.setup.encoding)
                 text_content_new = content_new.decode(Bcfg2.Options.setup.encoding)
@@ -25,7 +25,14 @@ class POSIX(Bcfg2.Client.Tools.Tool):
             help='Specify the number of paranoid copies you want'),
         Bcfg2.Options.BooleanOption(
             '-P', '--paranoid', cf=('client', 'paranoid'),
-            help='Make automatic backups of config files')]
+            help='Make automatic backups of config files'),
+        Bcfg2.Options.PathOption(
+            cf=('POSIX', 'digest_cache'), dest='posix_digest_cache',
+            help='Cache file digests in the given file')]
+
+    #: Path entries are independent of each other, so they can be
+    #: verified concurrently.
+    parallel_verify = True
 
     def __init__(self, config):
         Bcfg2.Client.Tools.Tool.__init__(self, config)
@@ -91,6 +98,13 @@ class POSIX(Bcfg2.Client.Tools.Tool):
             return False
         return True
 
+    def Inventory(self, structures=None):
+        rv = Bcfg2.Client.Tools.Tool.Inventory(self, structures)
+        if 'file' in self._handlers:
+            self._handlers['file'].save_digest_cache()
+        return rv
+    Inventory.__doc__ = Bcfg2.Client.Tools.Tool.Inventory.__doc__
+
     def InstallPath(self, entry):
         """Dispatch install to the proper method according to type"""
         self.logger.debug("POSIX: Installing entry %s:%s:%s" %
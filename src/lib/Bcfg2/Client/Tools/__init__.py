@@ -4,6 +4,7 @@ import os
 import sys
 import stat
 import logging
+from concurrent.futures import ThreadPoolExecutor
 import Bcfg2.Options
 import Bcfg2.Client
 import Bcfg2.Client.XML
@@ -29,7 +30,10 @@ class Tool(object):
         Bcfg2.Options.Option(
             cf=('client', 'command_timeout'),
             help="Timeout when running external commands other than probes",
-            type=Bcfg2.Options.Types.timeout)]
+            type=Bcfg2.Options.Types.timeout),
+        Bcfg2.Options.Option(
+            cf=('client', 'inventory_workers'), type=int, default=1,
+            help="Number of entries to verify at once")]
 
     #: The name of the tool.  By default this uses
     #: :class:`Bcfg2.Client.Tools.ClassName` to ensure that it is the
@@ -74,6 +78,14 @@ class Tool(object):
     #: runtime with a warning.
     conflicts = []
 
+    #: Entries handled by this tool can be verified concurrently.  If
+    #: this is True and ``inventory_workers`` is greater than 1,
+    #: :func:`Bcfg2.Client.Tools.Tool.Inventory` calls the
+    #: ``Verify<tag>`` methods from a pool of threads, so they must
+    #: not depend on each other or on shared state that is not
+    #: protected by a lock.
+    parallel_verify = False
+
     def __init__(self, config):
         """
         :param config: The XML configuration for this client
@@ -194,6 +206,7 @@ class Tool(object):
             structures = self.config
         mods = self.buildModlist()
         states = dict()
+        verify = []
         for struct in structures:
             for entry in struct:
                 if self.canVerify(entry):
@@ -203,18 +216,49 @@ class Tool(object):
                         self.logger.error("%s: Cannot verify %s entries" %
                                           (self.name, entry.tag))
                         continue
-                    try:
-                        states[entry] = func(entry, mods)
-                    except KeyboardInterrupt:
-                        raise
-                    except:  # pylint: disable=W0702
-                        self.logger.error("%s: Unexpected failure verifying %s"
-                                          % (self.name,
-                                             self.primarykey(entry)),
-                                          exc_info=1)
+                    verify.append((entry, func))
+        workers = 1
+        if self.parallel_verify:
+            workers = max(1, min(Bcfg2.Options.setup.inventory_workers,
+                                 len(verify)))
+        if workers > 1:
+            pool = ThreadPoolExecutor(max_workers=workers)
+            try:
+                for future in [pool.submit(self._verify_entry, entry, func,
+                                           mods, states)
+                               for entry, func in verify]:
+                    future.result()
+            finally:
+                pool.shutdown()
+        else:
+            for entry, func in verify:
+                self._verify_entry(entry, func, mods, states)
         self.extra = self.FindExtra()
         return states
 
+    def _verify_entry(self, entry, func, mods, states):
+        """ Verify a single entry and record its state.
+
+        :param entry: The entry to verify
+        :type entry: lxml.etree._Element
+        :param func: The ``Verify<tag>`` method to verify it with
+        :type func: callable
+        :param mods: The list of modified paths, as returned by
+                     :func:`Bcfg2.Client.Tools.Tool.buildModlist`
+        :type mods: list of strings
+        :param states: The dict to record the state of the entry in
+        :type states: dict
+        :returns: None
+        """
+        try:
+            states[entry] = func(entry, mods)
+        except KeyboardInterrupt:
+            raise
+        except:  # pylint: disable=W0702
+            self.logger.error("%s: Unexpected failure verifying %s" %
+                              (self.name, self.primarykey(entry)),
+                              exc_info=1)
+
     def Install(self, entries):
         """ Install entries.  'Install' in this sense means either
         initially install, or update as necessary to match the
@@ -512,6 +556,10 @@ class PkgTool(Tool):
 class SvcTool(Tool):
     """ Base class for tools that handle Service entries """
 
+    #: Service status checks only query the init system, so they can
+    #: be run concurrently.
+    parallel_verify = True
+
     options = Tool.options + [
         Bcfg2.Options.Option(
             '-s', '--service-mode', default='default',
@@ -6,11 +6,13 @@ import stat
 import time
 import fcntl
 import socket
+import hashlib
 import fnmatch
 import logging
 import argparse
 import tempfile
 import copy
+from concurrent.futures import ThreadPoolExecutor
 import Bcfg2.Logger
 import Bcfg2.Options
 from Bcfg2.Client import XML
@@ -96,6 +98,9 @@ class Client(object):
             cf=('client', 'probe_timeout'),
             type=Bcfg2.Options.Types.timeout,
             help="Timeout when running client probes"),
+        Bcfg2.Options.Option(
+            cf=('client', 'probe_workers'), type=int, default=1,
+            help="Number of client probes to run at once"),
         Bcfg2.Options.Option(
             "-b", "--only-bundles", default=[],
             type=Bcfg2.Options.Types.colon_list,
@@ -117,8 +122,9 @@ class Client(object):
                 '-f', '--file', type=argparse.FileType('rb'),
                 help='Configure from a file rather than querying the server'),
             Bcfg2.Options.PathOption(
-                '-c', '--cache', type=argparse.FileType('wb'),
-                help='Store the configuration in a file')),
+                '-c', '--cache', type=argparse.FileType('ab+'),
+                help='Store the configuration in a file, and only '
+                'download it again if it has changed')),
         Bcfg2.Options.BooleanOption(
             '--exit-on-probe-failure', default=True,
             cf=('client', 'exit_on_probe_failure'),
@@ -158,6 +164,9 @@ class Client(object):
         self.tools = []
         self.times = dict()
         self.times['initialization'] = time.time()
+        # the time taken by individual steps, such as each probe, as
+        # opposed to the timestamps in self.times
+        self.durations = dict()
 
         if Bcfg2.Options.setup.bundle_quick:
             if (not Bcfg2.Options.setup.only_bundles and
@@ -191,11 +200,18 @@ class Client(object):
             self.logger.error(message)
 
     def run_probe(self, probe):
-        """Execute probe."""
+        """Execute probe.  The time the probe took to run is recorded
+        in :attr:`times`, and the probe is killed if it runs longer
+        than the timeout given in its ``timeout`` attribute, or the
+        ``probe_timeout`` option if it has none."""
         name = probe.get('name')
         self.logger.info("Running probe %s" % name)
+        start = time.time()
         ret = XML.Element("probe-data", name=name, source=probe.get('source'))
         try:
+            timeout = probe.get('timeout')
+            if timeout is not None:
+                timeout = float(timeout)
             scripthandle, scriptname = tempfile.mkstemp()
             if sys.hexversion >= 0x03000000:
                 script = os.fdopen(scripthandle, 'w',
@@ -214,7 +230,7 @@ class Client(object):
                          stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH |
                          stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH |
                          stat.S_IWUSR)  # 0755
-                rv = self.cmd.run(scriptname)
+                rv = self.cmd.run(scriptname, timeout=timeout)
                 if rv.stderr:
                     self.logger.warning("Probe %s has error output: %s" %
                                         (name, rv.stderr))
@@ -232,8 +248,34 @@ class Client(object):
             raise
         except:
             self._probe_failure(name, sys.exc_info()[1])
+        finally:
+            self.durations['probetime_%s' % name] = time.time() - start
         return ret
 
+    def fingerprint_probe(self, probe, result):
+        """ Add a fingerprint of the result of a probe to the probe
+        data sent to the server.  If the server sent the fingerprint
+        of the result it last received for the probe, and the result
+        has not changed, the result is omitted and the probe data is
+        marked as unchanged.
+
+        :param probe: The probe, as received from the server
+        :type probe: lxml.etree._Element
+        :param result: The probe data returned by :func:`run_probe`
+        :type result: lxml.etree._Element
+        :returns: lxml.etree._Element - the probe data to send
+        """
+        if result.text is None:
+            return result
+        fingerprint = hashlib.sha256(result.text.encode('utf-8')).hexdigest()
+        result.set("fingerprint", fingerprint)
+        if probe.get("fingerprint") == fingerprint:
+            self.logger.debug("Result of probe %s is unchanged" %
+                              probe.get("name"))
+            result.text = None
+            result.set("unchanged", "true")
+        return result
+
     def fatal_error(self, message):
         """Signal a fatal error."""
         self.logger.error("Fatal error: %s" % (message))
@@ -265,8 +307,20 @@ class Client(object):
 
         # execute probes
         probedata = XML.Element("ProbeData")
-        for probe in probes.findall(".//probe"):
-            probedata.append(self.run_probe(probe))
+        probelist = probes.findall(".//probe")
+        workers = max(1, min(Bcfg2.Options.setup.probe_workers,
+                             len(probelist)))
+        if workers > 1:
+            # results are returned in the order the probes were sent
+            pool = ThreadPoolExecutor(max_workers=workers)
+            try:
+                results = list(pool.map(self.run_probe, probelist))
+            finally:
+                pool.shutdown()
+        else:
+            results = [self.run_probe(probe) for probe in probelist]
+        for probe, result in zip(probelist, results):
+            probedata.append(self.fingerprint_probe(probe, result))
 
         if len(probes.findall(".//probe")) > 0:
             try:
@@ -283,12 +337,13 @@ class Client(object):
     def get_config(self):
         """ load the configuration, either from the cached
         configuration file (-f), or from the server """
+        cached = None
         if Bcfg2.Options.setup.file:
             # read config from file
             try:
                 self.logger.debug("Reading cached configuration from %s" %
                                   Bcfg2.Options.setup.file.name)
-                return Bcfg2.Options.setup.file.read()
+                rawconfig = Bcfg2.Options.setup.file.read()
             except IOError:
                 self.fatal_error("Failed to read cached configuration from: %s"
                                  % Bcfg2.Options.setup.file.name)
@@ -325,26 +380,76 @@ class Client(object):
                     err = sys.exc_info()[1]
                     self.fatal_error("Failed to get decision list: %s" % err)
 
+            cached = self.read_cache()
+            rawconfig = None
             try:
-                rawconfig = self.proxy.GetConfig().encode('utf-8')
+                if cached:
+                    # only download the configuration if it differs
+                    # from the cached one
+                    rawconfig = self.proxy.GetConfigIfChanged(
+                        hashlib.sha256(cached).hexdigest()).encode('utf-8')
+                    if not rawconfig:
+                        self.logger.info("Configuration has not changed, "
+                                         "using cached configuration")
+                        rawconfig = cached
             except Proxy.ProxyError:
+                # the server may not have the method, or an ACL may
+                # deny it; either way, the full configuration can
+                # still be downloaded.  any other error is fatal.
                 err = sys.exc_info()[1]
-                self.fatal_error("Failed to download configuration from "
-                                 "Bcfg2: %s" % err)
+                if err.fault_code == xmlrpclib.METHOD_NOT_FOUND:
+                    self.logger.info("Server does not support conditional "
+                                     "configuration downloads")
+                elif err.status == 401:
+                    self.logger.warning("Server denied conditional "
+                                        "configuration download, downloading "
+                                        "the full configuration")
+                else:
+                    self.fatal_error("Failed to download configuration from "
+                                     "Bcfg2: %s" % err)
+            if rawconfig is None:
+                try:
+                    rawconfig = self.proxy.GetConfig().encode('utf-8')
+                except Proxy.ProxyError:
+                    err = sys.exc_info()[1]
+                    self.fatal_error("Failed to download configuration from "
+                                     "Bcfg2: %s" % err)
 
             self.times['config_download'] = time.time()
 
         if Bcfg2.Options.setup.cache:
-            try:
-                Bcfg2.Options.setup.cache.write(rawconfig)
-                os.chmod(Bcfg2.Options.setup.cache.name, 384)  # 0600
-            except IOError:
-                self.logger.warning("Failed to write config cache file %s" %
-                                    (Bcfg2.Options.setup.cache))
+            # the cache is only rewritten if the configuration changed
+            if rawconfig != cached:
+                try:
+                    Bcfg2.Options.setup.cache.seek(0)
+                    Bcfg2.Options.setup.cache.truncate()
+                    Bcfg2.Options.setup.cache.write(rawconfig)
+                    Bcfg2.Options.setup.cache.flush()
+                    os.chmod(Bcfg2.Options.setup.cache.name, 384)  # 0600
+                except IOError:
+                    self.logger.warning("Failed to write config cache file "
+                                        "%s" % Bcfg2.Options.setup.cache.name)
             self.times['caching'] = time.time()
 
         return rawconfig
 
+    def read_cache(self):
+        """ Read the configuration cached by a previous run with
+        ``--cache``.
+
+        :returns: bytes - The cached configuration, or None if there
+                  is no cache or it cannot be read
+        """
+        if not Bcfg2.Options.setup.cache:
+            return None
+        try:
+            Bcfg2.Options.setup.cache.seek(0)
+            return Bcfg2.Options.setup.cache.read() or None
+        except IOError:
+            self.logger.warning("Failed to read config cache file %s" %
+                                Bcfg2.Options.setup.cache.name)
+            return None
+
     def parse_config(self, rawconfig):
         """ Parse the XML configuration received from the Bcfg2 server """
         try:
@@ -450,6 +555,8 @@ class Client(object):
                                   "%s" % err)
                 raise SystemExit(2)
 
+        if self._proxy is not None:
+            self._proxy.close()
         self.logger.info("Finished Bcfg2 client run at %s" % time.time())
 
     def load_tools(self):
@@ -616,6 +723,7 @@ class Client(object):
             for entry in struct:
                 self.states[entry] = False
         for tool in self.tools:
+            start = time.time()
             try:
                 self.states.update(tool.Inventory())
             except KeyboardInterrupt:
@@ -623,6 +731,8 @@ class Client(object):
             except:  # pylint: disable=W0702
                 self.logger.error("%s.Inventory() call failed:" % tool.name,
                                   exc_info=1)
+            self.durations['inventorytime_%s' % tool.name] = \
+                time.time() - start
 
     def Decide(self):  # pylint: disable=R0912
         """Set self.whitelist based on user interaction."""
@@ -964,4 +1074,7 @@ class Client(object):
         for (event, timestamp) in list(self.times.items()):
             timeinfo.set(event, str(timestamp))
         stats.append(timeinfo)
+        durations = XML.SubElement(stats, "Durations")
+        for (event, duration) in list(self.durations.items()):
+            durations.set(event, str(duration))
         return feedback
@@ -39,6 +39,9 @@ import socketserver as SocketServer
 # httplib imports
 import http.client as httplib
 
+# BaseHTTPServer imports
+import http.server as BaseHTTPServer
+
 try:
     str = str
 except NameError:
@@ -89,7 +92,7 @@ input = input
 from functools import reduce
 
 
-from collections.abc import MutableMapping
+from collections.abc import MutableMapping, Mapping
 
 
 class CmpMixin(object):
@@ -396,8 +396,8 @@ class DjangoORM(StorageBase):
                 getattr(inter, entry_type).add(*updates[entry_type][i:i + 100])
                 i += 100
 
-        # performance metrics
-        for times in stats.findall('OpStamps'):
+        # performance metrics: timestamps and durations
+        for times in stats.findall('OpStamps') + stats.findall('Durations'):
             for metric, value in list(times.items()):
                 Performance(interaction=inter,
                             metric=metric,
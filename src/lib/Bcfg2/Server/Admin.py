@@ -17,6 +17,7 @@ import Bcfg2.Logger
 import Bcfg2.Options
 import Bcfg2.DBSettings
 import Bcfg2.Server.Core
+import Bcfg2.Server.Statistics
 import Bcfg2.Client.Proxy
 from Bcfg2.Server.Plugin import PullSource, Generator, MetadataConsistencyError
 from Bcfg2.Utils import hostnames2ranges, Executor, safe_input
@@ -721,14 +722,44 @@ class Minestruct(_ServerAdminCmd):
 class Perf(_ProxyAdminCmd):
     """ Get performance data from server """
 
+    options = _ProxyAdminCmd.options + [
+        Bcfg2.Options.Option(
+            "-w", "--window", type=int, default=0, choices=[0, 1, 5, 15],
+            help="Only report on the last 1, 5, or 15 minutes")]
+
     def run(self, setup):
-        output = [('Name', 'Min', 'Max', 'Mean', 'Count')]
-        data = self.proxy.get_statistics()
-        for key in sorted(data.keys()):
-            output.append(
-                (key, ) +
-                tuple(["%.06f" % item
-                       for item in data[key][:-1]] + [data[key][-1]]))
+        try:
+            histograms = self.proxy.get_histograms(setup.window)
+        except Bcfg2.Client.Proxy.ProxyError:
+            # older servers do not keep histograms
+            if setup.window:
+                self.errExit("Server does not support --window: %s" %
+                             sys.exc_info()[1])
+            histograms = None
+
+        if histograms is None:
+            output = [('Name', 'Min', 'Max', 'Mean', 'Count')]
+            data = self.proxy.get_statistics()
+            for key in sorted(data.keys()):
+                output.append(
+                    (key, ) +
+                    tuple(["%.06f" % item
+                           for item in data[key][:-1]] + [data[key][-1]]))
+        else:
+            output = [('Name', 'Min', 'Max', 'Mean', 'P50', 'P95', 'P99',
+                       'Count')]
+            for key in sorted(histograms.keys()):
+                hist = Bcfg2.Server.Statistics.Histogram.from_data(
+                    histograms[key])
+                output.append(
+                    (key, ) +
+                    tuple(["%.06f" % item
+                           for item in (hist.min, hist.max,
+                                        hist.sum / hist.count,
+                                        hist.percentile(50),
+                                        hist.percentile(95),
+                                        hist.percentile(99))] +
+                          [hist.count]))
         print_table(output)
 
 
@@ -8,6 +8,7 @@ import daemon
 import Bcfg2.Options
 import Bcfg2.Server.Statistics
 from Bcfg2.Server.Core import NetworkCore, NoExposedMethod
+from Bcfg2.Server.Metrics import MetricFamily
 from Bcfg2.Compat import xmlrpclib, urlparse
 from Bcfg2.Server.SSLServer import XMLRPCServer
 
@@ -24,6 +25,28 @@ class BuiltinCore(NetworkCore):
     """ The built-in server core """
     name = 'bcfg2-server'
 
+    options = NetworkCore.options + [
+        Bcfg2.Options.Option(
+            cf=('server', 'workers'), dest='server_workers', type=int,
+            default=XMLRPCServer.workers,
+            help='Number of threads that handle client requests'),
+        Bcfg2.Options.Option(
+            cf=('server', 'request_queue'), dest='server_request_queue',
+            type=int, default=XMLRPCServer.queue_size,
+            help='Number of client requests that can wait for a free '
+            'thread before requests are rejected'),
+        Bcfg2.Options.Option(
+            cf=('server', 'retry_after'), dest='server_retry_after',
+            type=int, default=XMLRPCServer.retry_after,
+            help='Number of seconds rejected clients are asked to wait '
+            'before retrying'),
+        Bcfg2.Options.Option(
+            cf=('server', 'keepalive_timeout'),
+            dest='server_keepalive_timeout', type=float,
+            default=XMLRPCServer.idle_timeout,
+            help='Number of seconds to wait for the next request on an '
+            'open client connection')]
+
     def __init__(self):
         NetworkCore.__init__(self)
 
@@ -31,11 +54,16 @@ class BuiltinCore(NetworkCore):
         #: powering this server core
         self.server = None
 
+        files_preserve = self._logfilehandles()
+        if self.metrics_server is not None:
+            # the metrics socket is bound before daemonizing, so it
+            # must survive the daemon context closing open files
+            files_preserve.append(self.metrics_server.fileno())
         daemon_args = dict(uid=Bcfg2.Options.setup.daemon_uid,
                            gid=Bcfg2.Options.setup.daemon_gid,
                            umask=int(Bcfg2.Options.setup.umask, 8),
                            detach_process=True,
-                           files_preserve=self._logfilehandles())
+                           files_preserve=files_preserve)
         if Bcfg2.Options.setup.daemon:
             daemon_args['pidfile'] = TimeoutPIDLockFile(
                 Bcfg2.Options.setup.daemon, acquire_timeout=5)
@@ -138,13 +166,18 @@ class BuiltinCore(NetworkCore):
                                             socket.AF_UNSPEC,
                                             socket.SOCK_STREAM)[0][4]
         try:
-            self.server = XMLRPCServer(Bcfg2.Options.setup.listen_all,
-                                       server_address,
-                                       keyfile=Bcfg2.Options.setup.key,
-                                       certfile=Bcfg2.Options.setup.cert,
-                                       register=False,
-                                       ca=Bcfg2.Options.setup.ca,
-                                       protocol=Bcfg2.Options.setup.protocol)
+            self.server = XMLRPCServer(
+                Bcfg2.Options.setup.listen_all,
+                server_address,
+                keyfile=Bcfg2.Options.setup.key,
+                certfile=Bcfg2.Options.setup.cert,
+                register=False,
+                ca=Bcfg2.Options.setup.ca,
+                protocol=Bcfg2.Options.setup.protocol,
+                workers=Bcfg2.Options.setup.server_workers,
+                queue_size=Bcfg2.Options.setup.server_request_queue,
+                retry_after=Bcfg2.Options.setup.server_retry_after,
+                idle_timeout=Bcfg2.Options.setup.server_keepalive_timeout)
         except:  # pylint: disable=W0702
             err = sys.exc_info()[1]
             self.logger.error("Server startup failed: %s" % err)
@@ -152,6 +185,23 @@ class BuiltinCore(NetworkCore):
             return False
         return True
 
+    def collect_metrics(self):
+        families = NetworkCore.collect_metrics(self)
+        if self.server is None or not hasattr(self.server, "active"):
+            return families
+        requests = MetricFamily("bcfg2_server_requests", "gauge",
+                                "Number of client requests being handled "
+                                "and waiting for a thread")
+        requests.add_sample(self.server.active, labels=dict(state="active"))
+        requests.add_sample(self.server.queued(),
+                            labels=dict(state="queued"))
+        rejected = MetricFamily("bcfg2_server_requests_rejected", "counter",
+                                "Number of client requests rejected because "
+                                "all threads were busy")
+        rejected.add_sample(self.server.rejected, suffix="_total")
+        return families + [requests, rejected]
+    collect_metrics.__doc__ = NetworkCore.collect_metrics.__doc__
+
     def _block(self):
         """ Enter the blocking infinite loop. """
         self.server.register_instance(self)
@@ -1,6 +1,6 @@
 """ ``Bcfg2.Server.Cache`` is an implementation of a simple
-memory-backed cache. Right now this doesn't provide many features, but
-more (time-based expiration, etc.)  can be added as necessary.
+memory-backed cache, with optional time-based expiration and
+size-bounded LRU eviction.
 
 The normal workflow is to get a Cache object, which is simply a dict
 interface to the unified cache that automatically uses a certain tag
@@ -62,9 +62,176 @@ cache.  In this case, the latter call is equivalent to:
     groupcache = Bcfg2.Server.Cache.Cache("Probes", "probegroups")
     groupcache.expire()
 
+Time-Based Expiration and Size Limits
+-------------------------------------
+
+By default, cached data lives until it is explicitly expired.  A
+cache can also be given a time-to-live (in seconds) and/or a maximum
+number of entries when it is created:
+
+.. code-block:: python
+
+    mdcache = Bcfg2.Server.Cache.Cache("Metadata", ttl=300, maxsize=5000)
+
+Limits apply to the tag set, not to the individual ``Cache`` object,
+so every ``Cache`` object for ``"Metadata"`` shares them; creating a
+``Cache`` object without limits does not remove limits that were set
+previously.  Entries older than ``ttl`` are treated as absent and
+purged lazily, the next time they are looked up or iterated over.
+When a new entry would grow the tag set beyond ``maxsize`` entries,
+the least recently used entries are evicted.  Neither lazy expiration
+nor eviction calls the hooks registered with
+:func:`Bcfg2.Server.Cache.add_expire_hook`, since they are local
+decisions of this process rather than invalidations of the data.
+
+Lookups are served from an index of tag => keys, so iterating over a
+``Cache`` object or expiring a tag set costs time proportional to the
+number of matching entries, not to the size of the unified cache.
+
+Sharing Data Between Processes
+------------------------------
+
+The cache is normally private to each process.  When several
+processes compute the same data, as the children of the
+:mod:`Bcfg2.Server.MultiprocessingCore` do, a tag set can be shared
+between them through a :class:`Bcfg2.Server.Cache.SharedStore`:
+
+.. code-block:: python
+
+    Bcfg2.Server.Cache.set_shared_store("/dev/shm/bcfg2-cache")
+    pcache = Bcfg2.Server.Cache.Cache("Packages", "pkg_sets", shared=True)
+
+Items in a shared tag set are pickled into the store when they are
+set, and loaded (via :func:`mmap.mmap`) from the store when they are
+looked up, so a process can use data computed by its siblings, and
+each process only holds the data it is currently working with.  This
+is only worthwhile for data that is expensive to compute, cheap to
+unpickle, and not modified after it has been cached.  Only the items
+that a process has set or looked up itself are included when it
+iterates over a shared tag set.  The time-to-live of a shared item
+counts from when any process stored it, and each process applies the
+size limit to the shared items it has set or looked up itself, so the
+store holds at most ``maxsize`` items per process; items that a
+process evicts or finds expired are removed from the store as well,
+and simply computed again by any process that needs them.  Expiring
+data removes it from the store as well; since expiration is also sent to the other processes
+via the expire hooks, items are removed even if the process that
+expires them never saw them.  If no store is set, shared tag sets are
+simply cached locally.
 """
 
-from Bcfg2.Compat import MutableMapping
+import os
+import sys
+import time
+import mmap
+import shutil
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+from Bcfg2.Compat import MutableMapping, cPickle, md5
+
+LOGGER = logging.getLogger(__name__)
+
+#: Placeholder stored in the local cache for items whose values live
+#: in the :class:`Bcfg2.Server.Cache.SharedStore`
+_IN_STORE = object()
+
+
+class SharedStore(object):
+    """ A cache store that can be read and written by several
+    processes.  Each item is pickled to its own file in a directory
+    per tag set; the directory should be on a memory-backed
+    filesystem, such as ``/dev/shm``, so that items can be loaded
+    straight from memory. """
+
+    def __init__(self, path):
+        """
+        :param path: The directory to store items in.  It will be
+                     created if it does not exist.
+        :type path: string
+        """
+        self.path = path
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+    def _dir(self, tags):
+        """ Get the directory that holds the items in a tag set """
+        return os.path.join(self.path,
+                            md5(repr(sorted(tags)).encode()).hexdigest())
+
+    def _file(self, tags, key):
+        """ Get the file that holds a single item """
+        return os.path.join(self._dir(tags),
+                            md5(repr(key).encode()).hexdigest())
+
+    def __contains__(self, item):
+        return os.path.exists(self._file(*item))
+
+    def get(self, tags, key):
+        """ Load an item from the store.
+
+        :raises: KeyError if the item is not in the store
+        """
+        try:
+            fileobj = open(self._file(tags, key), 'rb')
+        except (IOError, OSError):
+            raise KeyError(key)
+        try:
+            data = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                return cPickle.loads(data)
+            finally:
+                data.close()
+        finally:
+            fileobj.close()
+
+    def set(self, tags, key, value):
+        """ Store an item.  The item is written to a temporary file
+        that is then renamed into place, so readers never see a
+        partially written item. """
+        data = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+        dirname = self._dir(tags)
+        if not os.path.exists(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # another process may have created it in the meantime
+                if not os.path.isdir(dirname):
+                    raise
+        (fd, tmpfile) = tempfile.mkstemp(dir=dirname, prefix=".")
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+        os.rename(tmpfile, self._file(tags, key))
+
+    def mtime(self, tags, key):
+        """ Get the time at which an item was stored.
+
+        :returns: float, or None if the item is not in the store
+        """
+        try:
+            return os.stat(self._file(tags, key)).st_mtime
+        except OSError:
+            return None
+
+    def delete(self, tags, key):
+        """ Remove a single item from the store. """
+        try:
+            os.unlink(self._file(tags, key))
+        except OSError:
+            pass
+
+    def expire(self, tags=None):
+        """ Remove all items in a tag set, or all items in the store
+        if no tag set is given. """
+        if tags is None:
+            dirs = [os.path.join(self.path, d) for d in os.listdir(self.path)]
+        else:
+            dirs = [self._dir(tags)]
+        for dirname in dirs:
+            shutil.rmtree(dirname, ignore_errors=True)
 
 
 class _Cache(MutableMapping):
@@ -76,13 +243,16 @@ class _Cache(MutableMapping):
         self._tags = tags
 
     def __getitem__(self, key):
-        return self._registry[self._tags | set([key])]
+        return self._registry.get_item(self._tags, key)
 
     def __setitem__(self, key, value):
-        self._registry[self._tags | set([key])] = value
+        self._registry.set_item(self._tags, key, value)
 
     def __delitem__(self, key):
-        del self._registry[self._tags | set([key])]
+        self._registry.del_item(self._tags, key)
+
+    def __contains__(self, key):
+        return self._registry.has_item(self._tags, key)
 
     def __iter__(self):
         for item in self._registry.iterate(*self._tags):
@@ -119,7 +289,280 @@ class _Cache(MutableMapping):
 
 class _CacheRegistry(dict):
     """ The grand unified cache backend which contains all cache
-    items. """
+    items.
+
+    In addition to the items themselves, the registry keeps an
+    inverted index of tag => set of keys carrying that tag, and, for
+    tag sets that have limits set with :func:`set_limits`, an LRU
+    ordered record of each key's expiration time. """
+
+    def __init__(self):
+        dict.__init__(self)
+
+        #: Lock held while modifying the registry and its indexes
+        self._lock = threading.RLock()
+
+        #: Inverted index of tag => set of keys with that tag
+        self._index = dict()
+
+        #: Limits set with :func:`set_limits`.  Keys are tag sets, and
+        #: values are ``(<ttl>, <maxsize>)`` tuples.
+        self._limits = dict()
+
+        #: For each tag set with limits, an OrderedDict of key =>
+        #: expiration time (or None), in least to most recently used
+        #: order.
+        self._lru = dict()
+
+        #: Map of key => tag set for keys stored under a tag set with
+        #: limits, so the LRU record can be found from the key alone.
+        self._owners = dict()
+
+        #: All tag sets that :func:`Bcfg2.Server.Cache.Cache` objects
+        #: have been created for
+        self.tagsets = set()
+
+        #: Tag sets that are kept in :attr:`store`
+        self.shared = set()
+
+        #: The :class:`Bcfg2.Server.Cache.SharedStore` that shared tag
+        #: sets are kept in, or None to cache them locally
+        self.store = None
+
+    def set_limits(self, tags, ttl=None, maxsize=None):
+        """ Set the time-to-live and maximum size for a tag set.
+
+        :param tags: The tag set to limit
+        :type tags: frozenset
+        :param ttl: Number of seconds after which an item expires, or
+                    None to never expire items
+        :type ttl: int or float
+        :param maxsize: Maximum number of items in the tag set, or
+                        None for no limit
+        :type maxsize: int
+        """
+        with self._lock:
+            self._limits[tags] = (ttl, maxsize)
+            self._lru.setdefault(tags, OrderedDict())
+            self._evict(tags)
+
+    def _is_shared(self, tags):
+        """ Whether the given tag set is kept in the shared store """
+        return self.store is not None and tags in self.shared
+
+    def _shared_expires(self, tags, key):
+        """ Get the expiration time of an item in a shared tag set.
+        Its time-to-live counts from when it was stored, by this or
+        any other process.  The item is removed from the store if it
+        has expired.
+
+        :returns: float, or None if the item never expires
+        :raises: KeyError if the item has expired
+        """
+        ttl = self._limits.get(tags, (None, None))[0]
+        if ttl is None:
+            return None
+        mtime = self.store.mtime(tags, key)
+        if mtime is None:
+            return None
+        expires = mtime + ttl
+        if expires <= time.time():
+            fullkey = tags | set([key])
+            with self._lock:
+                if fullkey in self:
+                    del self[fullkey]
+            self.store.delete(tags, key)
+            raise KeyError(key)
+        return expires
+
+    def _touch(self, tags, fullkey, expires):
+        """ Record the use of an item in a tag set with limits, and
+        evict the least recently used items beyond the size limit.
+        This must be called with :attr:`_lock` held. """
+        lru = self._lru[tags]
+        lru[fullkey] = expires
+        lru.move_to_end(fullkey)
+        self._owners[fullkey] = tags
+        self._evict(tags)
+
+    def has_item(self, tags, key):
+        """ Whether an item is stored under the given tag set.  This
+        avoids loading shared items from the store. """
+        fullkey = tags | set([key])
+        if self._is_shared(tags):
+            try:
+                self._shared_expires(tags, key)
+            except KeyError:
+                return False
+            if (tags, key) in self.store:
+                return True
+            if fullkey in self:
+                # another process has expired the item
+                with self._lock:
+                    dict.pop(self, fullkey, None)
+                    self._unindex(fullkey)
+            return False
+        try:
+            self.get_item(tags, key)
+            return True
+        except KeyError:
+            return False
+
+    def get_item(self, tags, key):
+        """ Get an item stored under the given tag set, honoring its
+        time-to-live and updating its LRU position. """
+        fullkey = tags | set([key])
+        if self._is_shared(tags):
+            expires = self._shared_expires(tags, key)
+            try:
+                rv = self.store.get(tags, key)
+            except KeyError:
+                if fullkey in self:
+                    with self._lock:
+                        dict.pop(self, fullkey, None)
+                        self._unindex(fullkey)
+                raise
+            except Exception:  # pylint: disable=W0703
+                LOGGER.warning("Failed to load %s from shared cache: %s" %
+                               (sorted(fullkey), sys.exc_info()[1]))
+                raise KeyError(key)
+            with self._lock:
+                if fullkey not in self:
+                    self[fullkey] = _IN_STORE
+                if tags in self._lru:
+                    self._touch(tags, fullkey, expires)
+            return rv
+        rv = dict.__getitem__(self, fullkey)
+        if tags in self._lru:
+            with self._lock:
+                lru = self._lru[tags]
+                try:
+                    expires = lru[fullkey]
+                except KeyError:
+                    return rv
+                if expires is not None and expires <= time.time():
+                    del self[fullkey]
+                    raise KeyError(key)
+                lru.move_to_end(fullkey)
+        return rv
+
+    def set_item(self, tags, key, value):
+        """ Store an item under the given tag set, applying its
+        time-to-live and size limit. """
+        fullkey = tags | set([key])
+        if self._is_shared(tags):
+            try:
+                self.store.set(tags, key, value)
+                value = _IN_STORE
+            except Exception:  # pylint: disable=W0703
+                LOGGER.warning("Failed to add %s to shared cache, caching "
+                               "locally: %s" % (sorted(fullkey),
+                                                sys.exc_info()[1]))
+        with self._lock:
+            self[fullkey] = value
+            if tags in self._lru:
+                ttl = self._limits[tags][0]
+                if ttl is None:
+                    expires = None
+                else:
+                    expires = time.time() + ttl
+                self._touch(tags, fullkey, expires)
+
+    def del_item(self, tags, key):
+        """ Remove an item stored under the given tag set. """
+        fullkey = tags | set([key])
+        if self._is_shared(tags) and (tags, key) in self.store:
+            self.store.delete(tags, key)
+            with self._lock:
+                if fullkey in self:
+                    dict.pop(self, fullkey)
+                    self._unindex(fullkey)
+        else:
+            del self[fullkey]
+
+    def _evict(self, tags):
+        """ Evict the least recently used items from the given tag set
+        until it is within its size limit. """
+        maxsize = self._limits[tags][1]
+        if maxsize is None:
+            return
+        lru = self._lru[tags]
+        while len(lru) > maxsize:
+            del self[next(iter(lru))]
+
+    def _expired(self, key, now):
+        """ Purge the given key if its time-to-live has passed.
+
+        :returns: bool - True if the key was expired
+        """
+        owner = self._owners.get(key)
+        if owner is None:
+            return False
+        expires = self._lru[owner].get(key)
+        if expires is not None and expires <= now:
+            with self._lock:
+                if key in self:
+                    del self[key]
+            return True
+        return False
+
+    def _index_key(self, key):
+        """ Add a key to the tag index.  This must be called with
+        :attr:`_lock` held. """
+        for tag in key:
+            self._index.setdefault(tag, set()).add(key)
+
+    def _unindex(self, key):
+        """ Remove a key from the tag index and the LRU records.  This
+        must be called with :attr:`_lock` held. """
+        for tag in key:
+            keys = self._index.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._index[tag]
+        owner = self._owners.pop(key, None)
+        if owner is not None:
+            self._lru[owner].pop(key, None)
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            dict.__setitem__(self, key, value)
+            self._index_key(key)
+
+    def __delitem__(self, key):
+        with self._lock:
+            value = dict.pop(self, key)
+            self._unindex(key)
+            if value is _IN_STORE and self.store is not None:
+                for tags in self.shared:
+                    if len(key) == len(tags) + 1 and tags.issubset(key):
+                        self.store.delete(tags, list(key - tags)[0])
+
+    def clear(self):
+        with self._lock:
+            dict.clear(self)
+            self._index.clear()
+            self._owners.clear()
+            for lru in self._lru.values():
+                lru.clear()
+            if self.store is not None:
+                self.store.expire()
+
+    def _matching(self, tags):
+        """ Get a list of all keys that carry all of the given tags,
+        using the tag index. """
+        if not tags:
+            return list(self.keys())
+        with self._lock:
+            candidates = sorted([self._index.get(tag, frozenset())
+                                 for tag in tags], key=len)
+            rv = set(candidates[0])
+            for keys in candidates[1:]:
+                if not rv:
+                    break
+                rv.intersection_update(keys)
+        return list(rv)
 
     def iterate(self, *tags):
         """ Iterate over all items that match the given tags *and*
@@ -127,8 +570,9 @@ class _CacheRegistry(dict):
         for :class:`Bcfg2.Server.Cache._Cache` objects that have been
         instantiated via :func:`Bcfg2.Server.Cache.Cache`. """
         tags = frozenset(tags)
-        for key in list(self.keys()):
-            if key.issuperset(tags) and len(key.difference(tags)) == 1:
+        now = time.time()
+        for key in self._matching(tags):
+            if len(key) == len(tags) + 1 and not self._expired(key, now):
                 yield key
 
     def iter_all(self, *tags):
@@ -136,20 +580,60 @@ class _CacheRegistry(dict):
         regardless of how many additional tags they have (or don't
         have). This is used to expire all cache data that matches a
         set of tags. """
-        tags = frozenset(tags)
-        for key in list(self.keys()):
-            if key.issuperset(tags):
-                yield key
+        return iter(self._matching(frozenset(tags)))
 
 
 _cache = _CacheRegistry()  # pylint: disable=C0103
 _hooks = []  # pylint: disable=C0103
 
 
-def Cache(*tags):  # pylint: disable=C0103
+def Cache(*tags, **kwargs):  # pylint: disable=C0103
     """ A dict interface to the cache data tagged with the given
-    tags. """
-    return _Cache(_cache, frozenset(tags))
+    tags.
+
+    :param shared: Keep this tag set in the shared store set with
+                   :func:`set_shared_store`, if any
+    :type shared: bool
+    :param ttl: Number of seconds after which items in this tag set
+                expire.  If this is omitted, limits previously set on
+                the tag set are left untouched.
+    :type ttl: int or float
+    :param maxsize: Maximum number of items in this tag set; the
+                    least recently used items are evicted beyond it
+    :type maxsize: int
+    """
+    tags = frozenset(tags)
+    _cache.tagsets.add(tags)
+    if kwargs.get("shared"):
+        _cache.shared.add(tags)
+    if kwargs.get("ttl") is not None or kwargs.get("maxsize") is not None:
+        _cache.set_limits(tags, ttl=kwargs.get("ttl"),
+                          maxsize=kwargs.get("maxsize"))
+    return _Cache(_cache, tags)
+
+
+def set_shared_store(path):
+    """ Set the directory that shared tag sets are kept in.  See
+    :class:`Bcfg2.Server.Cache.SharedStore`.
+
+    :param path: The directory to keep shared data in, or None to
+                 cache shared tag sets locally
+    :type path: string
+    """
+    if path is None:
+        _cache.store = None
+    else:
+        _cache.store = SharedStore(path)
+
+
+def sizes():
+    """ Get the number of items in each tag set that a
+    :func:`Bcfg2.Server.Cache.Cache` object has been created for.
+
+    :returns: dict of tag set => number of items
+    """
+    return dict((tags, len(_Cache(_cache, tags)))
+                for tags in list(_cache.tagsets))
 
 
 def expire(*tags, **kwargs):
@@ -169,10 +653,22 @@ def expire(*tags, **kwargs):
         if frozenset(tags) in _cache:
             count = 1
             del _cache[frozenset(tags)]
+        elif _cache.store is not None:
+            for tagset in list(_cache.shared):
+                if (len(tags) == len(tagset) + 1 and
+                        tagset.issubset(tags)):
+                    key = list(frozenset(tags) - tagset)[0]
+                    if (tagset, key) in _cache.store:
+                        count = 1
+                        _cache.store.delete(tagset, key)
     else:
         for match in _cache.iter_all(*tags):
             count += 1
             del _cache[match]
+        if _cache.store is not None:
+            for tagset in list(_cache.shared):
+                if tagset.issuperset(tags):
+                    _cache.store.expire(tagset)
 
     for hook in _hooks:
         hook(tags, exact, count)
@@ -6,6 +6,8 @@ import pwd
 import atexit
 import logging
 import select
+import hashlib
+import socket
 import sys
 import threading
 import time
@@ -16,10 +18,13 @@ import Bcfg2.Server
 import Bcfg2.Logger
 import Bcfg2.Options
 import Bcfg2.DBSettings
+import Bcfg2.Server.Cache
+import Bcfg2.Server.Snapshot
 import Bcfg2.Server.Statistics
 import Bcfg2.Server.FileMonitor
 from itertools import chain
 from Bcfg2.Server.Cache import Cache
+from Bcfg2.Server.Metrics import MetricFamily, MetricsServer, parse_address
 from Bcfg2.Compat import xmlrpclib, wraps  # pylint: disable=W0622
 from Bcfg2.Server.Plugin.exceptions import *  # pylint: disable=W0401,W0614
 from Bcfg2.Server.Plugin.interfaces import *  # pylint: disable=W0401,W0614
@@ -116,6 +121,7 @@ class DefaultACL(Plugin, ClientACLs):
         return (("." not in rmi and
                  not rmi.endswith("_debug") and
                  rmi != 'get_statistics' and
+                 rmi != 'get_histograms' and
                  rmi != 'expire_metadata_cache') or
                 address[0] == "127.0.0.1")
 
@@ -137,6 +143,10 @@ class Core(object):
             "--no-fam-blocking", cf=('server', 'fam_blocking'),
             dest="fam_blocking", default=True,
             help='FAM blocks on startup until all events are processed'),
+        Bcfg2.Options.PathOption(
+            cf=('server', 'snapshot'),
+            help="Keep a snapshot of parsed repository data in this file "
+            "to speed up server startup"),
         Bcfg2.Options.BooleanOption(
             cf=('logging', 'performance'), dest="perflog",
             help="Periodically log performance statistics"),
@@ -147,7 +157,14 @@ class Core(object):
         Bcfg2.Options.Option(
             cf=('caching', 'client_metadata'), dest='client_metadata_cache',
             default='off',
-            choices=['off', 'on', 'initial', 'cautious', 'aggressive'])]
+            choices=['off', 'on', 'initial', 'cautious', 'aggressive']),
+        Bcfg2.Options.Option(
+            cf=('caching', 'client_metadata_ttl'), default=None,
+            type=Bcfg2.Options.Types.timeout,
+            help="Expire cached client metadata after this many seconds"),
+        Bcfg2.Options.Option(
+            cf=('caching', 'client_metadata_size'), default=None, type=int,
+            help="Maximum number of cached client metadata objects")]
 
     #: The name of this server core. This can be overridden by core
     #: implementations to provide a more specific name.
@@ -207,6 +224,21 @@ class Core(object):
         #: plugin objects.
         self.plugins = {}
 
+        #: Cache of the results of :func:`plugins_by_type`.  Keys are
+        #: plugin interface classes, and values are the sorted lists
+        #: of plugins that implement them.  This is invalidated by
+        #: :func:`expire_plugin_registry` whenever :attr:`plugins`
+        #: changes.
+        self._plugin_registry = dict()
+
+        #: The number of :func:`plugins_by_type` calls answered from
+        #: :attr:`_plugin_registry`
+        self.plugin_registry_hits = 0
+
+        #: The number of :func:`plugins_by_type` calls that had to
+        #: build the list of plugins
+        self.plugin_registry_misses = 0
+
         #: Blacklist of plugins that conflict with enabled plugins.
         #: If two plugins are loaded that conflict with each other,
         #: the first one loaded wins.
@@ -239,6 +271,22 @@ class Core(object):
         # that are created by Connector plugins came from
         self._dynamic_groups = dict()
 
+        #: Generator dispatch index used by :func:`Bind`.  Keys are
+        #: ``(<entry tag>, <entry name>)`` tuples, and values are
+        #: tuples of the generator plugins whose ``Entries`` dict
+        #: lists that entry.  An empty tuple is a negative cache
+        #: entry: no generator lists the entry, so it must be bound
+        #: with :func:`Bcfg2.Server.Plugin.interfaces.Generator.HandlesEntry`.
+        #: The index is populated lazily and discarded whenever the
+        #: FAM dispatches an event or the set of loaded plugins
+        #: changes.
+        self._bind_index = dict()
+
+        #: The value of
+        #: :attr:`Bcfg2.Server.FileMonitor.FileMonitor.dispatched`
+        #: that :attr:`_bind_index` is valid for.
+        self._bind_index_serial = None
+
         #: The FAM :class:`threading.Thread`,
         #: :func:`_file_monitor_thread`
         self.fam_thread = \
@@ -254,13 +302,20 @@ class Core(object):
                 threading.Thread(name="PerformanceLoggingThread",
                                  target=self._perflog_thread)
 
+        #: The :class:`threading.Thread` that serves
+        #: :func:`collect_metrics` over HTTP.  This is only set by
+        #: :class:`Bcfg2.Server.Core.NetworkCore` cores.
+        self.metrics_thread = None
+
         #: A :func:`threading.Lock` for use by
         #: :func:`Bcfg2.Server.FileMonitor.FileMonitor.handle_event_set`
         self.lock = threading.Lock()
 
         #: A :class:`Bcfg2.Server.Cache.Cache` object for caching client
         #: metadata
-        self.metadata_cache = Cache("Metadata")
+        self.metadata_cache = Cache(
+            "Metadata", ttl=Bcfg2.Options.setup.client_metadata_ttl,
+            maxsize=Bcfg2.Options.setup.client_metadata_size)
 
         #: Whether or not it's possible to use the Django database
         #: backend for plugins that have that capability
@@ -294,15 +349,40 @@ class Core(object):
         the same numerical sort_order value are sorted in alphabetical
         order by their name.
 
+        The list is computed once per interface and cached in
+        :attr:`_plugin_registry` until the set of loaded plugins
+        changes, so it must not be modified by the caller.  Cache hits
+        and misses are counted in :attr:`plugin_registry_hits` and
+        :attr:`plugin_registry_misses`.
+
         :param base_cls: The base plugin interface class to match (see
                          :mod:`Bcfg2.Server.Plugin.interfaces`)
         :type base_cls: type
         :returns: list of :attr:`Bcfg2.Server.Plugin.base.Plugin`
                   objects
         """
-        return sorted([plugin for plugin in list(self.plugins.values())
-                       if isinstance(plugin, base_cls)],
-                      key=lambda p: (p.sort_order, p.name))
+        registry = self._plugin_registry
+        try:
+            rv = registry[base_cls]
+        except KeyError:
+            self.plugin_registry_misses += 1
+            rv = sorted([plugin for plugin in list(self.plugins.values())
+                         if isinstance(plugin, base_cls)],
+                        key=lambda p: (p.sort_order, p.name))
+            registry[base_cls] = rv
+        else:
+            self.plugin_registry_hits += 1
+        return rv
+
+    def expire_plugin_registry(self):
+        """ Discard the cached results of :func:`plugins_by_type` and
+        the generator dispatch index used by :func:`Bind`.  This must
+        be called whenever :attr:`plugins` is modified. """
+        # replace the dict rather than clearing it, so that a
+        # concurrent plugins_by_type() call cannot put a stale result
+        # into the new registry
+        self._plugin_registry = dict()
+        self.expire_bind_index()
 
     def _perflog_thread(self):
         """ The thread that periodically logs performance statistics
@@ -311,10 +391,18 @@ class Core(object):
         while not self.terminate.isSet():
             self.terminate.wait(Bcfg2.Options.setup.performance_interval)
             if not self.terminate.isSet():
+                histograms = self.get_histograms(None)
                 for name, stats in list(self.get_statistics(None).items()):
-                    self.logger.info("Performance statistics: "
-                                     "%s min=%.06f, max=%.06f, average=%.06f, "
-                                     "count=%d" % ((name, ) + stats))
+                    msg = "Performance statistics: %s min=%.06f, " \
+                        "max=%.06f, average=%.06f, count=%d" % \
+                        ((name, ) + stats)
+                    if name in histograms:
+                        hist = Bcfg2.Server.Statistics.Histogram.from_data(
+                            histograms[name])
+                        msg += ", p50=%.06f, p95=%.06f, p99=%.06f" % \
+                            (hist.percentile(50), hist.percentile(95),
+                             hist.percentile(99))
+                    self.logger.info(msg)
         self.logger.info("Performance logging thread terminated")
 
     def _file_monitor_thread(self):
@@ -380,6 +468,7 @@ class Core(object):
                                   "Unloading %s" % (plugin, blacklist))
             for plug in blacklist:
                 del self.plugins[plug]
+        self.expire_plugin_registry()
 
         # Log deprecated and experimental plugins
         expl = []
@@ -438,6 +527,7 @@ class Core(object):
         except Exception as e:
             self.logger.error("Unexpected instantiation failure for plugin %s"
                               % plugin, exc_info=e)
+        self.expire_plugin_registry()
 
     @close_db_connection
     def shutdown(self):
@@ -451,8 +541,10 @@ class Core(object):
         self._running = False
         self.fam.shutdown()
         self.logger.info("%s: FAM shut down" % self.name)
+        self._save_snapshot()
         for plugin in list(self.plugins.values()):
             plugin.shutdown()
+        self.expire_plugin_registry()
         self.logger.info("%s: All plugins shut down" % self.name)
 
     @property
@@ -625,6 +717,42 @@ class Core(object):
                 self.logger.error("%s %s:%s: %s" %
                                   (msg, entry.tag, entry.get('name'), exc), exc_info=e)
 
+    def expire_bind_index(self):
+        """ Discard the generator dispatch index used by :func:`Bind`.
+        This is done automatically by :func:`expire_plugin_registry`
+        and when FAM events are handled, but can be called explicitly
+        by anything that modifies a generator's ``Entries`` dict
+        outside of a FAM event handler. """
+        self._bind_index_serial = None
+
+    def _get_bind_generators(self, tag, name):
+        """ Get the generator plugins whose ``Entries`` dict lists the
+        given entry, consulting and populating :attr:`_bind_index`.
+
+        :param tag: The tag of the entry
+        :type tag: string
+        :param name: The name of the entry
+        :type name: string
+        :returns: tuple of :class:`Bcfg2.Server.Plugin.interfaces.Generator`
+                  objects
+        """
+        serial = self.fam.dispatched
+        if serial != self._bind_index_serial:
+            # replace the dict rather than clearing it, so that
+            # threads that are currently populating the old index
+            # cannot put stale data into the new one
+            self._bind_index = dict()
+            self._bind_index_serial = serial
+        index = self._bind_index
+        key = (tag, name)
+        try:
+            return index[key]
+        except KeyError:
+            rv = tuple(gen for gen in self.plugins_by_type(Generator)
+                       if name in gen.Entries.get(tag, {}))
+            index[key] = rv
+            return rv
+
     def Bind(self, entry, metadata):
         """ Bind a single entry using the appropriate generator.
 
@@ -653,29 +781,34 @@ class Core(object):
                 self.logger.error("Falling back to %s:%s" %
                                   (entry.tag, entry.get('name')))
 
-        generators = self.plugins_by_type(Generator)
-        glist = [gen for gen in generators
-                 if entry.get('name') in gen.Entries.get(entry.tag, {})]
-        if len(glist) == 1:
-            return glist[0].Entries[entry.tag][entry.get('name')](entry,
-                                                                  metadata)
-        elif len(glist) > 1:
-            generators = ", ".join([gen.name for gen in glist])
-            self.logger.error("%s %s served by multiple generators: %s" %
-                              (entry.tag, entry.get('name'), generators))
-        g2list = [gen for gen in generators
-                  if gen.HandlesEntry(entry, metadata)]
+        generator = None
         try:
+            glist = self._get_bind_generators(entry.tag, entry.get('name'))
+            if len(glist) == 1:
+                generator = glist[0]
+                return generator.Entries[entry.tag][entry.get('name')](
+                    entry, metadata)
+            elif len(glist) > 1:
+                generators = ", ".join([gen.name for gen in glist])
+                self.logger.error("%s %s served by multiple generators: %s" %
+                                  (entry.tag, entry.get('name'), generators))
+            g2list = [gen for gen in self.plugins_by_type(Generator)
+                      if gen.HandlesEntry(entry, metadata)]
             if len(g2list) == 1:
-                return g2list[0].HandleEntry(entry, metadata)
+                generator = g2list[0]
+                return generator.HandleEntry(entry, metadata)
             entry.set('failure', 'no matching generator')
             raise PluginExecutionError("No matching generator: %s:%s" %
                                        (entry.tag, entry.get('name')))
         finally:
-            Bcfg2.Server.Statistics.stats.add_value("%s:Bind:%s" %
-                                                    (self.__class__.__name__,
-                                                     entry.tag),
-                                                    time.time() - start)
+            elapsed = time.time() - start
+            Bcfg2.Server.Statistics.stats.add_value(
+                "%s:Bind:%s" % (self.__class__.__name__, entry.tag), elapsed)
+            if generator is not None:
+                Bcfg2.Server.Statistics.stats.add_value(
+                    "%s:Generator:%s" % (self.__class__.__name__,
+                                         generator.name),
+                    elapsed)
 
     def BuildConfiguration(self, client):
         """ Build the complete configuration for a client.
@@ -781,6 +914,7 @@ class Core(object):
             return False
 
         try:
+            Bcfg2.Server.Snapshot.load()
             self.load_plugins()
 
             self.fam.start()
@@ -788,16 +922,26 @@ class Core(object):
             self.fam.AddMonitor(self.cfile, self)
             if self.perflog_thread is not None:
                 self.perflog_thread.start()
+            if self.metrics_thread is not None:
+                self.metrics_thread.start()
 
             for plug in self.plugins_by_type(Threaded):
                 plug.start_threads()
 
             self.block_for_fam_events()
+            self._save_snapshot()
             self._block()
         except:
             self.shutdown()
             raise
 
+    def _save_snapshot(self):
+        """ Save the :mod:`Bcfg2.Server.Snapshot` of parsed repository
+        data.  This is done once the server has handled the initial
+        FAM events, and again when it shuts down.  Nothing is saved
+        unless the snapshot was loaded by :func:`run`. """
+        Bcfg2.Server.Snapshot.save()
+
     def _run(self):
         """ Start up the server; this method should return
         immediately.  This must be overridden by a core
@@ -1233,6 +1377,38 @@ class Core(object):
         except MetadataConsistencyError:
             self.critical_error("Metadata consistency failure for %s" % client)
 
+    @exposed
+    def GetConfigIfChanged(self, address, digest):
+        """ Build config for a client by calling :func:`GetConfig`,
+        but only return it if it differs from the configuration the
+        client already has, so that a client whose configuration has
+        not changed does not need to download it again.
+
+        :param address: Client (address, port) pair
+        :type address: tuple
+        :param digest: The SHA-256 hex digest of the UTF-8 encoded
+                       configuration the client has cached
+        :type digest: string
+        :returns: string - The full configuration document for the
+                  client, or an empty string if its digest is
+                  ``digest``
+        :raises: :exc:`xmlrpclib.Fault`
+        """
+        config = self.GetConfig(address)
+        if isinstance(config, str):
+            data = config.encode('UTF-8')
+        else:
+            data = config
+        unchanged = hashlib.sha256(data).hexdigest() == digest
+        Bcfg2.Server.Statistics.stats.add_value(
+            "%s:config_unchanged" % self.__class__.__name__, int(unchanged),
+            unit="")
+        if unchanged:
+            self.logger.debug("Configuration for %s has not changed" %
+                              address[0])
+            return ""
+        return config
+
     @exposed
     @close_db_connection
     def RecvStats(self, address, stats):
@@ -1277,6 +1453,89 @@ class Core(object):
                   :func:`Bcfg2.Server.Statistics.Statistics.display` """
         return Bcfg2.Server.Statistics.stats.display()
 
+    @exposed
+    def get_histograms(self, _, window=0):
+        """ Get histograms of component execution times from
+        :attr:`Bcfg2.Server.Statistics.stats`, from which percentiles
+        can be computed with
+        :func:`Bcfg2.Server.Statistics.Histogram.percentile`.
+
+        :param window: Only include values from the last ``window``
+                       minutes (1, 5, or 15), or 0 to include all
+                       values.
+        :type window: int
+        :returns: dict - The histogram data as returned by
+                  :func:`Bcfg2.Server.Statistics.Statistics.histograms` """
+        return Bcfg2.Server.Statistics.stats.histograms(window)
+
+    def collect_metrics(self):
+        """ Collect performance data for export by
+        :class:`Bcfg2.Server.Metrics.MetricsServer`.  This includes
+        execution time percentiles from
+        :mod:`Bcfg2.Server.Statistics`, percentiles of the other
+        values it tracks, the number of entries bound
+        by each generator plugin, the sizes of the
+        :mod:`Bcfg2.Server.Cache` caches in this process, and the
+        state of the FAM event queue.
+
+        :returns: list of :class:`Bcfg2.Server.Metrics.MetricFamily`
+                  objects
+        """
+        timings = MetricFamily("bcfg2_server_call_seconds", "summary",
+                               "Execution time of server operations",
+                               unit="seconds")
+        samples = MetricFamily("bcfg2_server_samples", "summary",
+                               "Values sampled by server operations that "
+                               "are not times, such as queue depths and "
+                               "ratios")
+        binds = MetricFamily("bcfg2_server_generator_binds", "counter",
+                             "Number of entries bound by each generator")
+        for name, data in sorted(self.get_histograms(None).items()):
+            hist = Bcfg2.Server.Statistics.Histogram.from_data(data)
+            if data.get('unit', 'seconds') == 'seconds':
+                family = timings
+            else:
+                family = samples
+            labels = dict(name=name)
+            for quantile in [0.5, 0.9, 0.95, 0.99]:
+                family.add_sample(hist.percentile(quantile * 100),
+                                  labels=dict(name=name,
+                                              quantile=str(quantile)))
+            family.add_sample(hist.count, labels=labels, suffix="_count")
+            family.add_sample(hist.sum, labels=labels, suffix="_sum")
+            if ":Generator:" in name:
+                core, plugin = name.rsplit(":Generator:", 1)
+                binds.add_sample(hist.count, suffix="_total",
+                                 labels=dict(core=core, plugin=plugin))
+
+        caches = MetricFamily("bcfg2_server_cache_entries", "gauge",
+                              "Number of items in each cache")
+        for tags, size in sorted(Bcfg2.Server.Cache.sizes().items()):
+            caches.add_sample(size, labels=dict(cache=":".join(sorted(tags))))
+
+        fam_queue = MetricFamily("bcfg2_server_fam_queue_depth", "gauge",
+                                 "Number of FAM events waiting to be "
+                                 "handled")
+        fam_queue.add_sample(len(self.fam.events))
+        fam_events = MetricFamily("bcfg2_server_fam_events", "counter",
+                                  "Number of FAM events handled")
+        fam_events.add_sample(self.fam.dispatched, suffix="_total")
+        fam_coalesced = MetricFamily("bcfg2_server_fam_events_coalesced",
+                                     "counter",
+                                     "Number of FAM events dropped as "
+                                     "repeats of a pending event")
+        fam_coalesced.add_sample(self.fam.coalesced, suffix="_total")
+        registry = MetricFamily("bcfg2_server_plugin_registry_lookups",
+                                "counter",
+                                "Number of lookups of the plugins that "
+                                "implement an interface")
+        registry.add_sample(self.plugin_registry_hits, suffix="_total",
+                            labels=dict(result="hit"))
+        registry.add_sample(self.plugin_registry_misses, suffix="_total",
+                            labels=dict(result="miss"))
+        return [timings, samples, binds, caches, fam_queue, fam_events,
+                fam_coalesced, registry]
+
     @exposed
     def toggle_debug(self, address):
         """ Toggle debug status of the FAM and all plugins
@@ -1416,7 +1675,11 @@ class NetworkCore(Core):
         Bcfg2.Options.Option(
             cf=('server', 'group'), default=0, dest='daemon_gid',
             type=Bcfg2.Options.Types.groupname,
-            help="Group to run the server daemon as")]
+            help="Group to run the server daemon as"),
+        Bcfg2.Options.Option(
+            cf=('server', 'metrics_listen'), default=None,
+            help="[<host>]:<port> to serve OpenMetrics data on over "
+            "plain HTTP")]
 
     def __init__(self):
         Core.__init__(self)
@@ -1424,6 +1687,27 @@ class NetworkCore(Core):
         #: The CA that signed the server cert
         self.ca = Bcfg2.Options.setup.ca
 
+        #: The :class:`Bcfg2.Server.Metrics.MetricsServer` that serves
+        #: :func:`collect_metrics`, if ``metrics_listen`` is set.  The
+        #: socket is bound here, before privileges are dropped, but
+        #: requests are not served until :attr:`metrics_thread` is
+        #: started by :func:`Bcfg2.Server.Core.Core.run`.
+        self.metrics_server = None
+        if Bcfg2.Options.setup.metrics_listen:
+            try:
+                self.metrics_server = MetricsServer(
+                    parse_address(Bcfg2.Options.setup.metrics_listen), self)
+            except (ValueError, socket.error):
+                err = sys.exc_info()[1]
+                self.logger.error("Failed to start metrics listener on %s: "
+                                  "%s" % (Bcfg2.Options.setup.metrics_listen,
+                                          err))
+            else:
+                self.metrics_thread = threading.Thread(
+                    name="MetricsThread",
+                    target=self.metrics_server.serve_forever)
+                self.metrics_thread.daemon = True
+
         if self._database_available:
             db_settings = django.conf.settings.DATABASES['default']
             if (Bcfg2.Options.setup.daemon and
@@ -1482,6 +1766,13 @@ class NetworkCore(Core):
 
         Core.run(self)
 
+    def shutdown(self):
+        Core.shutdown(self)
+        if self.metrics_thread is not None and self.metrics_thread.is_alive():
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
+            self.logger.info("%s: Metrics listener shut down" % self.name)
+
     def authenticate(self, cert, user, password, address):
         """ Authenticate a client connection with
         :func:`Bcfg2.Server.Plugin.interfaces.Metadata.AuthenticateConnection`.
@@ -10,6 +10,13 @@ detected on that event.
 ``HandleEvent`` is called with a single argument, the
 :class:`Bcfg2.Server.FileMonitor.Event` object to be handled.
 
+Events are handled in batches.  Repeated events on the same file that
+arrive within a short window (see the ``fam_debounce`` option) are
+coalesced into one, and all events for one object are delivered
+together.  If the object has a ``HandleEvents`` method, it is called
+once with the list of events for that object; otherwise,
+``HandleEvent`` is called once for each event.
+
 Assumptions
 -----------
 
@@ -49,8 +56,10 @@ import os
 import sys
 import fnmatch
 import Bcfg2.Options
+from collections import deque
 from time import sleep, time
 from Bcfg2.Logger import Debuggable
+from Bcfg2.Server.Statistics import stats
 
 
 class Event(object):
@@ -116,12 +125,22 @@ class FileMonitor(Debuggable):
             help='File globs to ignore',
             type=Bcfg2.Options.Types.comma_list,
             default=['*~', '*#', '.#*', '*.swp', '*.swpx', '.*.swx',
-                     'SCCS', '.svn', '4913', '.gitignore'])]
+                     'SCCS', '.svn', '4913', '.gitignore']),
+        Bcfg2.Options.Option(
+            cf=('server', 'fam_debounce'),
+            help='Wait this many seconds for further events before '
+            'handling a set of FAM events',
+            type=Bcfg2.Options.Types.timeout, default=0.1)]
 
     #: The relative priority of this FAM backend.  Better backends
     #: should have higher priorities.
     __priority__ = -1
 
+    #: The longest time, in seconds, that :func:`handle_event_set`
+    #: will keep waiting for further events before it dispatches the
+    #: events it has already collected.
+    max_debounce = 5
+
     #: List of names of methods to be exposed as XML-RPC functions
     __rmi__ = Debuggable.__rmi__ + ["list_event_handlers"]
 
@@ -146,16 +165,35 @@ class FileMonitor(Debuggable):
         self.handles = dict()
 
         #: Queue of events to handle
-        self.events = []
+        self.events = deque()
 
         #: List of filename globs to ignore events for.  For events
         #: that include the full path, both the full path and the bare
         #: filename will be checked against ``ignore``.
         self.ignore = Bcfg2.Options.setup.ignore_files
 
+        #: How long, in seconds, to wait for further events before
+        #: handling a set of events, so that bursts of events (e.g.,
+        #: from a VCS update) can be coalesced.  If this is None,
+        #: events are handled as soon as they are received.
+        self.debounce = Bcfg2.Options.setup.fam_debounce
+
         #: Whether or not the FAM has been started.  See :func:`start`.
         self.started = False
 
+        #: Counter of events that have been dispatched to a handler.
+        #: This is incremented *after* the handler returns, so
+        #: consumers that derive data from handler state (e.g., the
+        #: generator dispatch index in
+        #: :func:`Bcfg2.Server.Core.Core.Bind`) can cheaply tell
+        #: whether that state may have changed since they last looked.
+        self.dispatched = 0
+
+        #: Counter of events that have been dropped because they
+        #: repeated an earlier, not yet handled event on the same
+        #: file.  See :func:`coalesce`.
+        self.coalesced = 0
+
     def __str__(self):
         return "%s: %s" % (__name__, self.__class__.__name__)
 
@@ -205,7 +243,7 @@ class FileMonitor(Debuggable):
 
         :returns: :class:`Bcfg2.Server.FileMonitor.Event`
         """
-        return self.events.pop(0)
+        return self.events.popleft()
 
     def fileno(self):
         """ Get the file descriptor of the file monitor thread.
@@ -216,10 +254,10 @@ class FileMonitor(Debuggable):
 
     def handle_one_event(self, event):
         """ Handle the given event by dispatching it to the object
-        that handles it.  This is only called by
-        :func:`handle_event_set`, so if a backend overrides that
-        method it does not necessarily need to implement this
-        function.
+        that handles it.  :func:`handle_event_set` dispatches events
+        in batches with :func:`handle_event_batch` instead, so if a
+        backend overrides that method it does not necessarily need to
+        implement this function.
 
         :param event: The event to handle.
         :type event: Bcfg2.Server.FileMonitor.Event
@@ -227,50 +265,170 @@ class FileMonitor(Debuggable):
         """
         if not self.started:
             self.start()
+        handler = self.get_handler(event)
+        if handler is not None:
+            self.handle_event_batch(handler, [event])
+
+    def get_handler(self, event):
+        """ Get the object that handles the given event.
+
+        :param event: The event to get the handler for
+        :type event: Bcfg2.Server.FileMonitor.Event
+        :returns: The handler object, or None if the event is ignored
+                  or was produced by an unknown monitor
+        """
         if self.should_ignore(event):
-            return
+            return None
         if event.requestID not in self.handles:
             self.logger.info("Got event for unexpected id %s, file %s" %
                              (event.requestID, event.filename))
+            return None
+        return self.handles[event.requestID]
+
+    def coalesce(self, events, event, last):
+        """ Add an event to a list of events to be handled, unless it
+        merely repeats an earlier event on the same file in that list.
+        An event repeats an earlier one if it has the same action, or
+        if it is a ``changed`` event that follows an ``exists`` or
+        ``created`` event: in either case, handling the earlier event
+        already reads the current contents of the file.
+
+        :param events: The list of events to add the event to
+        :type events: list of Bcfg2.Server.FileMonitor.Event
+        :param event: The event to add
+        :type event: Bcfg2.Server.FileMonitor.Event
+        :param last: A dict of (request ID, filename) => the index of
+                     the most recent event on that file in ``events``.
+                     This is updated if the event is added.
+        :type last: dict
+        :returns: bool - Whether or not the event was added
+        """
+        key = (event.requestID, event.filename)
+        if key in last:
+            prev = events[last[key]].code2str()
+            action = event.code2str()
+            if (action == prev or
+                    (action == 'changed' and prev in ['exists', 'created'])):
+                self.coalesced += 1
+                return False
+        last[key] = len(events)
+        events.append(event)
+        return True
+
+    def get_event_batches(self):
+        """ Collect all pending events, coalescing repeated events
+        with :func:`coalesce`, and group them by the object that
+        handles them.  If :attr:`debounce` is set, keep collecting
+        for as long as new events keep arriving within that many
+        seconds of each other, up to :attr:`max_debounce` seconds.
+
+        :returns: tuple of (<number of events received>, <list of
+                  (handler, list of events) tuples>).  Handlers are
+                  listed in the order in which their first event was
+                  received.
+        """
+        received = 0
+        batches = []
+        handlers = dict()
+        last = dict()
+        end = time() + self.max_debounce
+        while self.pending():
+            while self.pending():
+                event = self.get_event()
+                received += 1
+                handler = self.get_handler(event)
+                if handler is None:
+                    continue
+                if id(handler) not in handlers:
+                    handlers[id(handler)] = (handler, [])
+                    batches.append(handlers[id(handler)])
+                self.coalesce(handlers[id(handler)][1], event, last)
+            if self.debounce and time() < end:
+                sleep(self.debounce)
+        return (received, batches)
+
+    def handle_event_batch(self, handler, events):
+        """ Dispatch a list of events to the object that handles
+        them.  If the object has a ``HandleEvents`` method, it is
+        called once with the full list; otherwise, its
+        ``HandleEvent`` method is called once for each event.
+
+        :param handler: The object that handles the events
+        :type handler: Varies
+        :param events: The events to handle
+        :type events: list of Bcfg2.Server.FileMonitor.Event
+        :returns: None
+        """
+        if hasattr(handler, "HandleEvents"):
+            self.debug_log("Dispatching %d events to obj %s" %
+                           (len(events), handler))
+            try:
+                handler.HandleEvents(events)
+            except KeyboardInterrupt:
+                raise
+            except:  # pylint: disable=W0702
+                err = sys.exc_info()[1]
+                self.logger.error("Error in handling of events for %s: %s" %
+                                  (", ".join(e.filename for e in events),
+                                   err))
+            self.dispatched += len(events)
             return
-        self.debug_log("Dispatching event %s %s to obj %s" %
-                       (event.code2str(), event.filename,
-                        self.handles[event.requestID]))
-        try:
-            self.handles[event.requestID].HandleEvent(event)
-        except KeyboardInterrupt:
-            raise
-        except:  # pylint: disable=W0702
-            err = sys.exc_info()[1]
-            self.logger.error("Error in handling of event %s for %s: %s" %
-                              (event.code2str(), event.filename, err))
+        for event in events:
+            self.debug_log("Dispatching event %s %s to obj %s" %
+                           (event.code2str(), event.filename, handler))
+            try:
+                handler.HandleEvent(event)
+            except KeyboardInterrupt:
+                raise
+            except:  # pylint: disable=W0702
+                err = sys.exc_info()[1]
+                self.logger.error("Error in handling of event %s for %s: %s" %
+                                  (event.code2str(), event.filename, err))
+            self.dispatched += 1
 
     def handle_event_set(self, lock=None):
-        """ Handle all pending events.
-
-        :param lock: A thread lock to use while handling events.  If
-                     None, then no thread locking will be performed.
-                     This can possibly lead to race conditions in
-                     event handling, although it's unlikely to cause
-                     any real problems.
+        """ Handle all pending events.  Events are collected and
+        coalesced with :func:`get_event_batches`, and each batch is
+        dispatched with :func:`handle_event_batch`.  The number of
+        events received and the fraction of them that were coalesced
+        are recorded with :mod:`Bcfg2.Server.Statistics`.
+
+        :param lock: A thread lock to use while handling events.  It
+                     is acquired separately for each batch, so that
+                     other threads are not blocked for the whole
+                     event set.  If None, then no thread locking will
+                     be performed.  This can possibly lead to race
+                     conditions in event handling, although it's
+                     unlikely to cause any real problems.
         :type lock: threading.Lock
         :returns: None
         """
         if not self.started:
             self.start()
         count = 0
+        handled = 0
+        coalesced = self.coalesced
         start = time()
-        if lock:
-            lock.acquire()
         while self.pending():
-            self.handle_one_event(self.get_event())
-            count += 1
-        if lock:
-            lock.release()
+            received, batches = self.get_event_batches()
+            count += received
+            for handler, events in batches:
+                if lock:
+                    lock.acquire()
+                try:
+                    self.handle_event_batch(handler, events)
+                finally:
+                    if lock:
+                        lock.release()
+                handled += len(events)
         end = time()
         if count > 0:
-            self.logger.info("Handled %d events in %.03fs" % (count,
-                                                              (end - start)))
+            stats.add_value("FileMonitor:event_backlog", count, unit="")
+            stats.add_value("FileMonitor:coalesced_ratio",
+                            float(self.coalesced - coalesced) / count,
+                            unit="")
+            self.logger.info("Handled %d events (%d received) in %.03fs" %
+                             (handled, count, (end - start)))
 
     def handle_events_in_interval(self, interval):
         """ Handle events for the specified period of time (in
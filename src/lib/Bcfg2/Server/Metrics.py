@@ -0,0 +1,167 @@
+""" Export server performance data in the `OpenMetrics
+<https://openmetrics.io/>`_ text format over plain HTTP, so that it can
+be scraped by Prometheus and compatible monitoring systems.  This is
+much cheaper for a monitoring system than polling
+:func:`Bcfg2.Server.Core.Core.get_statistics` over XML-RPC.
+
+The listener is enabled with the ``metrics_listen`` option in the
+``[server]`` section of ``bcfg2.conf``, and is run by
+:class:`Bcfg2.Server.Core.NetworkCore`.  The data itself is collected
+by :func:`Bcfg2.Server.Core.Core.collect_metrics`. """
+
+import socket
+import logging
+from Bcfg2.Compat import BaseHTTPServer, SocketServer
+
+#: The HTTP content type of the OpenMetrics text format
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+
+def _escape(value):
+    """ Escape a label value or help string for the OpenMetrics text
+    format. """
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace(
+        '"', '\\"')
+
+
+def _format_value(value):
+    """ Format a sample value for the OpenMetrics text format. """
+    if isinstance(value, bool):
+        return str(int(value))
+    elif isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+class MetricFamily(object):
+    """ A named set of samples of a single metric type, rendered as
+    one metric family in the OpenMetrics text format. """
+
+    def __init__(self, name, mtype, helptext, unit=None):
+        """
+        :param name: The name of the metric family.  If ``unit`` is
+                     given, the name must end with it.
+        :type name: string
+        :param mtype: The OpenMetrics type of the metric family, e.g.,
+                      ``gauge``, ``counter``, or ``summary``
+        :type mtype: string
+        :param helptext: A description of the metric family
+        :type helptext: string
+        :param unit: The unit of the metric family, e.g., ``seconds``
+        :type unit: string
+        """
+        self.name = name
+        self.type = mtype
+        self.help = helptext
+        self.unit = unit
+
+        #: List of ``(<name suffix>, <labels dict>, <value>)`` tuples
+        self.samples = []
+
+    def add_sample(self, value, labels=None, suffix=""):
+        """ Add a sample to the metric family.
+
+        :param value: The value of the sample
+        :type value: int or float
+        :param labels: The labels of the sample
+        :type labels: dict
+        :param suffix: The suffix to append to the family name for
+                       this sample, e.g., ``_total`` for counters or
+                       ``_count`` and ``_sum`` for summaries
+        :type suffix: string
+        """
+        self.samples.append((suffix, labels or dict(), value))
+
+    def render(self):
+        """ Render the metric family in the OpenMetrics text format.
+
+        :returns: string
+        """
+        lines = ["# TYPE %s %s" % (self.name, self.type)]
+        if self.unit:
+            lines.append("# UNIT %s %s" % (self.name, self.unit))
+        lines.append("# HELP %s %s" % (self.name, _escape(self.help)))
+        for suffix, labels, value in self.samples:
+            if labels:
+                labelstr = "{%s}" % ",".join(
+                    '%s="%s"' % (key, _escape(val))
+                    for key, val in sorted(labels.items()))
+            else:
+                labelstr = ""
+            lines.append("%s%s%s %s" % (self.name, suffix, labelstr,
+                                        _format_value(value)))
+        return "\n".join(lines)
+
+
+def render(families):
+    """ Render a complete OpenMetrics exposition.
+
+    :param families: The metric families to render
+    :type families: list of :class:`MetricFamily` objects
+    :returns: string
+    """
+    return "".join(family.render() + "\n" for family in families) + "# EOF\n"
+
+
+class MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Serve the metrics collected by the server core on ``GET
+    /metrics``. """
+
+    def do_GET(self):  # pylint: disable=C0103
+        """ Handle a scrape request. """
+        if self.path.split("?")[0] not in ["/", "/metrics"]:
+            self.send_error(404)
+            return
+        try:
+            body = render(self.server.core.collect_metrics()).encode('utf-8')
+        except Exception as e:  # pylint: disable=W0703
+            self.server.logger.error("Failed to collect metrics", exc_info=e)
+            self.send_error(500)
+            return
+        self.send_response(200)
+        self.send_header("Content-type", CONTENT_TYPE)
+        self.send_header("Content-length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=W0622
+        self.server.logger.debug("%s: %s" % (self.address_string(),
+                                             format % args))
+
+
+class MetricsServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ Plain HTTP server that exposes the metrics collected by the
+    server core.  This offers no authentication or encryption, so it
+    should only listen on a trusted interface. """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, core):
+        """
+        :param address: The ``(<host>, <port>)`` pair to listen on
+        :type address: tuple
+        :param core: The server core to collect metrics from
+        :type core: Bcfg2.Server.Core.Core
+        """
+        if ':' in address[0]:
+            self.address_family = socket.AF_INET6
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.core = core
+        BaseHTTPServer.HTTPServer.__init__(self, address,
+                                           MetricsRequestHandler)
+
+
+def parse_address(value):
+    """ Parse a ``[<host>]:<port>`` listen address.  If the host is
+    omitted, ``localhost`` is used.
+
+    :param value: The address to parse
+    :type value: string
+    :returns: tuple of ``(<host>, <port>)``
+    """
+    if ':' in value:
+        host, port = value.rsplit(':', 1)
+    else:
+        host, port = '', value
+    host = host.strip('[]') or 'localhost'
+    return (host, int(port))
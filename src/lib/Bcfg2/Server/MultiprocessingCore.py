@@ -3,97 +3,161 @@
 :mod:`multiprocessing` library to offload work to multiple child
 processes.  As such, it requires Python 2.6+.
 
-The parent communicates with the children over
-:class:`multiprocessing.Queue` objects via a
+The parent communicates with the children over long-lived
+:func:`multiprocessing.Pipe` objects via a
 :class:`Bcfg2.Server.MultiprocessingCore.RPCQueue` object.
 
 A method being called via the RPCQueue must be exposed by the child by
 decorating it with :func:`Bcfg2.Server.Core.exposed`.
 """
 
+import os
+import sys
 import time
+import shutil
+import tempfile
 import threading
 import lxml.etree
 import multiprocessing
 import Bcfg2.Options
 import Bcfg2.Server.Cache
 import Bcfg2.Server.Plugin
-from itertools import cycle
-from Bcfg2.Compat import Queue, Empty, wraps
+import Bcfg2.Server.Statistics
+from itertools import count, cycle
+from Bcfg2.Compat import wraps
 from Bcfg2.Server.Core import Core, exposed
 from Bcfg2.Server.BuiltinCore import BuiltinCore
-from multiprocessing.connection import Listener, Client
+from Bcfg2.Server.Metrics import MetricFamily
 
 
-class RPCQueue(Bcfg2.Server.Plugin.Debuggable):
-    """ An implementation of a :class:`multiprocessing.Queue` designed
-    for several additional use patterns:
+class RPCError(Exception):
+    """ Raised when an RPC call to a child process fails. """
+    pass
 
-    * Random-access reads, based on a key that identifies the data;
-    * Publish-subscribe, where a datum is sent to all hosts.
 
-    The subscribers can deal with this as a normal Queue with no
-    special handling.
+class RPCQueue(Bcfg2.Server.Plugin.Debuggable):
+    """ An RPC channel to a set of subscribers, built on one
+    long-lived duplex :func:`multiprocessing.Pipe` per subscriber,
+    designed for several use patterns:
+
+    * Random-access calls, where a call is made to a single named
+      subscriber and the caller waits for the response;
+    * Publish-subscribe, where a call is sent to all subscribers and
+      no response is expected.
+
+    Each call is tagged with a request ID, and the response carries
+    the same ID, so any number of calls may be in flight on a single
+    pipe at once.  A thread per subscriber reads responses and hands
+    them to the waiting callers.
+
+    Subscribers receive ``(<request ID>, (<method>, <args>,
+    <kwargs>))`` tuples from their end of the pipe, and must respond
+    to each call whose request ID is not None by sending
+    ``(<request ID>, <success>, <return value or error message>)``.
     """
     poll_wait = 3.0
 
     def __init__(self):
         Bcfg2.Server.Plugin.Debuggable.__init__(self)
         self._terminate = threading.Event()
-        self._queues = dict()
-        self._listeners = []
+
+        #: A dict of subscriber name -> parent end of the pipe to that
+        #: subscriber
+        self._pipes = dict()
+
+        #: A dict of subscriber name -> lock held while sending on the
+        #: pipe to that subscriber
+        self._send_locks = dict()
+
+        #: A dict of request ID -> ``[<threading.Event>, <response>]``
+        #: for calls that are awaiting a response
+        self._pending = dict()
+        self._pending_lock = threading.Lock()
+        self._request_ids = count()
+        self._readers = []
 
     def add_subscriber(self, name):
         """ Add a subscriber to the queue.  This returns the
-        :class:`multiprocessing.Queue` object that the subscriber
-        should read from.  """
-        self._queues[name] = multiprocessing.Queue()
-        return self._queues[name]
+        subscriber's end of the :class:`multiprocessing.Pipe` that it
+        should read calls from and write responses to. """
+        parent_end, child_end = multiprocessing.Pipe()
+        self._pipes[name] = parent_end
+        self._send_locks[name] = threading.Lock()
+        reader = threading.Thread(name="RPCReader-%s" % name,
+                                  target=self._read_responses,
+                                  args=[name, parent_end])
+        reader.start()
+        self._readers.append(reader)
+        return child_end
+
+    def _send(self, dest, reqid, method, args, kwargs):
+        """ Send a call to the named subscriber. """
+        with self._send_locks[dest]:
+            self._pipes[dest].send((reqid, (method, args or [],
+                                            kwargs or dict())))
+
+    def _read_responses(self, name, pipe):
+        """ Read responses from the named subscriber and pass them to
+        the callers waiting on them. """
+        while not self._terminate.is_set():
+            try:
+                if not pipe.poll(self.poll_wait):
+                    continue
+                reqid, success, rv = pipe.recv()
+            except (EOFError, IOError, OSError):
+                if not self._terminate.is_set():
+                    self.logger.error("Lost RPC connection to %s" % name)
+                break
+            with self._pending_lock:
+                pending = self._pending.get(reqid)
+            if pending is None:
+                self.logger.warning("Discarding response to unknown RPC "
+                                    "request %s from %s" % (reqid, name))
+                continue
+            pending[1] = (success, rv)
+            pending[0].set()
 
     def publish(self, method, args=None, kwargs=None):
         """ Publish an RPC call to the queue for consumption by all
         subscribers. """
-        for queue in list(self._queues.values()):
-            queue.put((None, (method, args or [], kwargs or dict())))
+        for name in list(self._pipes.keys()):
+            self._send(name, None, method, args, kwargs)
 
     def rpc(self, dest, method, args=None, kwargs=None):
         """ Make an RPC call to the named subscriber, expecting a
-        response.  This opens a
-        :class:`multiprocessing.connection.Listener` and passes the
-        Listener address to the child as part of the RPC call, so that
-        the child can connect to the Listener to submit its results.
+        response.  This blocks until the response is received, or
+        until the queue is closed, in which case None is returned.
+
+        :raises: :exc:`Bcfg2.Server.MultiprocessingCore.RPCError` if
+                 the call failed in the subscriber
         """
-        listener = Listener()
-        self.logger.debug("Created new RPC listener at %s" % listener.address)
-        self._listeners.append(listener)
+        with self._pending_lock:
+            reqid = next(self._request_ids)
+            pending = self._pending[reqid] = [threading.Event(), None]
         try:
-            self._queues[dest].put((listener.address,
-                                    (method, args or [], kwargs or dict())))
-            conn = listener.accept()
-            try:
-                while not self._terminate.is_set():
-                    if conn.poll(self.poll_wait):
-                        return conn.recv()
-            finally:
-                conn.close()
+            self.logger.debug("Sending RPC request %s to %s: %s" %
+                              (reqid, dest, method))
+            self._send(dest, reqid, method, args, kwargs)
+            while not self._terminate.is_set():
+                if pending[0].wait(self.poll_wait):
+                    success, rv = pending[1]
+                    if not success:
+                        raise RPCError("%s: %s failed: %s" % (dest, method,
+                                                              rv))
+                    return rv
         finally:
-            listener.close()
-            self._listeners.remove(listener)
+            with self._pending_lock:
+                del self._pending[reqid]
 
     def close(self):
-        """ Close queues and connections. """
+        """ Close pipes to all subscribers. """
         self._terminate.set()
-        self.logger.debug("Closing RPC queues")
-        for name, queue in list(self._queues.items()):
-            self.logger.debug("Closing RPC queue to %s" % name)
-            queue.close()
-
-        # close any listeners that are waiting for connections
         self.logger.debug("Closing RPC connections")
-        for listener in self._listeners:
-            self.logger.debug("Closing RPC connection at %s" %
-                              listener.address)
-            listener.close()
+        for reader in self._readers:
+            reader.join()
+        for name, pipe in list(self._pipes.items()):
+            self.logger.debug("Closing RPC connection to %s" % name)
+            pipe.close()
 
 
 class DualEvent(object):
@@ -135,7 +199,7 @@ class DualEvent(object):
 class ChildCore(Core):
     """ A child process for :class:`Bcfg2.MultiprocessingCore.Core`.
     This core builds configurations from a given
-    :class:`multiprocessing.Pipe`.  Note that this is a full-fledged
+    :func:`multiprocessing.Pipe`.  Note that this is a full-fledged
     server core; the only input it gets from the parent process is the
     hostnames of clients to render.  All other state comes from the
     FAM. However, this core only is used to render configs; it doesn't
@@ -151,16 +215,13 @@ class ChildCore(Core):
     #: every ``poll_wait`` seconds.
     poll_wait = 3.0
 
-    def __init__(self, name, rpc_q, terminate):
+    def __init__(self, name, rpc_pipe, terminate):
         """
         :param name: The name of this child
         :type name: string
-        :param read_q: The queue the child will read from for RPC
-                       communications from the parent process.
-        :type read_q: multiprocessing.Queue
-        :param write_q: The queue the child will write the results of
-                        RPC calls to.
-        :type write_q: multiprocessing.Queue
+        :param rpc_pipe: The pipe the child will read RPC calls from
+                         and write their results to.
+        :type rpc_pipe: multiprocessing.connection.Connection
         :param terminate: An event that flags ChildCore objects to shut
                           themselves down.
         :type terminate: multiprocessing.Event
@@ -174,8 +235,12 @@ class ChildCore(Core):
         #: to determine when this child should shut down.
         self.terminate = terminate
 
-        #: The queue used for RPC communication
-        self.rpc_q = rpc_q
+        #: The pipe used for RPC communication
+        self.rpc_pipe = rpc_pipe
+
+        #: Lock held while writing results to :attr:`rpc_pipe`, since
+        #: several RPC calls may be handled at once
+        self._send_lock = threading.Lock()
 
         # override this setting so that the child doesn't try to write
         # the pidfile
@@ -189,16 +254,15 @@ class ChildCore(Core):
     def _run(self):
         return True
 
-    def _dispatch(self, address, data):
+    def _save_snapshot(self):
+        # the parent process saves the snapshot; all children have
+        # parsed the same data, so there is no need for each of them
+        # to write it as well
+        pass
+
+    def _dispatch(self, reqid, data):
         """ Method dispatcher used for commands received from
-        the RPC queue. """
-        if address is not None:
-            # if the key is None, then no response is expected.  we
-            # make the return connection before dispatching the actual
-            # RPC call so that the parent is blocking for a connection
-            # as briefly as possible
-            self.logger.debug("Connecting to parent via %s" % address)
-            client = Client(address)
+        the RPC pipe. """
         method, args, kwargs = data
         func = None
         rv = None
@@ -217,35 +281,49 @@ class ChildCore(Core):
                 self.logger.error("%s: Method %s is not exposed" % (self.name,
                                                                     method))
                 func = None
+        success = True
         if func is not None:
             self.logger.debug("%s: Calling RPC method %s" % (self.name,
                                                              method))
-            rv = func(*args, **kwargs)
-        if address is not None:
-            # if the key is None, then no response is expected
-            self.logger.debug("Returning data to parent via %s" % address)
-            client.send(rv)
+            try:
+                rv = func(*args, **kwargs)
+            except Exception:  # pylint: disable=W0703
+                err = sys.exc_info()[1]
+                self.logger.error("%s: RPC method %s failed: %s" %
+                                  (self.name, method, err), exc_info=1)
+                success = False
+                rv = str(err)
+        if reqid is not None:
+            # if the request ID is None, then no response is expected
+            self.logger.debug("%s: Returning data for RPC request %s" %
+                              (self.name, reqid))
+            with self._send_lock:
+                self.rpc_pipe.send((reqid, success, rv))
 
     def _block(self):
         self._rmi = self._get_rmi()
         while not self.terminate.is_set():
             try:
-                address, data = self.rpc_q.get(timeout=self.poll_wait)
+                if not self.rpc_pipe.poll(self.poll_wait):
+                    continue
+                reqid, data = self.rpc_pipe.recv()
                 threadname = "-".join(str(i) for i in data)
                 rpc_thread = threading.Thread(name=threadname,
                                               target=self._dispatch,
-                                              args=[address, data])
+                                              args=[reqid, data])
                 rpc_thread.start()
-            except Empty:
-                pass
+            except (EOFError, IOError, OSError):
+                self.logger.error("%s: Lost RPC connection to parent" %
+                                  self.name)
+                break
             except KeyboardInterrupt:
                 break
         self.shutdown()
 
     def shutdown(self):
         Core.shutdown(self)
-        self.logger.info("%s: Closing RPC command queue" % self.name)
-        self.rpc_q.close()
+        self.logger.info("%s: Closing RPC command pipe" % self.name)
+        self.rpc_pipe.close()
 
         while len(threading.enumerate()) > 1:
             threads = [t for t in threading.enumerate()
@@ -294,7 +372,16 @@ class MultiprocessingCore(BuiltinCore):
             '--children', dest="core_children",
             cf=('server', 'children'), type=int,
             default=multiprocessing.cpu_count(),
-            help='Spawn this number of children for the multiprocessing core')]
+            help='Spawn this number of children for the multiprocessing core'),
+        Bcfg2.Options.BooleanOption(
+            '--child-affinity', cf=('server', 'child_affinity'),
+            default=False,
+            help='Build configurations for a client on the same child '
+            'whenever that child is not busier than the others'),
+        Bcfg2.Options.BooleanOption(
+            '--shared-cache', cf=('caching', 'shared'), default=False,
+            help='Share expensive cached data, such as Packages '
+            'dependency resolution, between children')]
 
     #: How long to wait for a child process to shut down cleanly
     #: before it is terminated.
@@ -303,21 +390,6 @@ class MultiprocessingCore(BuiltinCore):
     def __init__(self):
         BuiltinCore.__init__(self)
 
-        #: A dict of child name -> one end of the
-        #: :class:`multiprocessing.Pipe` object used to communicate
-        #: with that child.  (The child is given the other end of the
-        #: Pipe.)
-        self.pipes = dict()
-
-        #: A queue that keeps track of which children are available to
-        #: render a configuration.  A child is popped from the queue
-        #: when it starts to render a config, then it's pushed back on
-        #: when it's done.  This lets us use a blocking call to
-        #: :func:`Queue.Queue.get` when waiting for an available
-        #: child.
-        self.available_children = \
-            Queue(maxsize=Bcfg2.Options.setup.core_children)
-
         #: The flag that indicates when to stop child threads and
         #: processes
         self.terminate = DualEvent(threading_event=self.terminate)
@@ -329,10 +401,28 @@ class MultiprocessingCore(BuiltinCore):
         #: A list of children that will be cycled through
         self._all_children = []
 
-        #: An iterator that each child will be taken from in sequence,
-        #: to provide a round-robin distribution of render requests
+        #: An iterator that each child will be taken from in sequence.
+        #: Render requests go to the child with the fewest requests in
+        #: flight; this is used to break ties between children that
+        #: are equally busy, so that they are used round-robin.
         self.children = None
 
+        #: A dict of child name -> number of :func:`GetConfig` calls
+        #: that child is currently handling
+        self.in_flight = dict()
+
+        #: Lock held while modifying :attr:`in_flight`
+        self._in_flight_lock = threading.Lock()
+
+        #: The directory that data shared between children is cached
+        #: in, if ``[caching] shared`` is enabled
+        self.shared_cache_dir = None
+
+        #: A dict of client name -> name of the child that last built
+        #: its configuration.  This is only used if ``child_affinity``
+        #: is enabled.
+        self._affinity = dict()
+
     def __str__(self):
         if hasattr(Bcfg2.Options.setup, "server"):
             return "%s(%s; %s children)" % (self.__class__.__name__,
@@ -343,17 +433,30 @@ class MultiprocessingCore(BuiltinCore):
                                         len(self._all_children))
 
     def _run(self):
+        if Bcfg2.Options.setup.shared_cache:
+            # use a memory-backed filesystem for the shared cache if
+            # one is available
+            if os.path.isdir("/dev/shm"):
+                tmpdir = "/dev/shm"
+            else:
+                tmpdir = None
+            self.shared_cache_dir = tempfile.mkdtemp(prefix="bcfg2-cache-",
+                                                     dir=tmpdir)
+            self.logger.debug("Sharing cached data between children in %s" %
+                              self.shared_cache_dir)
+            Bcfg2.Server.Cache.set_shared_store(self.shared_cache_dir)
         for cnum in range(Bcfg2.Options.setup.core_children):
             name = "Child-%s" % cnum
 
             self.logger.debug("Starting child %s" % name)
-            child_q = self.rpc_q.add_subscriber(name)
-            childcore = ChildCore(name, child_q, self.terminate)
+            child_pipe = self.rpc_q.add_subscriber(name)
+            childcore = ChildCore(name, child_pipe, self.terminate)
             child = multiprocessing.Process(target=childcore.run, name=name)
             child.start()
             self.logger.debug("Child %s started with PID %s" % (name,
                                                                 child.pid))
             self._all_children.append(name)
+            self.in_flight[name] = 0
         self.logger.debug("Started %s children: %s" % (len(self._all_children),
                                                        self._all_children))
         self.children = cycle(self._all_children)
@@ -384,6 +487,10 @@ class MultiprocessingCore(BuiltinCore):
         timer.cancel()
         self.logger.info("All children shut down")
 
+        if self.shared_cache_dir:
+            Bcfg2.Server.Cache.set_shared_store(None)
+            shutil.rmtree(self.shared_cache_dir, ignore_errors=True)
+
         while len(threading.enumerate()) > 1:
             threads = [t for t in threading.enumerate()
                        if t != threading.current_thread()]
@@ -436,48 +543,113 @@ class MultiprocessingCore(BuiltinCore):
         """ Publish cache expiration events to child nodes. """
         self.rpc_q.publish("expire_cache", args=tags, kwargs=dict(exact=exact))
 
+    def _select_child(self, client):
+        """ Select the child to build a configuration on.  This is the
+        child with the fewest :func:`GetConfig` calls in flight, so
+        that a single slow client does not hold up every request that
+        happens to be queued behind it.  If ``child_affinity`` is
+        enabled, the child that built the last configuration for the
+        client is preferred as long as it is no busier than the
+        others, so that its caches stay warm.  This must be called
+        with :attr:`_in_flight_lock` held.
+
+        :param client: The name of the client to build a configuration
+                       for
+        :type client: string
+        :returns: string - the name of the child
+        """
+        first = self._all_children.index(next(self.children))
+        children = self._all_children[first:] + self._all_children[:first]
+        childname = min(children, key=lambda c: self.in_flight[c])
+        if Bcfg2.Options.setup.child_affinity:
+            last = self._affinity.get(client)
+            if (last is not None and
+                    self.in_flight[last] <= self.in_flight[childname]):
+                childname = last
+            self._affinity[client] = childname
+        return childname
+
     @exposed
     def GetConfig(self, address):
         client = self.resolve_client(address)[0]
-        childname = next(self.children)
-        self.logger.debug("Building configuration for %s on %s" % (client,
-                                                                   childname))
-        return self.rpc_q.rpc(childname, "GetConfig", args=[client])
+        with self._in_flight_lock:
+            childname = self._select_child(client)
+            self.in_flight[childname] += 1
+            depth = self.in_flight[childname]
+        self.logger.debug("Building configuration for %s on %s (%s in flight)"
+                          % (client, childname, depth))
+        Bcfg2.Server.Statistics.stats.add_value(
+            "%s:in_flight:%s" % (self.__class__.__name__, childname), depth,
+            unit="")
+        try:
+            return self.rpc_q.rpc(childname, "GetConfig", args=[client])
+        finally:
+            with self._in_flight_lock:
+                self.in_flight[childname] -= 1
+
+    def collect_metrics(self):
+        families = BuiltinCore.collect_metrics(self)
+        children = MetricFamily("bcfg2_server_children", "gauge",
+                                "Number of busy and idle child processes")
+        busy = len([n for n in list(self.in_flight.values()) if n])
+        children.add_sample(busy, labels=dict(state="busy"))
+        children.add_sample(len(self._all_children) - busy,
+                            labels=dict(state="idle"))
+        requests = MetricFamily("bcfg2_server_child_requests", "gauge",
+                                "Number of configurations each child "
+                                "process is currently building")
+        for childname, count in sorted(self.in_flight.items()):
+            requests.add_sample(count, labels=dict(child=childname))
+        return families + [children, requests]
 
     @exposed
-    def get_statistics(self, address):
-        stats = dict()
-
-        def _aggregate_statistics(newstats, prefix=None):
-            """ Aggregate a set of statistics from a child or parent
-            server core.  This adds the statistics to the overall
-            statistics dict (optionally prepending a prefix, such as
-            "Child-1", to uniquely identify this set of statistics),
-            and aggregates it with the set of running totals that are
-            kept from all cores. """
-            for statname, vals in list(newstats.items()):
+    def get_histograms(self, address, window=0):
+        histograms = dict()
+        totals = dict()
+        units = dict()
+
+        def _aggregate_histograms(newdata, prefix=None):
+            """ Aggregate a set of histograms from a child or parent
+            server core.  This adds the histograms to the overall
+            histograms dict (optionally prepending a prefix, such as
+            "Child-1", to uniquely identify this set of histograms),
+            and merges it into the running totals that are kept from
+            all cores. """
+            for statname, data in list(newdata.items()):
                 if statname.startswith("ChildCore:"):
                     statname = statname[5:]
                 if prefix:
                     prettyname = "%s:%s" % (prefix, statname)
                 else:
                     prettyname = statname
-                stats[prettyname] = vals
+                histograms[prettyname] = data
                 totalname = "Total:%s" % statname
-                if totalname not in stats:
-                    stats[totalname] = vals
+                units[totalname] = data.get('unit', 'seconds')
+                hist = Bcfg2.Server.Statistics.Histogram.from_data(data)
+                if totalname not in totals:
+                    totals[totalname] = hist
                 else:
-                    newmin = min(stats[totalname][0], vals[0])
-                    newmax = max(stats[totalname][1], vals[1])
-                    newcount = stats[totalname][3] + vals[3]
-                    newmean = ((stats[totalname][2] * stats[totalname][3]) +
-                               (vals[2] * vals[3])) / newcount
-                    stats[totalname] = (newmin, newmax, newmean, newcount)
+                    totals[totalname].merge(hist)
 
-        stats = dict()
         for childname in self._all_children:
-            _aggregate_statistics(
-                self.rpc_q.rpc(childname, "get_statistics", args=[address]),
+            _aggregate_histograms(
+                self.rpc_q.rpc(childname, "get_histograms",
+                               args=[address, window]),
                 prefix=childname)
-        _aggregate_statistics(BuiltinCore.get_statistics(self, address))
+        _aggregate_histograms(BuiltinCore.get_histograms(self, address,
+                                                         window))
+        for totalname, hist in totals.items():
+            histograms[totalname] = hist.get_data()
+            histograms[totalname]['unit'] = units[totalname]
+        return histograms
+
+    @exposed
+    def get_statistics(self, address):
+        # the histograms carry the exact min, max, sum, and count of
+        # each statistic, so the totals across all cores are computed
+        # by merging histograms rather than by averaging averages.
+        stats = dict()
+        for statname, data in list(self.get_histograms(address).items()):
+            stats[statname] = (data['min'], data['max'],
+                               data['sum'] / data['count'], data['count'])
         return stats
@@ -11,6 +11,7 @@ import operator
 import lxml.etree
 import Bcfg2.Server
 import Bcfg2.Options
+import Bcfg2.Server.Snapshot
 import Bcfg2.Server.FileMonitor
 from Bcfg2.Logger import Debuggable
 from Bcfg2.Compat import CmpMixin, MutableMapping, wraps
@@ -571,6 +572,12 @@ class XMLFileBacked(FileBacked):
         #: XInclude.
         self.extra_monitors = []
 
+        #: The signatures of this file and of the files and
+        #: directories it includes, taken before they were read, for
+        #: :func:`Bcfg2.Server.Snapshot.store`.  Only collected if
+        #: the snapshot is enabled.
+        self.signatures = dict()
+
         if ((create is not None or self.create not in [None, False]) and
                 not os.path.exists(self.name)):
             toptag = create or self.create
@@ -587,6 +594,19 @@ class XMLFileBacked(FileBacked):
         if should_monitor:
             self.fam.AddMonitor(filename, self)
 
+    def HandleEvent(self, event=None):
+        self.signatures = dict()
+        self._sign(self.name)
+        FileBacked.HandleEvent(self, event)
+    HandleEvent.__doc__ = FileBacked.HandleEvent.__doc__
+
+    def _sign(self, path):
+        """ Record the signature of a file in :attr:`signatures` if
+        it has not been recorded yet.  This must be called before the
+        file is read. """
+        if Bcfg2.Server.Snapshot.enabled() and path not in self.signatures:
+            self.signatures[path] = Bcfg2.Server.Snapshot.signature(path)
+
     def _follow_xincludes(self, fname=None, xdata=None):
         """ follow xincludes, adding included files to self.extras """
         xinclude = '%sinclude' % Bcfg2.Server.XI_NAMESPACE
@@ -604,7 +624,11 @@ class XMLFileBacked(FileBacked):
                 rel = fname or self.name
                 fpath = os.path.join(os.path.dirname(rel), name)
 
-            # expand globs in xinclude, a bcfg2-specific extension
+            # expand globs in xinclude, a bcfg2-specific extension.
+            # the directory is signed so that new files matching the
+            # glob invalidate the snapshot
+            self._sign(os.path.dirname(fpath))
+            self._sign(fpath)
             extras = glob.glob(fpath)
             if not extras:
                 msg = "%s: %s does not exist, skipping" % (self.name, name)
@@ -626,22 +650,60 @@ class XMLFileBacked(FileBacked):
                     lxml.etree.SubElement(parent, xinclude, href=extra)
                     if extra not in self.extras:
                         self.extras.append(extra)
+                        self._sign(extra)
                         self._follow_xincludes(fname=extra)
                         if extra not in self.extra_monitors:
                             self.add_monitor(extra)
 
-    def Index(self):
-        self.xdata = lxml.etree.XML(self.data, base_url=self.name,
+    def _load_snapshot(self):
+        """ Load the XIncluded data for this file from
+        :mod:`Bcfg2.Server.Snapshot`, if neither this file nor any of
+        the files it includes have changed since the snapshot was
+        taken.
+
+        :returns: bool - Whether or not the data was loaded
+        """
+        snapshot = Bcfg2.Server.Snapshot.get(("XMLFileBacked", self.name))
+        if snapshot is None:
+            return False
+        data, extras, monitors = snapshot
+        self.xdata = lxml.etree.XML(data, base_url=self.name,
                                     parser=Bcfg2.Server.XMLParser)
-        self.extras = []
-        self._follow_xincludes()
-        if self.extras:
-            try:
-                self.xdata.getroottree().xinclude()
-            except lxml.etree.XIncludeError:
-                err = sys.exc_info()[1]
-                self.logger.error("XInclude failed on %s: %s" % (self.name,
-                                                                 err))
+        self.extras = list(extras)
+        for fpath in monitors:
+            if fpath not in self.extra_monitors:
+                self.add_monitor(fpath)
+        return True
+
+    def _store_snapshot(self):
+        """ Store the XIncluded data for this file in
+        :mod:`Bcfg2.Server.Snapshot`.  Only files that include other
+        files are stored, since reading the snapshot is no faster than
+        parsing a single file. """
+        if self.name not in self.signatures:
+            # the file was not read by HandleEvent, so it may have
+            # changed before the signatures were taken
+            return
+        Bcfg2.Server.Snapshot.store(
+            ("XMLFileBacked", self.name), self.signatures,
+            (lxml.etree.tostring(self.xdata), list(self.extras),
+             list(self.extra_monitors)))
+
+    def Index(self):
+        if not self._load_snapshot():
+            self.xdata = lxml.etree.XML(self.data, base_url=self.name,
+                                        parser=Bcfg2.Server.XMLParser)
+            self.extras = []
+            self._follow_xincludes()
+            if self.extras:
+                try:
+                    self.xdata.getroottree().xinclude()
+                    if Bcfg2.Server.Snapshot.enabled():
+                        self._store_snapshot()
+                except lxml.etree.XIncludeError:
+                    err = sys.exc_info()[1]
+                    self.logger.error("XInclude failed on %s: %s" %
+                                      (self.name, err))
 
         self.entries = self.xdata.getchildren()
         if self.__identifier__ is not None:
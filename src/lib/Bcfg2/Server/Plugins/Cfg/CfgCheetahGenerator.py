@@ -38,6 +38,9 @@ class CfgCheetahGenerator(CfgGenerator):
     #: .crypt.cheetah files
     __priority__ = 50
 
+    #: Rendered templates can be cached
+    cacheable = True
+
     #: :class:`Cheetah.Template.Template` compiler settings
     settings = dict(useStackFrames=False)
 
@@ -33,6 +33,9 @@ class CfgEncryptedGenshiGenerator(CfgGenshiGenerator):
     #: Override low priority from parent class
     __priority__ = 0
 
+    #: Don't keep decrypted data in the rendered template cache
+    cacheable = False
+
     #: Use a TemplateLoader class that decrypts the data on the fly
     #: when it's read in
     __loader_cls__ = EncryptedTemplateLoader
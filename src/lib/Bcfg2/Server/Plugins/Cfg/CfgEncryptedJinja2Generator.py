@@ -16,6 +16,9 @@ class CfgEncryptedJinja2Generator(CfgJinja2Generator, CfgEncryptedGenerator):
     #: Override low priority from parent class
     __priority__ = 0
 
+    #: Don't keep decrypted data in the rendered template cache
+    cacheable = False
+
     def handle_event(self, event):
         CfgEncryptedGenerator.handle_event(self, event)
     handle_event.__doc__ = CfgEncryptedGenerator.handle_event.__doc__
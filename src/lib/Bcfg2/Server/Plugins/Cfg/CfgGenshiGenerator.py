@@ -77,6 +77,9 @@ class CfgGenshiGenerator(CfgGenerator):
     #: .crypt.genshi files
     __priority__ = 50
 
+    #: Rendered templates can be cached
+    cacheable = True
+
     #: Error-handling in Genshi is pretty obtuse.  This regex is used
     #: to extract the first line of the code block that raised an
     #: exception in a Genshi template so we can provide a decent error
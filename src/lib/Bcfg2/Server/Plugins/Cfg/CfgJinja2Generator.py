@@ -61,6 +61,9 @@ class CfgJinja2Generator(CfgGenerator):
     #: .crypt.jinja2 files
     __priority__ = 50
 
+    #: Rendered templates can be cached
+    cacheable = True
+
     def __init__(self, fname, spec):
         CfgGenerator.__init__(self, fname, spec)
         if not HAS_JINJA2:
@@ -4,13 +4,21 @@ import re
 import os
 import sys
 import errno
+import inspect
+import logging
+import weakref
 import operator
 import lxml.etree
+from hashlib import sha256
 import Bcfg2.Options
+import Bcfg2.Server.Cache
 import Bcfg2.Server.Plugin
+import Bcfg2.Server.Snapshot
+from Bcfg2.Server.Cache import Cache
 from Bcfg2.Server.Plugin import PluginExecutionError
+from Bcfg2.Server.Plugins.TemplateHelper import HelperModule
 # pylint: disable=W0622
-from Bcfg2.Compat import u_str, str, b64encode, any, walk_packages
+from Bcfg2.Compat import u_str, str, b64encode, any, walk_packages, Mapping
 # pylint: enable=W0622
 
 try:
@@ -24,6 +32,18 @@ _handlers = [m[1]  # pylint: disable=C0103
 
 _CFG = None
 
+#: Memo of :func:`get_metadata_fingerprint` results for each client
+#: metadata object, so that the fingerprint is only calculated once
+#: per client run, no matter how many templates are rendered
+_FINGERPRINTS = weakref.WeakKeyDictionary()  # pylint: disable=C0103
+
+#: Names of Connector plugins whose data has been found to be
+#: impossible to fingerprint, so that disabling the template cache
+#: for them is only logged once
+_UNFINGERPRINTABLE = set()  # pylint: disable=C0103
+
+LOGGER = logging.getLogger(__name__)
+
 
 def get_cfg():
     """ Get the :class:`Bcfg2.Server.Plugins.Cfg.Cfg` plugin object
@@ -35,6 +55,91 @@ def get_cfg():
     return _CFG
 
 
+def _fingerprint_data(data):
+    """ Get a canonical representation of a piece of Connector data
+    for :func:`get_metadata_fingerprint`.  Mappings (including
+    :class:`Bcfg2.Server.Plugin.helpers.CallableDict` objects, such as
+    the data from Packages) are represented by their resolved values;
+    TemplateHelper modules by their filename and file signature; and
+    methods of plugin objects by the plugin and method name.
+
+    :raises: TypeError if the data is of a type whose contents cannot
+             be represented (e.g., a function)
+    """
+    if data is None or isinstance(data, (str, bytes, int, float)):
+        return data
+    elif isinstance(data, (lxml.etree._Element, lxml.etree._ElementTree)):
+        return lxml.etree.tostring(data)
+    elif isinstance(data, Bcfg2.Server.Plugin.FileBacked):
+        return (data.__class__.__name__, data.name, data.data)
+    elif isinstance(data, HelperModule):
+        return (data.__class__.__name__, data.name,
+                Bcfg2.Server.Snapshot.signature(data.name))
+    elif (inspect.ismethod(data) and
+          isinstance(data.__self__, Bcfg2.Server.Plugin.Plugin)):
+        return (data.__self__.name, data.__name__)
+    elif isinstance(data, Mapping):
+        return tuple(sorted((repr(k), _fingerprint_data(data[k]))
+                            for k in data))
+    elif isinstance(data, (list, tuple)):
+        return tuple(_fingerprint_data(v) for v in data)
+    elif isinstance(data, (set, frozenset)):
+        return tuple(sorted(repr(_fingerprint_data(v)) for v in data))
+    raise TypeError("Cannot fingerprint %s object" % data.__class__.__name__)
+
+
+def get_metadata_fingerprint(metadata):
+    """ Get a digest of all of the client metadata that a template
+    can reasonably use: groups, bundles, profile, categories, client
+    version, and the data from all Connector plugins (Probes,
+    Properties, etc.).  If ``[cfg] template_cache`` is ``client``, the
+    hostname, aliases, addresses, UUID, and password of the client
+    are included as well; if it is ``groups``, they are not, so that
+    clients with identical groups and Connector data share rendered
+    templates.
+
+    :param metadata: The client metadata to fingerprint
+    :type metadata: Bcfg2.Server.Plugins.Metadata.ClientMetadata
+    :returns: string, or None if the metadata contains Connector data
+              that cannot be fingerprinted
+    """
+    mode = Bcfg2.Options.setup.cfg_template_cache
+    try:
+        memo = _FINGERPRINTS[metadata]
+        if memo[0] == mode:
+            return memo[1]
+    except (KeyError, TypeError):
+        pass
+
+    fields = [sorted(metadata.groups), sorted(metadata.bundles),
+              metadata.profile, sorted(metadata.categories.items()),
+              metadata.version]
+    if mode == 'client':
+        fields.extend([metadata.hostname, sorted(metadata.aliases),
+                       sorted(metadata.addresses), metadata.uuid,
+                       metadata.password])
+    for conn in sorted(metadata.connectors):
+        try:
+            fields.append((conn, _fingerprint_data(getattr(metadata, conn,
+                                                           None))))
+        except TypeError:
+            if conn not in _UNFINGERPRINTABLE:
+                _UNFINGERPRINTABLE.add(conn)
+                LOGGER.warning("Cfg: Data from %s cannot be fingerprinted, "
+                               "templates will not be cached for clients "
+                               "that use it: %s" % (conn, sys.exc_info()[1]))
+            rv = None
+            break
+    else:
+        rv = sha256(repr(fields).encode('utf-8')).hexdigest()
+    try:
+        _FINGERPRINTS[metadata] = (mode, rv)
+    except TypeError:
+        # metadata object cannot be weakly referenced
+        pass
+    return rv
+
+
 class CfgBaseFileMatcher(Bcfg2.Server.Plugin.SpecificData):
     """ .. currentmodule:: Bcfg2.Server.Plugins.Cfg
 
@@ -173,6 +278,13 @@ class CfgGenerator(CfgBaseFileMatcher):
     client. See :class:`Bcfg2.Server.Plugin.helpers.EntrySet` for more
     details on how the best handler is chosen."""
 
+    #: Whether or not the data generated by this handler can be kept
+    #: in the rendered template cache (see ``[cfg] template_cache``)
+    #: and reused for clients with the same metadata fingerprint.
+    #: This should only be set on handlers whose output depends
+    #: solely on the entry and the client metadata.
+    cacheable = False
+
     def __init__(self, name, specific):
         # we define an __init__ that just calls the parent __init__,
         # so that we can set the docstring on __init__ to something
@@ -523,6 +635,21 @@ class CfgEntrySet(Bcfg2.Server.Plugin.EntrySet):
     def __init__(self, basename, path, entry_type):
         Bcfg2.Server.Plugin.EntrySet.__init__(self, basename, path, entry_type)
         self.specific = None
+
+        #: Mapping of generator filename ->
+        #: :class:`Bcfg2.Server.Cache.Cache` object holding the data
+        #: rendered by that generator, keyed by entry attributes and
+        #: :func:`get_metadata_fingerprint`
+        self.render_caches = dict()
+
+        #: Mapping of handler type -> index of handlers of that type
+        #: by specificity, as returned by :func:`_get_handler_index`
+        self._handler_index = dict()
+
+        #: Mapping of (handler type, hostname, frozenset of groups) ->
+        #: list of handlers that apply to clients with that hostname
+        #: and groups, for handlers whose specificity is indexed
+        self._handler_cache = dict()
     __init__.__doc__ = Bcfg2.Server.Plugin.EntrySet.__doc__
 
     def set_debug(self, debug):
@@ -559,19 +686,57 @@ class CfgEntrySet(Bcfg2.Server.Plugin.EntrySet):
                     self.entry_init(event, hdlr)
                     return
                 elif hdlr.ignore(event, basename=self.path):
+                    # ignored files may be included by templates in
+                    # this directory, so data rendered from them may
+                    # be out of date
+                    self.expire_render_cache()
                     return
         # we only get here if event.filename in self.entries, so handle
         # created event like changed
         elif action == 'changed' or action == 'created':
             self.entries[event.filename].handle_event(event)
+            self.expire_render_cache(event.filename)
             return
         elif action == 'deleted':
+            self.expire_render_cache(event.filename)
             del self.entries[event.filename]
+            self.expire_handler_index()
             return
 
         self.logger.error("Could not process event %s for %s; ignoring" %
                           (action, event.filename))
 
+    def expire_render_cache(self, fname=None):
+        """ Expire data rendered by cacheable generators in this
+        CfgEntrySet from the rendered template cache.
+
+        :param fname: The filename of the generator to expire
+                      rendered data for, relative to this
+                      CfgEntrySet.  If this is not given, rendered
+                      data for all generators is expired.
+        :type fname: string
+        :returns: None
+        """
+        if Bcfg2.Options.setup.cfg_template_cache == 'off':
+            return
+        if fname is None:
+            entries = list(self.entries.values())
+        else:
+            entries = [self.entries[fname]]
+        for ent in entries:
+            if isinstance(ent, CfgGenerator) and ent.cacheable:
+                Bcfg2.Server.Cache.expire("Cfg", "render", ent.name)
+
+    def expire_handler_index(self):
+        """ Expire the index of handlers used by
+        :func:`get_handlers`.  This must be called whenever a handler
+        is added to or removed from this CfgEntrySet.
+
+        :returns: None
+        """
+        self._handler_index = dict()
+        self._handler_cache = dict()
+
     def get_matching(self, metadata):
         return self.get_handlers(metadata, CfgGenerator)
     get_matching.__doc__ = Bcfg2.Server.Plugin.EntrySet.get_matching.__doc__
@@ -619,6 +784,7 @@ class CfgEntrySet(Bcfg2.Server.Plugin.EntrySet):
             else:
                 self.entries[event.filename] = hdlr(fpath)
             self.entries[event.filename].handle_event(event)
+        self.expire_handler_index()
 
     def bind_entry(self, entry, metadata):
         self.bind_info_to_entry(entry, metadata)
@@ -645,6 +811,7 @@ class CfgEntrySet(Bcfg2.Server.Plugin.EntrySet):
                                             sys.exc_info()[1]))
 
         if entry.get('encoding') == 'base64':
+            size, digest = self._get_digest(entry, data)
             data = b64encode(data)
         else:
             try:
@@ -670,14 +837,40 @@ class CfgEntrySet(Bcfg2.Server.Plugin.EntrySet):
                 # data is already unicode; newer versions of Cheetah
                 # seem to return unicode
                 pass
+            size, digest = self._get_digest(entry, data)
 
         if data:
             entry.text = data
+            if digest is not None:
+                entry.set('digest', digest)
+                entry.set('size', str(size))
         else:
             entry.set('empty', 'true')
         return entry
     bind_entry.__doc__ = Bcfg2.Server.Plugin.EntrySet.bind_entry.__doc__
 
+    def _get_digest(self, entry, data):
+        """ Get the size and digest of the content of the given entry,
+        which the client uses to verify the file on disk without
+        decoding the entry or comparing its content byte for byte.
+
+        :param entry: The entry being bound
+        :type entry: lxml.etree._Element
+        :param data: The content of the entry, before it is base64
+                     encoded
+        :type data: string
+        :returns: tuple of (<size in bytes>, ``sha256:<hex digest>``),
+                  or (None, None) if the digest cannot be determined
+        """
+        if not isinstance(data, bytes):
+            try:
+                data = data.encode(Bcfg2.Options.setup.encoding)
+            except UnicodeEncodeError:
+                self.logger.debug("Cfg: Cannot determine digest of %s: %s" %
+                                  (entry.get("name"), sys.exc_info()[1]))
+                return (None, None)
+        return (len(data), "sha256:%s" % sha256(data).hexdigest())
+
     def get_handlers(self, metadata, handler_type):
         """ Get all handlers of the given type for the given metadata.
 
@@ -687,11 +880,76 @@ class CfgEntrySet(Bcfg2.Server.Plugin.EntrySet):
         :type handler_type: type
         :returns: list of Cfg handler classes
         """
-        rv = []
-        for ent in list(self.entries.values()):
-            if (isinstance(ent, handler_type) and
-                    (not ent.__specific__ or ent.specific.matches(metadata))):
-                rv.append(ent)
+        # get the cache before the index, so that a list built from
+        # an index that expire_handler_index() has since replaced
+        # can only end up in the cache that was replaced with it
+        cache = self._handler_cache
+        allents, hosts, groups, other = self._get_handler_index(handler_type)
+        if metadata.hostname in hosts:
+            hostname = metadata.hostname
+        else:
+            hostname = None
+        matched = frozenset(g for g in groups if g in metadata.groups)
+        key = (handler_type, hostname, matched)
+        try:
+            rv = cache[key]
+        except KeyError:
+            rv = list(allents)
+            if hostname is not None:
+                rv.extend(hosts[hostname])
+            for group in matched:
+                rv.extend(groups[group])
+            rv.sort(key=operator.itemgetter(0))
+            cache[key] = rv
+        if other:
+            rv = rv + [item for item in other
+                       if item[1].specific.matches(metadata)]
+            rv.sort(key=operator.itemgetter(0))
+        return [ent for _, ent in rv]
+
+    def _get_handler_index(self, handler_type):
+        """ Get the index of all handlers of the given type by
+        specificity, building it if necessary.  Each handler is listed
+        as a tuple of (<position in :attr:`entries`>, <handler>), so
+        that :func:`get_handlers` can return handlers in the order in
+        which they were added.
+
+        :param handler_type: The type of Cfg handler to get
+        :type handler_type: type
+        :returns: tuple of (<list of handlers that apply to all
+                  clients>, <dict of hostname -> list of handlers>,
+                  <dict of group name -> list of handlers>, <list of
+                  handlers whose specificity cannot be indexed and
+                  must be checked for each client>)
+        """
+        index = self._handler_index
+        try:
+            return index[handler_type]
+        except KeyError:
+            pass
+        allents = []
+        hosts = dict()
+        groups = dict()
+        other = []
+        for item in enumerate(self.entries.values()):
+            ent = item[1]
+            if not isinstance(ent, handler_type):
+                continue
+            spec = ent.specific
+            if not ent.__specific__:
+                allents.append(item)
+            elif not isinstance(spec, Bcfg2.Server.Plugin.Specificity):
+                other.append(item)
+            elif spec.all:
+                allents.append(item)
+            elif spec.hostname:
+                hosts.setdefault(spec.hostname, []).append(item)
+            elif spec.group:
+                groups.setdefault(spec.group, []).append(item)
+            else:
+                other.append(item)
+        rv = (allents, hosts, groups, other)
+        index[handler_type] = rv
         return rv
 
     def bind_info_to_entry(self, entry, metadata):
@@ -756,7 +1014,7 @@ class CfgEntrySet(Bcfg2.Server.Plugin.EntrySet):
             return (self._create_data(entry, metadata), None)
 
         try:
-            return (generator.get_data(entry, metadata), generator)
+            return (self._render_data(generator, entry, metadata), generator)
         except:
             # TODO: the exceptions raised by ``get_data`` are not
             # constrained in any way, so for now this needs to be a
@@ -766,6 +1024,47 @@ class CfgEntrySet(Bcfg2.Server.Plugin.EntrySet):
             self.logger.error(msg)
             raise PluginExecutionError(msg)
 
+    def _render_data(self, generator, entry, metadata):
+        """ Get data for the given entry on the given client from a
+        generator, reusing data previously rendered by the generator
+        for the same entry attributes and
+        :func:`get_metadata_fingerprint` if the rendered template
+        cache is enabled.
+
+        :param generator: The generator to get data from
+        :type generator: Bcfg2.Server.Plugins.Cfg.CfgGenerator
+        :param entry: The abstract entry to generate data for.  This
+                      will not be modified
+        :type entry: lxml.etree._Element
+        :param metadata: The client metadata to generate data for
+        :type metadata: Bcfg2.Server.Plugins.Metadata.ClientMetadata
+        :returns: string - the data for the entry
+        """
+        if (Bcfg2.Options.setup.cfg_template_cache == 'off' or
+                not generator.cacheable):
+            return generator.get_data(entry, metadata)
+        fingerprint = get_metadata_fingerprint(metadata)
+        if fingerprint is None:
+            return generator.get_data(entry, metadata)
+
+        if generator.name not in self.render_caches:
+            self.render_caches[generator.name] = Cache(
+                "Cfg", "render", generator.name, shared=True,
+                ttl=Bcfg2.Options.setup.cfg_template_cache_ttl,
+                maxsize=Bcfg2.Options.setup.cfg_template_cache_size)
+        cache = self.render_caches[generator.name]
+        key = (tuple(sorted(entry.attrib.items())), fingerprint)
+        try:
+            data = cache[key]
+            self.debug_log("Cfg: Using cached data from %s for %s" %
+                           (generator.name, metadata.hostname))
+            return data
+        except KeyError:
+            pass
+        data = generator.get_data(entry, metadata)
+        cache[key] = data
+        return data
+
     def _validate_data(self, entry, metadata, data):
         """ Validate data for the given entry on the given client
 
@@ -894,7 +1193,20 @@ class Cfg(Bcfg2.Server.Plugin.GroupSpool,
             cf=("cfg", "handlers"), dest="cfg_handlers",
             help="Cfg handlers to load",
             type=Bcfg2.Options.Types.comma_list, action=CfgHandlerAction,
-            default=_handlers)]
+            default=_handlers),
+        Bcfg2.Options.Option(
+            cf=("cfg", "template_cache"), dest="cfg_template_cache",
+            default="off", choices=["off", "client", "groups"],
+            help="Cache rendered templates per client or per group set"),
+        Bcfg2.Options.Option(
+            cf=("cfg", "template_cache_size"), dest="cfg_template_cache_size",
+            type=int, default=None,
+            help="Maximum number of cached renderings of each template"),
+        Bcfg2.Options.Option(
+            cf=("cfg", "template_cache_ttl"), dest="cfg_template_cache_ttl",
+            type=Bcfg2.Options.Types.timeout, default=None,
+            help="Expire cached renderings of templates after this many "
+            "seconds")]
 
     def __init__(self, core):
         global _CFG  # pylint: disable=W0603
@@ -6,19 +6,23 @@ import os
 import sys
 import time
 import copy
+import heapq
 import errno
 import socket
 import logging
+import threading
 import lxml.etree
 import Bcfg2.Server
 import Bcfg2.Options
+import Bcfg2.Server.Cache
 import Bcfg2.Server.Plugin
+import Bcfg2.Server.Snapshot
 import Bcfg2.Server.FileMonitor
+from itertools import count
+from operator import attrgetter
 from Bcfg2.Utils import locked
 from Bcfg2.Server.Cache import Cache
-# pylint: disable=W0622
-from Bcfg2.Compat import MutableMapping, all, any, wraps
-# pylint: enable=W0622
+from Bcfg2.Compat import MutableMapping, wraps
 from Bcfg2.version import Bcfg2VersionInfo
 
 try:
@@ -144,6 +148,8 @@ class XMLMetadataConfig(Bcfg2.Server.Plugin.XMLFileBacked):
 
     def load_xml(self):
         """Load changes from XML"""
+        self.signatures = dict()
+        self._sign(self.name)
         try:
             xdata = lxml.etree.parse(os.path.join(self.basedir, self.basefile),
                                      parser=Bcfg2.Server.XMLParser)
@@ -476,6 +482,10 @@ class MetadataGroup(tuple):  # pylint: disable=E0012,R0924
         self.warned = []
     # pylint: enable=R0913
 
+    def __getnewargs__(self):
+        return (self.name, self.bundles, self.category, self.is_profile,
+                self.is_public)
+
     def __str__(self):
         return repr(self)
 
@@ -488,6 +498,132 @@ class MetadataGroup(tuple):  # pylint: disable=E0012,R0924
         return hash(self.name)
 
 
+class MetadataGroupRule(object):
+    """ A single declaration of group membership in ``groups.xml``,
+    i.e., a Group element with no children, together with the
+    conditions imposed by the Group and Client elements it is nested
+    in.  A rule is a predicate that is called with the client name,
+    the client's current groups, and the client's current categories,
+    and returns True if the client meets all of its conditions. """
+
+    def __init__(self, element, order, category_check=None):
+        """
+        :param element: The Group element that declares membership
+        :type element: lxml.etree._Element
+        :param order: A key that sorts rules in the order in which
+                      they must be evaluated
+        :type order: tuple
+        :param category_check: A callable that is called with the
+                               client name, the group name, and the
+                               client's categories, and returns False
+                               if the client is already a member of a
+                               group in the category of this group.
+                               This is only given for rules that add a
+                               group that is in a category.
+        :type category_check: callable
+        """
+        #: The name of the group this rule adds or removes
+        self.name = element.get("name")
+
+        #: Whether this rule removes the group instead of adding it
+        self.negate = element.get("negate", "false").lower() == "true"
+
+        #: Sort key giving the order in which rules are evaluated
+        self.order = order
+
+        #: List of ``(<group name>, <negate>)`` tuples for the Group
+        #: elements this declaration is nested in
+        self.groups = []
+
+        #: List of ``(<client name>, <negate>)`` tuples for the Client
+        #: elements this declaration is nested in
+        self.clients = []
+
+        self.category_check = category_check
+        for parent in element.iterancestors():
+            negate = parent.get('negate', 'false').lower() == 'true'
+            if parent.tag == 'Group':
+                self.groups.append((parent.get("name"), negate))
+            elif parent.tag == 'Client':
+                self.clients.append((parent.get("name"), negate))
+
+    def __call__(self, client, groups, categories):
+        for name, negate in self.clients:
+            if negate == (name == client):
+                return False
+        for name, negate in self.groups:
+            if negate == (name in groups):
+                return False
+        if self.category_check is not None:
+            return bool(self.category_check(client, self.name, categories))
+        return True
+
+    def __getstate__(self):
+        # the category check is a method of the Metadata plugin, so it
+        # is not pickled; see Metadata._load_groups_xml_snapshot()
+        state = self.__dict__.copy()
+        state['category_check'] = None
+        return state
+
+    def __repr__(self):
+        return "%s(%s%s, groups=%s, clients=%s)" % \
+            (self.__class__.__name__, "!" if self.negate else "", self.name,
+             self.groups, self.clients)
+
+
+class SessionCache(dict):
+    """ dict of (address, port) pairs to ``(<timestamp>, <client
+    name>)`` tuples, for clients whose name is remembered for the
+    rest of their session.  Entries for each address are also kept in
+    a heap ordered by timestamp, so that the expired entries for an
+    address can be removed without looking at the entries for any
+    other address. """
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self)
+        #: mapping of address -> heap of (timestamp, sequence number,
+        #: (address, port)).  The sequence number keeps heapq from
+        #: comparing the (address, port) pairs themselves.
+        self._expiry = dict()
+        self._seq = count()
+        self.update(*args, **kwargs)
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        # superseded heap entries are left in place, and skipped by
+        # expire() because their timestamp is no longer current
+        heapq.heappush(self._expiry.setdefault(key[0], []),
+                       (value[0] or 0, next(self._seq), key))
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        dict.clear(self)
+        self._expiry.clear()
+
+    def expire(self, address, ttl):
+        """ Remove all entries for the given address, with any port
+        number, that are older than ``ttl`` seconds.
+
+        :param address: The address to expire entries for
+        :type address: string
+        :param ttl: The age in seconds after which an entry expires
+        :type ttl: int
+        """
+        heap = self._expiry.get(address)
+        if not heap:
+            return
+        cutoff = time.time() - ttl
+        while heap and heap[0][0] < cutoff:
+            stamp, _, key = heapq.heappop(heap)
+            if key in self and (self[key][0] or 0) == stamp:
+                del self[key]
+        if not heap:
+            del self._expiry[address]
+
+
 class Metadata(Bcfg2.Server.Plugin.Metadata,
                Bcfg2.Server.Plugin.ClientRunHooks,
                Bcfg2.Server.Plugin.DatabaseBacked):
@@ -542,11 +678,22 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
         self.raliases = {}
         # mapping of groupname -> MetadataGroup object
         self.groups = {}
-        # mappings of groupname -> [predicates]
+        # mappings of groupname -> [MetadataGroupRule objects]
         self.group_membership = dict()
         self.negated_groups = dict()
         # list of group names in document order
         self.ordered_groups = []
+        # indexes of MetadataGroupRule objects that let _merge_groups
+        # evaluate only the rules that can have changed: rules that
+        # apply only to a given client; rules that have no positive
+        # Group or Client conditions, and so can apply to a client
+        # with no groups at all; and rules that must be re-evaluated
+        # when the given group or category is added to or removed
+        # from a client
+        self._rules_by_client = dict()
+        self._floating_rules = []
+        self._rules_by_group = dict()
+        self._rules_by_category = dict()
         # mapping of hostname -> version string
         if self._use_db:
             self.versions = ClientVersions(core)  # pylint: disable=E1102
@@ -554,8 +701,30 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
             self.versions = dict()
 
         self.uuid = {}
-        self.session_cache = {}
+        # mapping of clientname -> uuid
+        self.ruuid = {}
+        self.session_cache = SessionCache()
         self.cache = Cache("Metadata")
+        # reverse indexes of group, bundle, and profile names -> set
+        # of names of clients, built from the full metadata of each
+        # client.  the indexes are only used when client metadata is
+        # cached, and a client's entries are dropped whenever its
+        # cached metadata is expired, so they are never more stale
+        # than the metadata cache itself.
+        self._clients_by_group = dict()
+        self._clients_by_bundle = dict()
+        self._clients_by_profile = dict()
+        # mapping of clientname -> (groups, bundles, profile,
+        # expiration time) that are in the reverse indexes
+        self._indexed = dict()
+        # clients that must be (re-)indexed before the reverse indexes
+        # can be used, or None if every client must be indexed
+        self._unindexed = None
+        # heap of (timestamp, clientname) for expiring indexed clients
+        # along with the client_metadata_ttl of the metadata cache
+        self._index_expiry = []
+        self._index_lock = threading.Lock()
+        Bcfg2.Server.Cache.add_expire_hook(self._expire_client_index)
         self.default = None
         self.pdirty = False
 
@@ -827,6 +996,7 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
                 self.auth[client.get('name')] = client.get('auth')
             if 'uuid' in client.attrib:
                 self.uuid[client.get('uuid')] = clname
+                self.ruuid[clname] = client.get('uuid')
             if client.get('secure', 'false').lower() == 'true':
                 self.secure.append(clname)
             if (client.get('location', 'fixed') == 'floating' or
@@ -868,41 +1038,65 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
         self.cache.expire()
         self.states['clients.xml'] = True
 
-    def _get_condition(self, element):
-        """ Return a predicate that returns True if a client meets
-        the condition specified in the given Group or Client
-        element """
-        negate = element.get('negate', 'false').lower() == 'true'
-        pname = element.get("name")
-        if element.tag == 'Group':
-            return lambda c, g, _: negate != (pname in g)
-        elif element.tag == 'Client':
-            return lambda c, g, _: negate != (pname == c)
-
-    def _get_category_condition(self, grpname):
-        """ get a predicate that returns False if a client is already
-        a member of a group in the given group's category, True
-        otherwise"""
-        return lambda client, _, categories: \
-            bool(self._check_category(client, grpname, categories))
-
-    def _aggregate_conditions(self, conditions):
-        """ aggregate all conditions on a given group declaration
-        into a single predicate """
-        return lambda client, groups, cats: \
-            all(cond(client, groups, cats) for cond in conditions)
-
-    def _handle_groups_xml_event(self, _):  # pylint: disable=R0912
+    def _handle_groups_xml_event(self, _):
         """ re-read groups.xml on any event on it """
         # disable metadata builds during parsing.  this prevents
         # clients from getting bogus metadata during the brief time it
         # takes to rebuild the groups.xml data
         self.states['groups.xml'] = False
 
+        snapshot = Bcfg2.Server.Snapshot.get(("Metadata", "groups.xml"))
+        if snapshot is not None:
+            self._load_groups_xml_snapshot(*snapshot)
+        else:
+            self._compile_groups_xml()
+            if Bcfg2.Server.Snapshot.enabled():
+                Bcfg2.Server.Snapshot.store(
+                    ("Metadata", "groups.xml"), self.groups_xml.signatures,
+                    (self.groups, self.default, self.group_membership,
+                     self.negated_groups, self.ordered_groups))
+        self.cache.expire()
+        self.states['groups.xml'] = True
+
+    def _load_groups_xml_snapshot(self, groups, default, group_membership,
+                                  negated_groups, ordered_groups):
+        """ Restore the data compiled from groups.xml by
+        :func:`_compile_groups_xml` from :mod:`Bcfg2.Server.Snapshot`,
+        and rebuild the rule indexes from it. """
+        # pylint: disable=R0913
+        self.groups = groups
+        self.default = default
+        self.group_membership = group_membership
+        self.negated_groups = negated_groups
+        self.ordered_groups = ordered_groups
+        self._rules_by_client = dict()
+        self._floating_rules = []
+        self._rules_by_group = dict()
+        self._rules_by_category = dict()
+        rules = []
+        for grouprules in list(group_membership.values()) + \
+                list(negated_groups.values()):
+            rules.extend(grouprules)
+        for rule in sorted(rules, key=lambda r: r.order[1]):
+            if not rule.negate:
+                category = self.groups[rule.name].category
+                if category:
+                    rule.category_check = self._check_category
+                    self._rules_by_category.setdefault(category,
+                                                       []).append(rule)
+            self._index_rule(rule)
+
+    def _compile_groups_xml(self):  # pylint: disable=R0912
+        """ Compile the parsed groups.xml data into groups and group
+        membership rules. """
         self.groups = {}
         self.group_membership = dict()
         self.negated_groups = dict()
         self.ordered_groups = []
+        self._rules_by_client = dict()
+        self._floating_rules = []
+        self._rules_by_group = dict()
+        self._rules_by_category = dict()
 
         # first, we get a list of all of the groups declared in the
         # file.  we do this in two stages because the old way of
@@ -934,48 +1128,67 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
         # since there doesn't seem to be a way to get Group elements
         # of arbitrary depth with particular ultimate ancestors in
         # XPath.  We do the same thing for Client tags.
+        group_order = dict()
+        negated_order = dict()
+        seq = 0
         for el in self.groups_xml.xdata.xpath("//Groups/Group//*") + \
                 self.groups_xml.xdata.xpath("//Groups/Client//*"):
             if (el.tag != 'Group' and el.tag != 'Client') or el.getchildren():
                 continue
 
-            conditions = []
-            for parent in el.iterancestors():
-                cond = self._get_condition(parent)
-                if cond:
-                    conditions.append(cond)
-
             gname = el.get("name")
             if el.get("negate", "false").lower() == "true":
-                self.negated_groups.setdefault(gname, [])
-                self.negated_groups[gname].append(
-                    self._aggregate_conditions(conditions))
+                if gname not in self.negated_groups:
+                    self.negated_groups[gname] = []
+                    negated_order[gname] = len(negated_order)
+                rule = MetadataGroupRule(el, (negated_order[gname], seq))
+                self.negated_groups[gname].append(rule)
             else:
-                if self.groups[gname].category:
-                    conditions.append(self._get_category_condition(gname))
+                category = self.groups[gname].category
+                if category:
+                    category_check = self._check_category
+                else:
+                    category_check = None
 
                 if gname not in self.ordered_groups:
+                    group_order[gname] = len(self.ordered_groups)
                     self.ordered_groups.append(gname)
+                rule = MetadataGroupRule(el, (group_order[gname], seq),
+                                         category_check=category_check)
                 self.group_membership.setdefault(gname, [])
-                self.group_membership[gname].append(
-                    self._aggregate_conditions(conditions))
-        self.cache.expire()
-        self.states['groups.xml'] = True
+                self.group_membership[gname].append(rule)
+                if category:
+                    self._rules_by_category.setdefault(category,
+                                                       []).append(rule)
+            seq += 1
+            self._index_rule(rule)
 
     def HandleEvent(self, event):
         """Handle update events for data files."""
+        self.HandleEvents([event])
+
+    def HandleEvents(self, events):
+        """Handle a batch of update events for data files.  Each data
+        file is reloaded and processed at most once per batch, no
+        matter how many of the events concern it or the files it
+        xincludes."""
         for handles, event_handler in list(self.handlers.items()):
-            if handles(event):
-                # clear the entire cache when we get an event for any
-                # metadata file
-                self.cache.expire()
-
-                # clear out the list of category suppressions that
-                # have been warned about, since this may change when
-                # clients.xml or groups.xml changes.
-                for group in list(self.groups.values()):
-                    group.warned = []
-                event_handler(event)
+            for event in events:
+                if handles(event):
+                    break
+            else:
+                continue
+
+            # clear the entire cache when we get an event for any
+            # metadata file
+            self.cache.expire()
+
+            # clear out the list of category suppressions that have
+            # been warned about, since this may change when
+            # clients.xml or groups.xml changes.
+            for group in list(self.groups.values()):
+                group.warned = []
+            event_handler(event)
 
         if False not in list(self.states.values()) and self.debug_flag:
             # check that all groups are real and complete. this is
@@ -1068,14 +1281,8 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
             cache_ttl = 90
             if cleanup_cache:
                 # remove entries for this client's IP address with
-                # _any_ port numbers - perhaps a priority queue could
-                # be faster?
-                curtime = time.time()
-                for addrpair in list(self.session_cache.keys()):
-                    if addresspair[0] == addrpair[0]:
-                        (stamp, _) = self.session_cache[addrpair]
-                        if curtime - stamp > cache_ttl:
-                            del self.session_cache[addrpair]
+                # _any_ port numbers
+                self.session_cache.expire(addresspair[0], cache_ttl)
             # return the cached data
             try:
                 stamp = self.session_cache[addresspair][0]
@@ -1104,36 +1311,78 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
             self.logger.error(err)
             raise Bcfg2.Server.Plugin.MetadataConsistencyError(err)
 
+    def _index_rule(self, rule):
+        """ Add a :class:`MetadataGroupRule` to the indexes used by
+        :func:`_merge_groups` to find the rules that may apply to a
+        client. """
+        positive_clients = [c for c, negate in rule.clients if not negate]
+        if positive_clients:
+            for client in positive_clients:
+                self._rules_by_client.setdefault(client, []).append(rule)
+        elif not [g for g, negate in rule.groups if not negate]:
+            self._floating_rules.append(rule)
+        for grpname in set([rule.name] + [g for g, _ in rule.groups]):
+            self._rules_by_group.setdefault(grpname, []).append(rule)
+
+    def _get_triggered_rules(self, groups):
+        """ Get the set of rules whose result may change when the
+        given groups are added to or removed from a client: rules with
+        conditions on those groups, and rules that add or remove those
+        groups. """
+        rv = set()
+        for grpname in groups:
+            rv.update(self._rules_by_group.get(grpname, []))
+        return rv
+
     def _merge_groups(self, client, groups, categories=None):
         """ set group membership based on the contents of groups.xml
         and initial group membership of this client. Returns a tuple
-        of (allgroups, categories)"""
+        of (allgroups, categories).
+
+        Each pass adds every group that a rule grants, and then
+        removes every negated group that a rule revokes, until the
+        number of groups no longer changes.  Only the rules that can
+        have a different result than they did in the previous pass are
+        evaluated, so adding a group only re-evaluates the rules that
+        depend on it."""
         numgroups = -1  # force one initial pass
         if categories is None:
             categories = dict()
+        pending = set(self._floating_rules)
+        pending.update(self._rules_by_client.get(client, []))
+        pending.update(self._get_triggered_rules(groups))
         while numgroups != len(groups):
             numgroups = len(groups)
             newgroups = set()
             removegroups = set()
-            for grpname in self.ordered_groups:
-                if grpname in groups:
+            for rule in sorted(pending, key=attrgetter("order")):
+                if (rule.negate or rule.name in groups or
+                        rule.name in newgroups):
                     continue
-                if any(p(client, groups, categories)
-                       for p in self.group_membership[grpname]):
-                    newgroups.add(grpname)
-                    if (grpname in self.groups and
-                            self.groups[grpname].category):
-                        categories[self.groups[grpname].category] = grpname
+                if rule(client, groups, categories):
+                    newgroups.add(rule.name)
+                    if (rule.name in self.groups and
+                            self.groups[rule.name].category):
+                        categories[self.groups[rule.name].category] = \
+                            rule.name
             groups.update(newgroups)
-            for grpname, predicates in list(self.negated_groups.items()):
-                if grpname not in groups:
+            pending.update(self._get_triggered_rules(newgroups))
+            removedcats = set()
+            for rule in sorted(pending, key=attrgetter("order")):
+                if (not rule.negate or rule.name not in groups or
+                        rule.name in removegroups):
                     continue
-                if any(p(client, groups, categories) for p in predicates):
-                    removegroups.add(grpname)
-                    if (grpname in self.groups and
-                            self.groups[grpname].category):
-                        del categories[self.groups[grpname].category]
+                if rule(client, groups, categories):
+                    removegroups.add(rule.name)
+                    if (rule.name in self.groups and
+                            self.groups[rule.name].category):
+                        category = self.groups[rule.name].category
+                        del categories[category]
+                        removedcats.add(category)
             groups.difference_update(removegroups)
+            pending = self._get_triggered_rules(newgroups | removegroups)
+            for category in removedcats:
+                pending.update(self._rules_by_category.get(category, []))
         return (groups, categories)
 
     def _check_category(self, client, grpname, categories):
@@ -1271,12 +1520,7 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
             password = self.passwords[client]
         else:
             password = None
-        uuids = [item for item, value in list(self.uuid.items())
-                 if value == client]
-        if uuids:
-            uuid = uuids[0]
-        else:
-            uuid = None
+        uuid = self.ruuid.get(client, None)
         if not profile:
             # one last ditch attempt at setting the profile
             profiles = [g for g in groups
@@ -1306,8 +1550,128 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
         return set([g.name for g in list(self.groups.values())
                     if g.category == category])
 
+    def _expire_client_index(self, tags, exact, _):
+        """ Hook called by :func:`Bcfg2.Server.Cache.expire` that
+        drops clients from the reverse indexes when their cached
+        metadata is expired. """
+        tags = set(tags)
+        if tags and "Metadata" not in tags:
+            return
+        tags.discard("Metadata")
+        with self._index_lock:
+            if len(tags) == 1:
+                self._unindex_client(tags.pop())
+            elif not tags or not exact:
+                self._clients_by_group = dict()
+                self._clients_by_bundle = dict()
+                self._clients_by_profile = dict()
+                self._indexed = dict()
+                self._unindexed = None
+                self._index_expiry = []
+
+    def _unindex_client(self, client):
+        """ Remove a client from the reverse indexes and mark it to be
+        indexed again.  This must be called with ``_index_lock``
+        held. """
+        if self._unindexed is not None:
+            self._unindexed.add(client)
+        if client not in self._indexed:
+            return
+        groups, bundles, profile = self._indexed.pop(client)[:3]
+        for index, names in [(self._clients_by_group, groups),
+                             (self._clients_by_bundle, bundles),
+                             (self._clients_by_profile, [profile])]:
+            for name in names:
+                index[name].discard(client)
+                if not index[name]:
+                    del index[name]
+
+    def _index_client(self, imd):
+        """ Add the full metadata of a client to the reverse indexes.
+        This must be called with ``_index_lock`` held. """
+        client = imd.hostname
+        self._unindex_client(client)
+        if self._unindexed is not None:
+            self._unindexed.discard(client)
+        groups = frozenset(imd.groups)
+        bundles = frozenset(imd.bundles)
+        ttl = getattr(Bcfg2.Options.setup, "client_metadata_ttl", None)
+        if ttl:
+            expires = time.time() + ttl
+            heapq.heappush(self._index_expiry, (expires, client))
+        else:
+            expires = None
+        self._indexed[client] = (groups, bundles, imd.profile, expires)
+        for name in groups:
+            self._clients_by_group.setdefault(name, set()).add(client)
+        for name in bundles:
+            self._clients_by_bundle.setdefault(name, set()).add(client)
+        self._clients_by_profile.setdefault(imd.profile, set()).add(client)
+
+    def _update_client_index(self):
+        """ Bring the reverse indexes up to date by building metadata
+        for all clients that have been added, or whose cached metadata
+        has been expired, since they were last indexed.
+
+        :returns: bool - True if the indexes can be used; False if
+                  client metadata is not cached, in which case every
+                  query must build metadata for every client. """
+        if self.core.metadata_cache_mode not in ['cautious', 'aggressive']:
+            return False
+        clients = None
+        while True:
+            # metadata is built without holding the lock, since
+            # building metadata can itself query the indexes (e.g.,
+            # from a Connector plugin)
+            with self._index_lock:
+                now = time.time()
+                while (self._index_expiry and
+                       self._index_expiry[0][0] <= now):
+                    expires, client = heapq.heappop(self._index_expiry)
+                    if (client in self._indexed and
+                            self._indexed[client][3] == expires):
+                        self._unindex_client(client)
+                if self._unindexed is None:
+                    clients = set(self.list_clients())
+                    self._unindexed = set(clients)
+                elif self._unindexed and clients is None:
+                    clients = set(self.list_clients())
+                    self._unindexed.intersection_update(clients)
+                if not self._unindexed:
+                    return True
+                client = self._unindexed.pop()
+                if client not in clients:
+                    clients = set(self.list_clients())
+                    if client not in clients:
+                        continue
+            imd = self.core.build_metadata(client)
+            with self._index_lock:
+                # don't index the metadata if it was expired while it
+                # was being built
+                if (self._unindexed is not None and
+                        client not in self._unindexed):
+                    self._index_client(imd)
+
+    def _get_indexed_clients(self, index, names, match_all=True):
+        """ Get the names of clients from a reverse index that are
+        listed under all (or, if ``match_all`` is False, any) of the
+        given names. """
+        with self._index_lock:
+            sets = [index.get(name, set()) for name in names]
+            if not sets:
+                if match_all:
+                    return list(self._indexed.keys())
+                return []
+            if match_all:
+                sets.sort(key=len)
+                return list(sets[0].intersection(*sets[1:]))
+            return list(set().union(*sets))
+
     def get_client_names_by_profiles(self, profiles):
         """ return a list of names of clients in the given profile groups """
+        if self._update_client_index():
+            return self._get_indexed_clients(self._clients_by_profile,
+                                             profiles, match_all=False)
         rv = []
         for client in self.list_clients():
             mdata = self.core.build_metadata(client)
@@ -1317,6 +1681,8 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
 
     def get_client_names_by_groups(self, groups):
         """ return a list of names of clients in the given groups """
+        if self._update_client_index():
+            return self._get_indexed_clients(self._clients_by_group, groups)
         rv = []
         for client in self.list_clients():
             mdata = self.core.build_metadata(client)
@@ -1327,6 +1693,8 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
     def get_client_names_by_bundles(self, bundles):
         """ given a list of bundles, return a list of names of clients
         that use those bundles """
+        if self._update_client_index():
+            return self._get_indexed_clients(self._clients_by_bundle, bundles)
         rv = []
         for client in self.list_clients():
             mdata = self.core.build_metadata(client)
@@ -1415,6 +1783,7 @@ class Metadata(Bcfg2.Server.Plugin.Metadata,
             if user not in self.uuid:
                 client = user
                 self.uuid[user] = user
+                self.ruuid.setdefault(user, user)
             else:
                 client = self.uuid[user]
 
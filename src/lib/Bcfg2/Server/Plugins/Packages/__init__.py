@@ -362,11 +362,13 @@ class Packages(Bcfg2.Server.Plugin.Plugin,
         groups.sort()
         # check for this set of groups in the group cache
         gcache = Bcfg2.Server.Cache.Cache("Packages", "pkg_groups",
-                                          collection.cachekey)
+                                          collection.cachekey, shared=True)
         gkey = hash(tuple(groups))
-        if gkey not in gcache:
-            gcache[gkey] = collection.get_groups(groups)
-        for pkgs in list(gcache[gkey].values()):
+        try:
+            pkg_groups = gcache[gkey]
+        except KeyError:
+            pkg_groups = gcache[gkey] = collection.get_groups(groups)
+        for pkgs in list(pkg_groups.values()):
             base.update(pkgs)
 
         # essential pkgs are those marked as such by the distribution
@@ -375,10 +377,12 @@ class Packages(Bcfg2.Server.Plugin.Plugin,
         # check for this set of packages in the package cache
         pkey = hash((tuple(base), tuple(recommended), tuple(pinned_src)))
         pcache = Bcfg2.Server.Cache.Cache("Packages", "pkg_sets",
-                                          collection.cachekey)
-        if pkey not in pcache:
-            pcache[pkey] = collection.complete(base, recommended, pinned_src)
-        packages, unknown = pcache[pkey]
+                                          collection.cachekey, shared=True)
+        try:
+            packages, unknown = pcache[pkey]
+        except KeyError:
+            packages, unknown = pcache[pkey] = \
+                collection.complete(base, recommended, pinned_src)
         if unknown:
             self.logger.info("Packages: Got %d unknown entries" % len(unknown))
             self.logger.info("Packages: %s" % list(unknown))
@@ -5,7 +5,9 @@ import os
 import sys
 import time
 import copy
+import fcntl
 import operator
+import threading
 import lxml.etree
 import Bcfg2.Server
 import Bcfg2.Server.Cache
@@ -16,7 +18,7 @@ from Bcfg2.Logger import Debuggable
 from Bcfg2.Server.Statistics import track_statistics
 
 try:
-    from django.db import models
+    from django.db import models, transaction
     HAS_DJANGO = True
 except ImportError:
     HAS_DJANGO = False
@@ -119,6 +121,12 @@ class ProbeStore(Debuggable):
         commits on every change. """
         pass
 
+    def shutdown(self):
+        """ Perform any tasks required before the server shuts down,
+        such as writing data that has not yet been written to the
+        backend store. """
+        pass
+
 
 class DBProbeStore(ProbeStore, Bcfg2.Server.Plugin.DatabaseBacked):
     """ Caching abstraction layer between the database and the Probes
@@ -139,24 +147,86 @@ class DBProbeStore(ProbeStore, Bcfg2.Server.Plugin.DatabaseBacked):
         self._groupcache[hostname] = list(set(r.group for r in groupdata))
         self.core.metadata_cache.expire(hostname)
 
+    def _update_records(self, model, hostname, field, values):
+        """ Bring the records of ``model`` for the given client in line
+        with ``values``.  The existing records are read with a single
+        query and compared to ``values``; records that are new are
+        inserted with a single ``bulk_create()``, records that have
+        changed are updated with a single ``bulk_update()`` (or with
+        one ``save()`` each on versions of Django that lack it), and
+        records that are no longer wanted, including duplicate
+        records, are removed with a single ``delete()``, all in one
+        transaction.
+
+        :param model: The database model to update
+        :type model: django.db.models.Model
+        :param hostname: The client whose records are updated
+        :type hostname: string
+        :param field: The name of the field that identifies a record
+                      for the client (e.g., ``probe``)
+        :type field: string
+        :param values: dict of <value of ``field``> => <dict of other
+                       field values>
+        :type values: dict
+        :returns: bool - True if any records were changed
+        """
+        # Django < 1.6 has commit_on_success() instead of atomic()
+        atomic = getattr(transaction, "atomic", None) or \
+            transaction.commit_on_success  # pylint: disable=E1101
+        with atomic():
+            records = dict()
+            delete = []
+            for record in model.objects.filter(hostname=hostname):
+                key = getattr(record, field)
+                if key in records or key not in values:
+                    delete.append(record.pk)
+                else:
+                    records[key] = record
+
+            create = []
+            update = []
+            update_fields = set()
+            for key, fields in values.items():
+                if key not in records:
+                    fields = dict(fields)
+                    fields[field] = key
+                    create.append(model(hostname=hostname, **fields))
+                    continue
+                record = records[key]
+                changed = [f for f, val in fields.items()
+                           if getattr(record, f) != val]
+                if changed:
+                    for fname in changed:
+                        setattr(record, fname, fields[fname])
+                    update.append(record)
+                    update_fields.update(changed)
+
+            if delete:
+                model.objects.filter(pk__in=delete).delete()
+            if create:
+                model.objects.bulk_create(create)
+            if update:
+                if hasattr(model.objects, "bulk_update"):
+                    # bulk_update() does not set auto_now fields
+                    # (e.g., timestamps) the way save() does
+                    for dbfield in model._meta.fields:
+                        if getattr(dbfield, "auto_now", False):
+                            for record in update:
+                                dbfield.pre_save(record, False)
+                            update_fields.add(dbfield.name)
+                    model.objects.bulk_update(update, list(update_fields))
+                else:
+                    for record in update:
+                        record.save()
+        return bool(delete or create or update)
+
     @Bcfg2.Server.Plugin.DatabaseBacked.get_db_lock
     def set_groups(self, hostname, groups):
         Bcfg2.Server.Cache.expire("Probes", "probegroups", hostname)
         olddata = self._groupcache.get(hostname, [])
         self._groupcache[hostname] = groups
-        for group in groups:
-            try:
-                ProbesGroupsModel.objects.get_or_create(
-                    hostname=hostname,
-                    group=group)
-            except ProbesGroupsModel.MultipleObjectsReturned:
-                ProbesGroupsModel.objects.filter(hostname=hostname,
-                                                 group=group).delete()
-                ProbesGroupsModel.objects.get_or_create(
-                    hostname=hostname,
-                    group=group)
-        ProbesGroupsModel.objects.filter(
-            hostname=hostname).exclude(group__in=groups).delete()
+        self._update_records(ProbesGroupsModel, hostname, "group",
+                             dict((group, dict()) for group in groups))
         if olddata != groups:
             self.core.metadata_cache.expire(hostname)
 
@@ -177,30 +247,11 @@ class DBProbeStore(ProbeStore, Bcfg2.Server.Plugin.DatabaseBacked):
     def set_data(self, hostname, data):
         Bcfg2.Server.Cache.expire("Probes", "probedata", hostname)
         self._datacache[hostname] = ClientProbeDataSet()
-        expire_metadata = False
         for probe, pdata in list(data.items()):
             self._datacache[hostname][probe] = pdata
-            try:
-                record, created = ProbesDataModel.objects.get_or_create(
-                    hostname=hostname,
-                    probe=probe)
-            except ProbesDataModel.MultipleObjectsReturned:
-                ProbesDataModel.objects.filter(hostname=hostname,
-                                               probe=probe).delete()
-                record, created = ProbesDataModel.objects.get_or_create(
-                    hostname=hostname,
-                    probe=probe)
-            expire_metadata |= created
-            if record.data != pdata:
-                record.data = pdata
-                record.save()
-                expire_metadata = True
-        qset = ProbesDataModel.objects.filter(
-            hostname=hostname).exclude(probe__in=list(data.keys()))
-        if len(qset):
-            qset.delete()
-            expire_metadata = True
-        if expire_metadata:
+        if self._update_records(ProbesDataModel, hostname, "probe",
+                                dict((probe, dict(data=pdata))
+                                     for probe, pdata in data.items())):
             self.core.metadata_cache.expire(hostname)
 
 
@@ -226,44 +277,56 @@ class XMLProbeStore(ProbeStore):
             self.logger.error("Failed to read file probed.xml: %s" % err)
             return
         for client in data.getchildren():
-            self._datacache[client.get('name')] = \
-                ClientProbeDataSet(timestamp=client.get("timestamp"))
-            self._groupcache[client.get('name')] = []
-            for pdata in client:
-                if pdata.tag == 'Probe':
-                    self._datacache[client.get('name')][pdata.get('name')] = \
-                        ProbeData(pdata.get("value"))
-                elif pdata.tag == 'Group':
-                    self._groupcache[client.get('name')].append(
-                        pdata.get('name'))
+            self._load_client(client)
 
         self.core.metadata_cache.expire()
 
+    def _load_client(self, client):
+        """ Load the probe data and groups of a single client from a
+        ``Client`` element of probed.xml """
+        hostname = client.get('name')
+        self._datacache[hostname] = \
+            ClientProbeDataSet(timestamp=client.get("timestamp"))
+        self._groupcache[hostname] = []
+        for pdata in client:
+            if pdata.tag == 'Probe':
+                self._datacache[hostname][pdata.get('name')] = \
+                    ProbeData(pdata.get("value"))
+            elif pdata.tag == 'Group':
+                self._groupcache[hostname].append(pdata.get('name'))
+
     def _load_groups(self, hostname):
         self._load_data(hostname)
 
+    def _get_client_element(self, client, probed, parent=None):
+        """ Get a ``Client`` element for probed.xml that describes
+        the probe data and groups of a single client """
+        # make a copy of probe data for this client in case it
+        # submits probe data while we're trying to write probed.xml
+        probedata = copy.copy(probed)
+        attrs = dict(name=client, timestamp=str(int(probedata.timestamp)))
+        if parent is None:
+            ctag = lxml.etree.Element('Client', **attrs)
+        else:
+            ctag = lxml.etree.SubElement(parent, 'Client', **attrs)
+        for probe in sorted(probedata):
+            try:
+                lxml.etree.SubElement(
+                    ctag, 'Probe', name=probe,
+                    value=probedata[probe].decode('utf-8'))
+            except AttributeError:
+                lxml.etree.SubElement(
+                    ctag, 'Probe', name=probe,
+                    value=probedata[probe])
+        for group in sorted(self._groupcache.get(client, [])):
+            lxml.etree.SubElement(ctag, "Group", name=group)
+        return ctag
+
     def commit(self):
         """ Write received probe data to probed.xml """
         top = lxml.etree.Element("Probed")
         for client, probed in sorted(self._datacache.items()):
-            # make a copy of probe data for this client in case it
-            # submits probe data while we're trying to write
-            # probed.xml
-            probedata = copy.copy(probed)
-            ctag = \
-                lxml.etree.SubElement(top, 'Client', name=client,
-                                      timestamp=str(int(probedata.timestamp)))
-            for probe in sorted(probedata):
-                try:
-                    lxml.etree.SubElement(
-                        ctag, 'Probe', name=probe,
-                        value=self._datacache[client][probe].decode('utf-8'))
-                except AttributeError:
-                    lxml.etree.SubElement(
-                        ctag, 'Probe', name=probe,
-                        value=self._datacache[client][probe])
-            for group in sorted(self._groupcache[client]):
-                lxml.etree.SubElement(ctag, "Group", name=group)
+            self._get_client_element(client, probed, parent=top)
         try:
             top.getroottree().write(self._fname,
                                     xml_declaration=False,
@@ -291,6 +354,190 @@ class XMLProbeStore(ProbeStore):
             self.core.metadata_cache.expire(hostname)
 
 
+class JournalProbeStore(XMLProbeStore):
+    """ Caching abstraction layer between ``probed.xml`` and the
+    Probes plugin that writes only the data of clients that have
+    reported probe data since the last commit.  That data is appended
+    to a journal, ``probed.xml.journal``, which is merged into
+    ``probed.xml`` once it holds ``[probes] journal_size`` records,
+    and when the server shuts down. """
+
+    def __init__(self, core, datadir):
+        self._journal = os.path.join(datadir, 'probed.xml.journal')
+
+        #: The set of clients whose data has changed since the last
+        #: commit
+        self._dirty = set()
+
+        #: The number of records in the journal, as far as this
+        #: process knows
+        self._records = 0
+
+        # the journal is locked with lockf() to exclude other
+        # processes, but lockf() locks are held per process, so
+        # threads in this process also need a lock
+        self._lock = threading.Lock()
+        XMLProbeStore.__init__(self, core, datadir)
+
+    def _open_journal(self, exclusive=True):
+        """ Open and lock the journal.  The lock is released when the
+        returned file object is closed.
+
+        :param exclusive: Acquire an exclusive lock for writing,
+                          rather than a shared lock for reading
+        :type exclusive: bool
+        :returns: file object
+        """
+        journal = os.fdopen(os.open(self._journal,
+                                    os.O_RDWR | os.O_APPEND | os.O_CREAT),
+                            'rb+')
+        if exclusive:
+            fcntl.lockf(journal.fileno(), fcntl.LOCK_EX)
+        else:
+            fcntl.lockf(journal.fileno(), fcntl.LOCK_SH)
+        return journal
+
+    def _read_journal(self, journal):
+        """ Read all records in the journal.
+
+        :param journal: The open journal
+        :type journal: file
+        :returns: list of ``Client`` elements
+        """
+        rv = []
+        journal.seek(0)
+        for line in journal:
+            if not line.strip():
+                continue
+            try:
+                rv.append(lxml.etree.XML(line, parser=Bcfg2.Server.XMLParser))
+            except lxml.etree.XMLSyntaxError:
+                self.logger.warning("Skipping corrupt record in %s" %
+                                    self._journal)
+        return rv
+
+    def _load_data(self, _=None):
+        """ Load probe data from probed.xml and the journal """
+        with self._lock:
+            try:
+                journal = self._open_journal(exclusive=False)
+            except (IOError, OSError):
+                err = sys.exc_info()[1]
+                self.logger.error("Failed to open %s: %s" % (self._journal,
+                                                             err))
+                XMLProbeStore._load_data(self)
+                return
+            try:
+                if not os.path.exists(self._fname):
+                    XMLProbeStore.commit(self)
+                XMLProbeStore._load_data(self)
+                records = self._read_journal(journal)
+            finally:
+                journal.close()
+            for client in records:
+                self._load_client(client)
+            self._records = len(records)
+        if records:
+            self.core.metadata_cache.expire()
+
+    def set_groups(self, hostname, groups):
+        XMLProbeStore.set_groups(self, hostname, groups)
+        self._dirty.add(hostname)
+
+    def set_data(self, hostname, data):
+        XMLProbeStore.set_data(self, hostname, data)
+        self._dirty.add(hostname)
+
+    def commit(self):
+        """ Append the data of all clients that have reported probe
+        data since the last commit to the journal, and merge the
+        journal into probed.xml if it has grown too large. """
+        with self._lock:
+            dirty = self._dirty
+            self._dirty = set()
+            records = []
+            for client in sorted(dirty):
+                if client in self._datacache:
+                    records.append(lxml.etree.tostring(
+                        self._get_client_element(client,
+                                                 self._datacache[client])))
+            if not records:
+                return
+            try:
+                journal = self._open_journal()
+                try:
+                    # newlines in attribute values are escaped, so
+                    # each record is a single line
+                    journal.write(b"\n".join(records) + b"\n")
+                finally:
+                    journal.close()
+            except (IOError, OSError):
+                err = sys.exc_info()[1]
+                self.logger.error("Failed to write %s: %s" % (self._journal,
+                                                              err))
+                self._dirty.update(dirty)
+                return
+            self._records += len(records)
+        if self._records >= Bcfg2.Options.setup.probes_journal_size:
+            self.compact()
+
+    def compact(self):
+        """ Merge the journal into probed.xml and truncate it.  This
+        merges the records in probed.xml and the journal, rather than
+        the data in memory, so that records written by other server
+        processes are kept. """
+        with self._lock:
+            try:
+                journal = self._open_journal()
+            except (IOError, OSError):
+                err = sys.exc_info()[1]
+                self.logger.error("Failed to open %s: %s" % (self._journal,
+                                                             err))
+                return
+            try:
+                records = self._read_journal(journal)
+                if not records:
+                    self._records = 0
+                    return
+                top = lxml.etree.Element("Probed")
+                if os.path.exists(self._fname):
+                    try:
+                        top = lxml.etree.parse(
+                            self._fname,
+                            parser=Bcfg2.Server.XMLParser).getroot()
+                    except (IOError, lxml.etree.XMLSyntaxError):
+                        err = sys.exc_info()[1]
+                        self.logger.error("Failed to read %s, not merging "
+                                          "%s into it: %s" %
+                                          (self._fname, self._journal, err))
+                        return
+                clients = dict((c.get("name"), c)
+                               for c in top.getchildren())
+                for client in records:
+                    clients[client.get("name")] = client
+                top = lxml.etree.Element("Probed")
+                for name in sorted(clients.keys()):
+                    top.append(clients[name])
+                tmpfile = "%s.new" % self._fname
+                try:
+                    top.getroottree().write(tmpfile, xml_declaration=False,
+                                            pretty_print='true')
+                    os.rename(tmpfile, self._fname)
+                except (IOError, OSError):
+                    err = sys.exc_info()[1]
+                    self.logger.error("Failed to write %s: %s" %
+                                      (self._fname, err))
+                    return
+                journal.truncate(0)
+                self._records = 0
+            finally:
+                journal.close()
+
+    def shutdown(self):
+        self.commit()
+        self.compact()
+
+
 class ClientProbeDataSet(dict):
     """ dict of probe => [probe data] that records a timestamp for
     each host """
@@ -359,34 +606,44 @@ class ProbeData(str):  # pylint: disable=E0012,R0924
 
 class ProbeSet(Bcfg2.Server.Plugin.EntrySet):
     """ Handle universal and group- and host-specific probe files """
-    ignore = re.compile(r'^(\.#.*|.*~|\..*\.(tmp|sw[px])|probed\.xml)$')
+    ignore = re.compile(
+        r'^(\.#.*|.*~|\..*\.(tmp|sw[px])|probed\.xml(\.journal|\.new)?)$')
     probename = \
         re.compile(r'(.*/)?(?P<basename>\S+?)(\.(?P<mode>(?:G\d\d)|H)_\S+)?$')
     bangline = re.compile(r'^#!\s*(?P<interpreter>.*)$')
+    timeoutline = re.compile(r'^#\s*timeout:\s*(?P<timeout>\d+(\.\d+)?)\s*$')
     basename_is_regex = True
 
     def __init__(self, path, plugin_name):
         self.plugin_name = plugin_name
         Bcfg2.Server.Plugin.EntrySet.__init__(self, r'[0-9A-Za-z_\-]+', path,
                                               Bcfg2.Server.Plugin.SpecificData)
+        #: Cache of probe lists built by :func:`get_probe_data`.  Keys
+        #: are tuples of the names of the probe files sent to a client
+        #: and whether or not the client can handle unicode probes.
+        self._probecache = Bcfg2.Server.Cache.Cache("Probes", "probelist")
         Bcfg2.Server.FileMonitor.get_fam().AddMonitor(path, self)
 
     def HandleEvent(self, event):
         """ handle events on everything but probed.xml """
         if (event.filename != self.path and
-                not event.filename.endswith("probed.xml")):
+                not event.filename.endswith(("probed.xml",
+                                             "probed.xml.journal",
+                                             "probed.xml.new"))):
+            self._probecache.expire()
             return self.handle_event(event)
 
     def get_probe_data(self, metadata):
         """ Get an XML description of all probes for a client suitable
-        for sending to that client.
+        for sending to that client.  Probe lists are cached, so that
+        clients that get the same set of probe files share the
+        result.
 
         :param metadata: The client metadata to get probes for.
         :type metadata: Bcfg2.Server.Plugins.Metadata.ClientMetadata
         :returns: list of lxml.etree._Element objects, each of which
                   represents one probe.
         """
-        ret = []
         build = dict()
         candidates = self.get_matching(metadata)
         candidates.sort(key=operator.attrgetter('specific'))
@@ -396,12 +653,32 @@ class ProbeSet(Bcfg2.Server.Plugin.EntrySet):
             if pname not in build:
                 build[pname] = entry
 
+        use_unicode = bool(metadata.version_info and
+                           metadata.version_info > (1, 3, 1, '', 0))
+        key = (tuple(sorted(e.name for e in build.values())), use_unicode)
+        try:
+            probes = self._probecache[key]
+        except KeyError:
+            probes = self._build_probes(build, use_unicode)
+            self._probecache[key] = probes
+        return [copy.copy(p) for p in probes]
+
+    def _build_probes(self, build, use_unicode):
+        """ Build the XML description of the given probes.
+
+        :param build: dict of <probe name> => <probe file>
+        :type build: dict
+        :param use_unicode: Whether or not the client can handle
+                            unicode probes
+        :type use_unicode: bool
+        :returns: list of lxml.etree._Element objects
+        """
+        ret = []
         for (name, entry) in list(build.items()):
             probe = lxml.etree.Element('probe')
             probe.set('name', os.path.basename(name))
             probe.set('source', self.plugin_name)
-            if (metadata.version_info and
-                    metadata.version_info > (1, 3, 1, '', 0)):
+            if use_unicode:
                 try:
                     probe.text = entry.data.decode('utf-8')
                 except AttributeError:
@@ -414,11 +691,20 @@ class ProbeSet(Bcfg2.Server.Plugin.EntrySet):
                                       "probes. Skipping %s" %
                                       probe.get('name'))
                     continue
-            match = self.bangline.match(entry.data.split('\n')[0])
+            lines = entry.data.split('\n')
+            match = self.bangline.match(lines[0])
             if match:
                 probe.set('interpreter', match.group('interpreter'))
             else:
                 probe.set('interpreter', '/bin/sh')
+            # look for a timeout in the comments at the top of the probe
+            for line in lines[1:]:
+                if not line.startswith('#'):
+                    break
+                match = self.timeoutline.match(line)
+                if match:
+                    probe.set('timeout', match.group('timeout'))
+                    break
             ret.append(probe)
         return ret
 
@@ -438,6 +724,14 @@ class Probes(Bcfg2.Server.Plugin.Probing,
         Bcfg2.Options.BooleanOption(
             cf=('probes', 'use_database'), dest="probes_db",
             help="Use database capabilities of the Probes plugin"),
+        Bcfg2.Options.BooleanOption(
+            cf=('probes', 'journal'), dest="probes_journal",
+            help="Append probe data to a journal instead of rewriting "
+            "probed.xml for each client"),
+        Bcfg2.Options.Option(
+            cf=('probes', 'journal_size'), dest="probes_journal_size",
+            help="Merge the probe data journal into probed.xml after this "
+            "many records", default=1000, type=int),
         Bcfg2.Options.Option(
             cf=('probes', 'allowed_groups'), dest="probes_allowed_groups",
             help="Whitespace-separated list of group name regexps to which "
@@ -452,22 +746,66 @@ class Probes(Bcfg2.Server.Plugin.Probing,
         Bcfg2.Server.Plugin.DatabaseBacked.__init__(self, core)
 
         self.probes = ProbeSet(self.data, self.name)
+
+        #: Cache of the results most recently received from each
+        #: client.  Keys are hostnames, and values are dicts of <probe
+        #: name> => (<fingerprint>, <groups>, <data>).
+        self._fingerprints = Bcfg2.Server.Cache.Cache("Probes",
+                                                      "fingerprints")
         if self._use_db:
             self.probestore = DBProbeStore(core, self.data)
+        elif Bcfg2.Options.setup.probes_journal:
+            self.probestore = JournalProbeStore(core, self.data)
         else:
             self.probestore = XMLProbeStore(core, self.data)
 
+    def shutdown(self):
+        super(Probes, self).shutdown()
+        self.probestore.shutdown()
+
     @track_statistics()
     def GetProbes(self, metadata):
-        return self.probes.get_probe_data(metadata)
+        probes = self.probes.get_probe_data(metadata)
+        fingerprints = self._fingerprints.get(metadata.hostname, dict())
+        for probe in probes:
+            if probe.get("name") in fingerprints:
+                probe.set("fingerprint", fingerprints[probe.get("name")][0])
+        return probes
 
     def ReceiveData(self, client, datalist):
         cgroups = set()
         cdata = dict()
+        fingerprints = self._fingerprints.get(client.hostname, dict())
+        newprints = dict()
+        keep_groups = False
         for data in datalist:
-            groups, cdata[data.get("name")] = \
-                self.ReceiveDataItem(client, data)
+            name = data.get("name")
+            fingerprint = data.get("fingerprint")
+            if data.get("unchanged", "false").lower() == "true":
+                # the client has declared that the result has not
+                # changed since it was last sent
+                if (name in fingerprints and
+                        fingerprints[name][0] == fingerprint):
+                    groups, cdata[name] = fingerprints[name][1:]
+                else:
+                    self.logger.info(
+                        "Unknown result of probe %s from %s, keeping prior "
+                        "data" % (name, client.hostname))
+                    groups = []
+                    cdata[name] = \
+                        self.probestore.get_data(client.hostname).get(
+                            name, ProbeData(''))
+                    keep_groups = True
+            else:
+                groups, cdata[name] = self.ReceiveDataItem(client, data)
             cgroups.update(groups)
+            if fingerprint is not None:
+                newprints[name] = (fingerprint, groups, cdata[name])
+        if keep_groups:
+            # the groups set by a probe whose result is not known
+            # cannot be told apart from the others, so keep them all
+            cgroups.update(self.probestore.get_groups(client.hostname))
+        self._fingerprints[client.hostname] = newprints
         self.probestore.set_groups(client.hostname, list(cgroups))
         self.probestore.set_data(client.hostname, cdata)
         self.probestore.commit()
@@ -4,14 +4,19 @@ better. """
 
 import os
 import sys
+import codecs
+import itertools
 import socket
 import signal
 import logging
 import ssl
 import threading
 import time
+import Bcfg2.Server.Statistics
+from Bcfg2.Utils import Compressor, Decompressor, compress, \
+    content_encodings, negotiate_encoding
 from Bcfg2.Compat import xmlrpclib, SimpleXMLRPCServer, SocketServer, \
-    b64decode
+    BaseHTTPServer, b64decode, Queue, Full
 
 
 class XMLRPCACLCheckException(Exception):
@@ -21,6 +26,10 @@ class XMLRPCACLCheckException(Exception):
 class XMLRPCDispatcher(SimpleXMLRPCServer.SimpleXMLRPCDispatcher):
     """ An XML-RPC dispatcher. """
 
+    #: String responses longer than this many characters are
+    #: serialized and sent in pieces of this size
+    stream_chunk_size = 64 * 1024
+
     def __init__(self, allow_none, encoding):
         try:
             SimpleXMLRPCServer.SimpleXMLRPCDispatcher.__init__(self,
@@ -36,12 +45,34 @@ class XMLRPCDispatcher(SimpleXMLRPCServer.SimpleXMLRPCDispatcher):
 
     def _marshaled_dispatch(self, address, data):
         params, method = xmlrpclib.loads(data)
+        return b''.join(self._dispatch_request(address, params,
+                                               method)).decode('utf-8')
+
+    def _dispatch_request(self, address, params, method):
+        """ Check the ACLs for and call a parsed XML-RPC request.
+
+        :param address: The address of the client
+        :type address: tuple
+        :param params: The parameters of the request
+        :type params: tuple
+        :param method: The name of the method to call
+        :type method: string
+        :returns: iterator of bytes - The UTF-8 encoded XML-RPC
+                  response.  Large string responses are serialized
+                  lazily, one piece at a time, by
+                  :func:`_stream_response`; all other responses are
+                  produced in one piece.
+        :raises: :class:`XMLRPCACLCheckException`
+        """
         if not self.instance.check_acls(address, method):
             raise XMLRPCACLCheckException
         try:
             if '.' not in method:
                 params = (address, ) + params
             response = self.instance._dispatch(method, params, self.funcs)
+            if (isinstance(response, (str, bytes)) and
+                    len(response) > self.stream_chunk_size):
+                return self._stream_response(response)
             # py3k compatibility
             if type(response) not in [bool, str, list, dict, set, type(None)]:
                 response = (response.decode('utf-8'), )
@@ -65,7 +96,38 @@ class XMLRPCDispatcher(SimpleXMLRPCServer.SimpleXMLRPCDispatcher):
                 xmlrpclib.Fault(1, "%s:%s" % (err[0].__name__, err[1])),
                 methodresponse=True, allow_none=self.allow_none,
                 encoding=self.encoding)
-        return raw_response
+        return iter([raw_response.encode('utf-8')])
+
+    def _stream_response(self, response):
+        """ Serialize a response that consists of a single large
+        string, such as a client configuration, in pieces of
+        :attr:`stream_chunk_size` characters.  This produces the same
+        document as :func:`xmlrpclib.dumps`, but the escaped and
+        encoded copies of the string are never held in memory all at
+        once.
+
+        :param response: The string to return
+        :type response: str or UTF-8 encoded bytes
+        :returns: generator of bytes
+        """
+        if self.encoding in (None, 'utf-8'):
+            header = "<?xml version='1.0'?>\n"
+        else:
+            header = "<?xml version='1.0' encoding='%s'?>\n" % self.encoding
+        yield (header + "<methodResponse>\n<params>\n<param>\n"
+               "<value><string>").encode('utf-8')
+        if isinstance(response, bytes):
+            decoder = codecs.getincrementaldecoder('utf-8')()
+        else:
+            decoder = None
+        for i in range(0, len(response), self.stream_chunk_size):
+            chunk = response[i:i + self.stream_chunk_size]
+            if decoder is not None:
+                chunk = decoder.decode(chunk,
+                                       final=i + len(chunk) >= len(response))
+            yield xmlrpclib.escape(chunk).encode('utf-8')
+        yield ("</string></value>\n</param>\n</params>\n"
+               "</methodResponse>\n").encode('utf-8')
 
 
 class SSLServer(SocketServer.TCPServer, object):
@@ -190,14 +252,49 @@ class SSLServer(SocketServer.TCPServer, object):
 class XMLRPCRequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
     """ XML-RPC request handler.
 
-    Adds support for HTTP authentication.
+    Adds support for HTTP authentication.  Connections are kept open
+    (HTTP/1.1 keep-alive) so that clients can send several requests
+    over one connection, and so only perform one TLS handshake.  The
+    server's timeout applies while a request is read and answered;
+    between requests, the worker only waits
+    :attr:`WorkerPoolMixIn.idle_timeout` seconds for the next one
+    before closing the connection.
     """
 
+    protocol_version = "HTTP/1.1"
+
+    #: Responses smaller than this many bytes are not compressed
+    encode_threshold = 1400
+
+    #: The request body is read and parsed in pieces of this many bytes
+    read_chunk_size = 64 * 1024
+
     def __init__(self, *args, **kwargs):
         self.logger = logging.getLogger(self.__class__.__name__)
+        #: The number of requests received on this connection
+        self.requests = 0
         SimpleXMLRPCServer.SimpleXMLRPCRequestHandler.__init__(self, *args,
                                                                **kwargs)
 
+    def log_error(self, format, *args):  # pylint: disable=W0622
+        """ Idle keep-alive connections time out as a matter of
+        course, so that is only logged at debug level. """
+        if self.requests and format.startswith("Request timed out"):
+            self.logger.debug("Closing idle connection from %s" %
+                              self.client_address[0])
+        else:
+            SimpleXMLRPCServer.SimpleXMLRPCRequestHandler.log_error(
+                self, format, *args)
+
+    def handle_one_request(self):
+        if self.requests:
+            # the worker waits only briefly for the next request on a
+            # kept-alive connection, so that idle clients do not hold
+            # it
+            self.request.settimeout(self.server.idle_timeout)
+        SimpleXMLRPCServer.SimpleXMLRPCRequestHandler.handle_one_request(
+            self)
+
     def authenticate(self):
         try:
             header = self.headers['Authorization']
@@ -229,6 +326,9 @@ class XMLRPCRequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
 
         Optionally check HTTP authentication when parsing.
         """
+        # the request line has been read, so the rest of the request
+        # gets the full I/O timeout
+        self.request.settimeout(self.server.timeout)
         if not SimpleXMLRPCServer.SimpleXMLRPCRequestHandler.parse_request(self):
             return False
         try:
@@ -242,32 +342,178 @@ class XMLRPCRequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
             return False
         return True
 
-    def do_POST(self):
+    def _add_compression_stats(self, action, encoding, elapsed, ratio):
+        """ Record the time taken to compress or decompress data, and
+        the compression ratio (uncompressed size / compressed size),
+        in :mod:`Bcfg2.Server.Statistics`. """
+        name = self.server.__class__.__name__
+        Bcfg2.Server.Statistics.stats.add_value(
+            "%s:%s:%s" % (name, action, encoding), elapsed)
+        Bcfg2.Server.Statistics.stats.add_value(
+            "%s:%s_ratio:%s" % (name, action, encoding), ratio, unit="")
+
+    def _compress(self, data, encoding):
+        """ Compress a response with the given content coding """
+        start = time.time()
+        rv = compress(data, encoding)
+        self._add_compression_stats("compress", encoding, time.time() - start,
+                                    float(len(data)) / max(len(rv), 1))
+        return rv
+
+    def _read_request(self):
+        """ Read the request body and parse it as it arrives, rather
+        than reading all of it before parsing it.  The body is
+        decompressed according to its ``Content-Encoding`` header as
+        it is read; unsupported content codings are rejected with HTTP
+        415.
+
+        :returns: tuple of (<params>, <method name>), or None if an
+                  error response has been sent
+        """
+        encoding = self.headers.get("Content-Encoding",
+                                    "identity").strip().lower()
+        decompressor = None
+        if encoding != "identity":
+            try:
+                decompressor = Decompressor(encoding)
+            except ValueError:
+                self.logger.error("Failed to decode request from %s: %s" %
+                                  (self.client_address[0], sys.exc_info()[1]))
+                self.send_error(415, self.responses[415][0])
+                return None
+        parser, unmarshaller = xmlrpclib.getparser()
+        size_remaining = int(self.headers["content-length"])
+        size = 0
+        elapsed = 0.0
         try:
-            max_chunk_size = 10 * 1024 * 1024
-            size_remaining = int(self.headers["content-length"])
-            L = []
             while size_remaining:
-                chunk_size = min(size_remaining, max_chunk_size)
-                chunk = self.rfile.read(chunk_size).decode('utf-8')
+                chunk = self.rfile.read(min(size_remaining,
+                                            self.read_chunk_size))
                 if not chunk:
                     break
-                L.append(chunk)
-                size_remaining -= len(L[-1])
-            data = ''.join(L)
-            if data is None:
-                return  # response has been sent
+                size_remaining -= len(chunk)
+                if decompressor is not None:
+                    start = time.time()
+                    chunk = decompressor.decompress(chunk)
+                    elapsed += time.time() - start
+                    size += len(chunk)
+                parser.feed(chunk)
+            if decompressor is not None:
+                start = time.time()
+                chunk = decompressor.flush()
+                elapsed += time.time() - start
+                size += len(chunk)
+                parser.feed(chunk)
+        except ValueError:
+            self.logger.error("Failed to decode request from %s: %s" %
+                              (self.client_address[0], sys.exc_info()[1]))
+            self.send_error(415, self.responses[415][0])
+            return None
+        if decompressor is not None:
+            self._add_compression_stats(
+                "decompress", encoding, elapsed,
+                float(size) / max(int(self.headers["content-length"]), 1))
+        parser.close()
+        return unmarshaller.close(), unmarshaller.getmethodname()
+
+    def _write(self, data):
+        """ Write part of a response, retrying on SSL3_WRITE_PENDING """
+        failcount = 0
+        while True:
+            try:
+                # If we hit SSL3_WRITE_PENDING here try to resend.
+                self.wfile.write(data)
+                break
+            except ssl.SSLError:
+                e = sys.exc_info()[1]
+                if str(e).find("SSL3_WRITE_PENDING") < 0:
+                    raise
+                self.logger.error("SSL3_WRITE_PENDING")
+                failcount += 1
+                if failcount < 5:
+                    continue
+                raise
 
-            response = self.server._marshaled_dispatch(self.client_address,
-                                                       data)
-            if sys.hexversion >= 0x03000000:
-                response = response.encode('utf-8')
+    def _write_chunked(self, response, encoding):
+        """ Write a response body with chunked transfer encoding,
+        compressing it as it is written if a content coding is given.
+
+        :param response: The response body
+        :type response: iterator of bytes
+        :param encoding: The content coding to compress the response
+                         with, or None
+        :type encoding: string
+        """
+        compressor = None
+        if encoding is not None:
+            compressor = Compressor(encoding)
+        size = 0
+        compressed = 0
+        elapsed = 0.0
+        for chunk in itertools.chain(response, [None]):
+            if compressor is not None:
+                start = time.time()
+                if chunk is None:
+                    chunk = compressor.flush()
+                else:
+                    size += len(chunk)
+                    chunk = compressor.compress(chunk)
+                elapsed += time.time() - start
+                compressed += len(chunk)
+            # an empty chunk would end the response
+            if chunk:
+                self._write(("%x\r\n" % len(chunk)).encode('ascii'))
+                self._write(chunk)
+                self._write(b"\r\n")
+        self._write(b"0\r\n\r\n")
+        if compressor is not None:
+            self._add_compression_stats("compress", encoding, elapsed,
+                                        float(size) / max(compressed, 1))
+
+    def do_POST(self):
+        self.requests += 1
+        # the number of values of 1 is the number of TLS handshakes
+        # saved by keeping connections open
+        Bcfg2.Server.Statistics.stats.add_value(
+            "%s:connection_reused" % self.server.__class__.__name__,
+            int(self.requests > 1), unit="")
+        try:
+            request = self._read_request()
+            if request is None:
+                return  # response has been sent
+            params, method = request
+
+            response = self.server._dispatch_request(self.client_address,
+                                                     params, method)
+            # large responses are produced in several pieces.  these
+            # are sent as they are produced if the client supports
+            # chunked transfer encoding; otherwise, and for small
+            # responses, the whole response is sent at once.
+            first = next(response, b'')
+            second = next(response, None)
+            chunked = second is not None
+            if chunked:
+                response = itertools.chain([first, second], response)
+                if self.request_version == "HTTP/1.0":
+                    response = b''.join(response)
+                    chunked = False
+            else:
+                response = first
+            encoding = None
+            if chunked or len(response) > self.encode_threshold:
+                encoding = negotiate_encoding(
+                    self.headers.get("Accept-Encoding"))
+            if encoding is not None and not chunked:
+                response = self._compress(response, encoding)
         except XMLRPCACLCheckException:
             self.send_error(401, self.responses[401][0])
             self.end_headers()
         except:  # pylint: disable=W0702
             self.logger.error("Unexpected dispatch error for %s: %s" %
                               (self.client_address, sys.exc_info()[1]))
+            # the request may not have been read completely, so the
+            # connection cannot be reused
+            self.close_connection = True
             try:
                 self.send_response(500)
                 self.send_header("Content-length", "0")
@@ -279,28 +525,27 @@ class XMLRPCRequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
                 raise
         else:
             # got a valid XML RPC response
-            client_address = self.request.getpeername()
             try:
                 self.send_response(200)
                 self.send_header("Content-type", "text/xml")
-                self.send_header("Content-length", str(len(response)))
-                self.end_headers()
-                failcount = 0
-                while True:
-                    try:
-                        # If we hit SSL3_WRITE_PENDING here try to resend.
-                        self.wfile.write(response)
-                        break
-                    except ssl.SSLError:
-                        e = sys.exc_info()[1]
-                        if str(e).find("SSL3_WRITE_PENDING") < 0:
-                            raise
-                        self.logger.error("SSL3_WRITE_PENDING")
-                        failcount += 1
-                        if failcount < 5:
-                            continue
-                        raise
+                if encoding is not None:
+                    self.send_header("Content-Encoding", encoding)
+                # tell the client which content codings it can use for
+                # requests (RFC 7694)
+                self.send_header("Accept-Encoding",
+                                 ", ".join(content_encodings))
+                if self.server.saturated():
+                    self.send_header("Connection", "close")
+                if chunked:
+                    self.send_header("Transfer-Encoding", "chunked")
+                    self.end_headers()
+                    self._write_chunked(response, encoding)
+                else:
+                    self.send_header("Content-length", str(len(response)))
+                    self.end_headers()
+                    self._write(response)
             except socket.error:
+                self.close_connection = True
                 err = sys.exc_info()[1]
                 if isinstance(err, socket.timeout):
                     self.logger.warning("Connection timed out for %s" %
@@ -315,10 +560,13 @@ class XMLRPCRequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
                     self.logger.warning("Socket error sending response to %s: "
                                         "%s" % (self.client_address[0], err))
             except ssl.SSLError:
+                self.close_connection = True
                 err = sys.exc_info()[1]
                 self.logger.warning("SSLError handling client %s: %s" %
                                     (self.client_address[0], err))
             except:
+                # a partially sent response cannot be completed
+                self.close_connection = True
                 etype, err = sys.exc_info()[:2]
                 self.logger.error("Unknown error sending response to %s: "
                                   "%s (%s)" %
@@ -334,14 +582,176 @@ class XMLRPCRequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
             self.logger.warning("Error closing connection: %s" % err)
 
 
-class XMLRPCServer(SocketServer.ThreadingMixIn, SSLServer,
-                   XMLRPCDispatcher, object):
+class XMLRPCRejectHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Request handler used when all of the workers of a
+    :class:`WorkerPoolMixIn` server are busy.  The request is read and
+    discarded, so that the client sees the response rather than a
+    reset connection, and the client is told to try again later with
+    HTTP 503. """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):  # pylint: disable=C0103
+        """ Discard the request and send HTTP 503 """
+        size_remaining = int(self.headers.get("content-length", 0))
+        while size_remaining > 0:
+            chunk = self.rfile.read(min(size_remaining, 64 * 1024))
+            if not chunk:
+                break
+            size_remaining -= len(chunk)
+        self.send_response(503)
+        self.send_header("Retry-After", str(self.server.retry_after))
+        self.send_header("Content-Length", "0")
+        self.send_header("Connection", "close")
+        self.end_headers()
+
+    def log_message(self, format, *args):  # pylint: disable=W0622
+        """ Rejected requests are counted, not logged """
+        pass
+
+
+class WorkerPoolMixIn(object):
+    """ Mix-in class that handles requests with a fixed number of
+    worker threads, rather than with a new thread for each request
+    like :class:`SocketServer.ThreadingMixIn`.  Accepted requests wait
+    in a queue of at most :attr:`queue_size` requests for a free
+    worker; if the queue is full, the request is rejected with HTTP
+    503 and a ``Retry-After`` header, so that a herd of clients slows
+    the server down gracefully instead of overwhelming it.
+
+    The number of active, queued, and rejected requests is recorded in
+    :mod:`Bcfg2.Server.Statistics` as each request is accepted. """
+
+    #: The number of worker threads
+    workers = 32
+
+    #: The maximum number of accepted requests waiting for a worker
+    queue_size = 128
+
+    #: The number of seconds rejected clients are asked to wait
+    #: before retrying
+    retry_after = 5
+
+    #: The number of seconds a worker waits for the next request on a
+    #: kept-alive connection before closing it
+    idle_timeout = 1
+
+    def _start_workers(self):
+        """ Start the worker threads and the thread that rejects
+        requests when the queue is full.  This must be called after
+        the server is daemonized. """
+        self._requests = Queue(self.queue_size)
+        self._rejects = Queue(self.queue_size)
+        self._active_lock = threading.Lock()
+
+        #: The number of requests currently being handled
+        self.active = 0
+
+        #: The number of requests rejected since the server started
+        self.rejected = 0
+
+        self._workers = []
+        for i in range(self.workers):
+            self._workers.append(
+                threading.Thread(name="%sWorker%d" %
+                                 (self.__class__.__name__, i),
+                                 target=self._worker_thread))
+        self._workers.append(
+            threading.Thread(name="%sRejecter" % self.__class__.__name__,
+                             target=self._reject_thread))
+        for thread in self._workers:
+            thread.daemon = True
+            thread.start()
+
+    def _stop_workers(self):
+        """ Stop the worker threads once the queued requests have been
+        handled """
+        if not getattr(self, "_workers", None):
+            return
+        for _ in range(self.workers):
+            self._requests.put(None)
+        self._rejects.put(None)
+        deadline = time.time() + self.timeout
+        for thread in self._workers:
+            thread.join(max(0, deadline - time.time()))
+        self._workers = []
+
+    def queued(self):
+        """ The number of accepted requests waiting for a worker """
+        return self._requests.qsize()
+
+    def saturated(self):
+        """ Whether requests are waiting for a worker.  Keep-alive
+        connections are closed after each request while the server
+        is saturated, so that idle clients do not hold workers. """
+        return not self._requests.empty()
+
+    def process_request(self, request, client_address):
+        """ Queue a request for a worker, or reject it if the queue
+        is full """
+        name = self.__class__.__name__
+        Bcfg2.Server.Statistics.stats.add_value("%s:queued" % name,
+                                                self.queued(), unit="")
+        try:
+            self._requests.put_nowait((request, client_address))
+        except Full:
+            self.rejected += 1
+            Bcfg2.Server.Statistics.stats.add_value("%s:rejected" % name, 1,
+                                                    unit="")
+            try:
+                self._rejects.put_nowait((request, client_address))
+            except Full:
+                self.shutdown_request(request)
+        else:
+            Bcfg2.Server.Statistics.stats.add_value("%s:rejected" % name, 0,
+                                                    unit="")
+
+    def _worker_thread(self):
+        """ Handle queued requests until a None is queued """
+        while True:
+            item = self._requests.get()
+            if item is None:
+                break
+            request, client_address = item
+            with self._active_lock:
+                self.active += 1
+                active = self.active
+            Bcfg2.Server.Statistics.stats.add_value(
+                "%s:active" % self.__class__.__name__, active, unit="")
+            try:
+                self.finish_request(request, client_address)
+            except:  # pylint: disable=W0702
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+                with self._active_lock:
+                    self.active -= 1
+
+    def _reject_thread(self):
+        """ Reject requests that did not fit in the queue until a None
+        is queued """
+        while True:
+            item = self._rejects.get()
+            if item is None:
+                break
+            request, client_address = item
+            try:
+                XMLRPCRejectHandler(request, client_address, self)
+            except:  # pylint: disable=W0702
+                pass
+            finally:
+                self.shutdown_request(request)
+
+
+class XMLRPCServer(WorkerPoolMixIn, SSLServer, XMLRPCDispatcher, object):
     """ Component XMLRPCServer. """
 
     def __init__(self, listen_all, server_address, RequestHandlerClass=None,
                  keyfile=None, certfile=None, ca=None,
                  protocol='xmlrpc/tls', timeout=10, logRequests=False,
-                 register=True, allow_none=True, encoding=None):
+                 register=True, allow_none=True, encoding=None,
+                 workers=None, queue_size=None, retry_after=None,
+                 idle_timeout=None):
         """
         :param listen_all: Listen on all interfaces
         :type listen_all: bool
@@ -360,6 +770,17 @@ class XMLRPCServer(SocketServer.ThreadingMixIn, SSLServer,
         :param allow_none: Allow None values in XML-RPC
         :type allow_none: bool
         :param encoding: Encoding to use for XML-RPC
+        :param workers: The number of threads that handle requests
+        :type workers: int
+        :param queue_size: The maximum number of requests waiting for
+                           a worker before requests are rejected
+        :type queue_size: int
+        :param retry_after: The number of seconds rejected clients are
+                            asked to wait before retrying
+        :type retry_after: int
+        :param idle_timeout: The number of seconds to wait for the
+                             next request on a kept-alive connection
+        :type idle_timeout: float
         """
 
         XMLRPCDispatcher.__init__(self, allow_none, encoding)
@@ -380,6 +801,14 @@ class XMLRPCServer(SocketServer.ThreadingMixIn, SSLServer,
                            keyfile=keyfile,
                            certfile=certfile,
                            protocol=protocol)
+        if workers is not None:
+            self.workers = workers
+        if queue_size is not None:
+            self.queue_size = queue_size
+        if retry_after is not None:
+            self.retry_after = retry_after
+        if idle_timeout is not None:
+            self.idle_timeout = idle_timeout
         self.logRequests = logRequests
         self.serve = False
         self.register = register
@@ -402,6 +831,7 @@ class XMLRPCServer(SocketServer.ThreadingMixIn, SSLServer,
 
     def server_close(self):
         SSLServer.server_close(self)
+        self._stop_workers()
         self.logger.info("server_close()")
 
     def _get_require_auth(self):
@@ -439,6 +869,7 @@ class XMLRPCServer(SocketServer.ThreadingMixIn, SSLServer,
             threading.Thread(name="%sThread" % self.__class__.__name__,
                              target=self._tasks_thread)
         self.task_thread.start()
+        self._start_workers()
         self.logger.info("serve_forever() [start]")
         signal.signal(signal.SIGINT, self._handle_shutdown_signal)
         signal.signal(signal.SIGTERM, self._handle_shutdown_signal)
@@ -0,0 +1,207 @@
+""" ``Bcfg2.Server.Snapshot`` keeps a snapshot of parsed repository
+data on disk, so that a restarted server can reuse the results of
+parsing files that have not changed since it last ran instead of
+parsing them again.
+
+Each item in the snapshot is stored with the signatures (modification
+time, inode, and size) of the files it was built from, and is only
+returned by :func:`get` if all of those files still have the same
+signatures.  For instance:
+
+.. code-block:: python
+
+    data = Bcfg2.Server.Snapshot.get(("Foo", self.name))
+    if data is None:
+        signatures = Bcfg2.Server.Snapshot.signatures([self.name])
+        data = self.parse(self.name)
+        Bcfg2.Server.Snapshot.store(("Foo", self.name), signatures, data)
+
+Items must be picklable.  The snapshot is only used if the
+``snapshot`` option in the ``[server]`` section of ``bcfg2.conf`` is
+set; otherwise, :func:`get` always returns None and :func:`store`
+does nothing.
+"""
+
+import os
+import sys
+import logging
+import tempfile
+import threading
+import Bcfg2.Options
+from Bcfg2.Compat import cPickle
+from Bcfg2.version import __version__
+
+LOGGER = logging.getLogger(__name__)
+
+#: The file the snapshot is loaded from and saved to, or None if the
+#: snapshot is disabled.
+_path = None
+
+#: dict of <key> => (<dict of filename => signature>, <data>)
+_items = dict()
+
+#: Set of keys that have been used (i.e., read or stored) since the
+#: snapshot was loaded.  Only these are saved, so items for files
+#: that no longer exist do not accumulate.
+_used = set()
+
+#: Whether the snapshot has changed since it was loaded
+_dirty = False
+
+_lock = threading.Lock()
+
+
+def enabled():
+    """ Whether or not the snapshot is in use.  Callers can check this
+    to avoid preparing data for :func:`store` that would be discarded.
+
+    :returns: bool
+    """
+    return _path is not None
+
+
+def signature(path):
+    """ Get the signature of a file, which is used to determine
+    whether or not the file has changed.
+
+    :param path: The path to the file
+    :type path: string
+    :returns: tuple of (<mtime>, <inode>, <size>), or None if the file
+              does not exist
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime, stat.st_ino, stat.st_size)
+
+
+def load(path=None):
+    """ Load the snapshot from disk.  If the snapshot cannot be read,
+    or was written by a different version of Bcfg2, an empty snapshot
+    is used instead.
+
+    :param path: The snapshot file.  Defaults to the ``snapshot``
+                 option.
+    :type path: string
+    :returns: None
+    """
+    global _path, _items, _dirty  # pylint: disable=W0603
+    if path is None:
+        path = Bcfg2.Options.setup.snapshot
+    with _lock:
+        _path = path
+        _items = dict()
+        _used.clear()
+        _dirty = False
+        if path is None or not os.path.exists(path):
+            return
+        try:
+            with open(path, 'rb') as snapfile:
+                version, items = cPickle.load(snapfile)
+        except:  # pylint: disable=W0702
+            LOGGER.warning("Failed to load snapshot from %s, ignoring it" %
+                           path)
+            return
+        if version != __version__:
+            LOGGER.info("Snapshot %s was written by Bcfg2 %s, ignoring it" %
+                        (path, version))
+            return
+        _items = items
+        LOGGER.debug("Loaded %d items from snapshot %s" % (len(items), path))
+
+
+def save():
+    """ Write the snapshot to disk if it has changed.  The snapshot is
+    written to a temporary file that is then renamed into place, so a
+    server that starts while the snapshot is being saved never reads
+    a partially written snapshot.
+
+    :returns: None
+    """
+    global _dirty  # pylint: disable=W0603
+    with _lock:
+        if _path is None or not (_dirty or set(_items) - _used):
+            return
+        items = dict((k, v) for k, v in _items.items() if k in _used)
+        try:
+            data = cPickle.dumps((__version__, items),
+                                 cPickle.HIGHEST_PROTOCOL)
+        except:  # pylint: disable=W0702
+            LOGGER.error("Failed to pickle snapshot: %s" % sys.exc_info()[1])
+            return
+        _dirty = False
+    try:
+        (fd, tmpfile) = tempfile.mkstemp(dir=os.path.dirname(_path),
+                                         prefix=".snapshot")
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+        os.rename(tmpfile, _path)
+    except (IOError, OSError):
+        LOGGER.error("Failed to save snapshot to %s: %s" %
+                     (_path, sys.exc_info()[1]))
+        return
+    LOGGER.debug("Saved %d items to snapshot %s" % (len(items), _path))
+
+
+def get(key):
+    """ Get an item from the snapshot.
+
+    :param key: The key of the item
+    :type key: hashable
+    :returns: The item, or None if it is not in the snapshot or if any
+              of the files it was built from have changed
+    """
+    with _lock:
+        if key not in _items:
+            return None
+        signatures, data = _items[key]
+        for path, sig in signatures.items():
+            if signature(path) != sig:
+                return None
+        _used.add(key)
+        return data
+
+
+def signatures(paths):
+    """ Get the signatures of a set of files for :func:`store`.
+
+    :param paths: The files (and directories) to get signatures of
+    :type paths: list of strings
+    :returns: dict of <path> => <signature>
+    """
+    return dict((path, signature(path)) for path in paths)
+
+
+def store(key, sigs, data):
+    """ Add an item to the snapshot.  The signatures of the files the
+    item was built from must be taken *before* the files are read;
+    if any of the files have changed by the time the item is stored,
+    the item may not reflect their current contents, so it is not
+    stored.
+
+    :param key: The key of the item
+    :type key: hashable
+    :param sigs: The signatures of the files (and directories) the
+                 item was built from, as returned by
+                 :func:`signatures`.  Files that do not exist are
+                 recorded as missing, so the item is discarded if
+                 they are created.
+    :type sigs: dict
+    :param data: The item to store.  It must be picklable.
+    :returns: None
+    """
+    global _dirty  # pylint: disable=W0603
+    if _path is None:
+        return
+    for path, sig in sigs.items():
+        if signature(path) != sig:
+            LOGGER.debug("Not storing %s in snapshot: %s changed while it "
+                         "was being read" % (key, path))
+            return
+    with _lock:
+        _items[key] = (dict(sigs), data)
+        _used.add(key)
+        _dirty = True
@@ -1,29 +1,202 @@
 """ Module for tracking execution time statistics from the Bcfg2
 server core.  This data is exposed by
-:func:`Bcfg2.Server.Core.BaseCore.get_statistics`."""
+:func:`Bcfg2.Server.Core.BaseCore.get_statistics` and, with
+percentiles, by :func:`Bcfg2.Server.Core.BaseCore.get_histograms`."""
 
+import math
 import time
+from collections import deque
 from Bcfg2.Compat import wraps
 
 
+class Histogram(object):
+    """ A mergeable streaming histogram with logarithmically sized
+    buckets.  Each bucket covers values within a fixed ratio of each
+    other, so percentiles computed from the histogram have a bounded
+    relative error (:attr:`relative_accuracy`) regardless of the
+    distribution of the values.  Histograms from different processes
+    can be combined exactly with :func:`merge`. """
+
+    #: The maximum relative error of percentiles computed from the
+    #: histogram.
+    relative_accuracy = 0.01
+
+    #: Values smaller than this are counted as zero.
+    min_value = 1e-9
+
+    _gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+    _log_gamma = math.log(_gamma)
+
+    def __init__(self):
+        #: Dict of bucket index => number of values in that bucket.
+        #: Bucket ``i`` holds values in ``(gamma ** (i - 1), gamma **
+        #: i]``.
+        self.buckets = dict()
+
+        #: Number of values smaller than :attr:`min_value`
+        self.zero = 0
+
+        #: Total number of values
+        self.count = 0
+
+        #: Sum of all values
+        self.sum = 0.0
+
+        #: Smallest value, or None if the histogram is empty
+        self.min = None
+
+        #: Largest value, or None if the histogram is empty
+        self.max = None
+
+    def add_value(self, value):
+        """ Add a value to the histogram.
+
+        :param value: The value to add
+        :type value: int or float
+        """
+        value = float(value)
+        if value < self.min_value:
+            self.zero += 1
+        else:
+            idx = int(math.ceil(math.log(value) / self._log_gamma))
+            self.buckets[idx] = self.buckets.get(idx, 0) + 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """ Add all values from another histogram to this one.
+
+        :param other: The histogram to merge into this one
+        :type other: Bcfg2.Server.Statistics.Histogram
+        :returns: Bcfg2.Server.Statistics.Histogram - ``self``
+        """
+        for idx, count in other.buckets.items():
+            self.buckets[idx] = self.buckets.get(idx, 0) + count
+        self.zero += other.zero
+        self.count += other.count
+        self.sum += other.sum
+        if other.min is not None and (self.min is None or
+                                      other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or
+                                      other.max > self.max):
+            self.max = other.max
+        return self
+
+    def percentile(self, pct):
+        """ Estimate the given percentile of the values in the
+        histogram.
+
+        :param pct: The percentile to get, from 0 to 100
+        :type pct: int or float
+        :returns: float, or None if the histogram is empty
+        """
+        if not self.count:
+            return None
+        rank = max(1, int(math.ceil(self.count * pct / 100.0)))
+        if rank >= self.count:
+            return self.max
+        seen = self.zero
+        if seen >= rank:
+            return self.min
+        for idx in sorted(self.buckets.keys()):
+            seen += self.buckets[idx]
+            if seen >= rank:
+                estimate = 2 * self._gamma ** idx / (self._gamma + 1)
+                return min(max(estimate, self.min), self.max)
+        return self.max
+
+    def get_data(self):
+        """ Get the histogram as a dict of XML-RPC-safe values, for
+        transport between processes.  The inverse of
+        :func:`from_data`.
+
+        :returns: dict
+        """
+        return dict(count=self.count, sum=self.sum, zero=self.zero,
+                    min=self.min or 0.0, max=self.max or 0.0,
+                    buckets=[[idx, count]
+                             for idx, count in sorted(self.buckets.items())])
+
+    @classmethod
+    def from_data(cls, data):
+        """ Create a histogram from data returned by :func:`get_data`.
+
+        :param data: The histogram data
+        :type data: dict
+        :returns: Bcfg2.Server.Statistics.Histogram
+        """
+        rv = cls()
+        rv.count = data['count']
+        rv.sum = data['sum']
+        rv.zero = data['zero']
+        if rv.count:
+            rv.min = data['min']
+            rv.max = data['max']
+        rv.buckets = dict((idx, count) for idx, count in data['buckets'])
+        return rv
+
+    def __repr__(self):
+        return "%s(count=%s, p50=%s, p95=%s, p99=%s)" % (
+            self.__class__.__name__, self.count, self.percentile(50),
+            self.percentile(95), self.percentile(99))
+
+
 class Statistic(object):
     """ A single named statistic, tracking minimum, maximum, and
-    average execution time, and number of invocations. """
+    average execution time, and number of invocations.  A
+    :class:`Histogram` of all values is also kept, along with
+    per-minute histograms from which histograms over the last
+    :attr:`windows` minutes can be built. """
 
-    def __init__(self, name, initial_value):
+    #: The sliding windows, in minutes, that are kept for each
+    #: statistic.
+    windows = (1, 5, 15)
+
+    def __init__(self, name, initial_value, unit="seconds"):
         """
         :param name: The name of this statistic
         :type name: string
         :param initial_value: The initial value to be added to this
                               statistic
         :type initial_value: int or float
+        :param unit: The unit of the values of this statistic, or an
+                     empty string if they are counts or ratios
+        :type unit: string
         """
         self.name = name
+
+        #: The unit of the values of this statistic
+        self.unit = unit
         self.min = float(initial_value)
         self.max = float(initial_value)
         self.ave = float(initial_value)
         self.count = 1
 
+        #: :class:`Histogram` of all values
+        self.histogram = Histogram()
+
+        # deque of (<minute>, <Histogram>) tuples, oldest first, for
+        # the last max(windows) minutes
+        self._minutes = deque()
+        self._add_to_histograms(initial_value)
+
+    def _add_to_histograms(self, value):
+        """ Add a value to the overall and current minute's
+        histograms, discarding per-minute histograms that have fallen
+        out of the largest window. """
+        minute = int(time.time() // 60)
+        if not self._minutes or self._minutes[-1][0] != minute:
+            self._minutes.append((minute, Histogram()))
+            while self._minutes[0][0] <= minute - max(self.windows):
+                self._minutes.popleft()
+        self._minutes[-1][1].add_value(value)
+        self.histogram.add_value(value)
+
     def add_value(self, value):
         """ Add a value to the statistic, recalculating the various
         metrics.
@@ -35,6 +208,27 @@ class Statistic(object):
         self.max = max(self.max, float(value))
         self.count += 1
         self.ave = (((self.ave * (self.count - 1)) + value) / self.count)
+        self._add_to_histograms(value)
+
+    def get_histogram(self, window=None):
+        """ Get a histogram of the values of this statistic.
+
+        :param window: Only include values from the last ``window``
+                       minutes.  Values older than the largest of
+                       :attr:`windows` are not kept, so larger windows
+                       are truncated.  If this is not given, all
+                       values are included.
+        :type window: int
+        :returns: :class:`Histogram`
+        """
+        if not window:
+            return self.histogram
+        oldest = int(time.time() // 60) - window
+        rv = Histogram()
+        for minute, histogram in list(self._minutes):
+            if minute > oldest:
+                rv.merge(histogram)
+        return rv
 
     def get_value(self):
         """ Get a tuple of all the stats tracked on this named item.
@@ -61,7 +255,7 @@ class Statistics(object):
     def __init__(self):
         self.data = dict()
 
-    def add_value(self, name, value):
+    def add_value(self, name, value, unit="seconds"):
         """ Add a value to the named :class:`Statistic`.  This just
         proxies to :func:`Statistic.add_value` or the
         :class:`Statistic` constructor as appropriate.
@@ -71,9 +265,14 @@ class Statistics(object):
         :type name: string
         :param value: The value to add to the Statistic
         :type value: int or float
+        :param unit: The unit of the value, used when the
+                     :class:`Statistic` is created.  Values that are
+                     not execution times, such as queue depths or
+                     ratios, should be added with an empty unit.
+        :type unit: string
         """
         if name not in self.data:
-            self.data[name] = Statistic(name, value)
+            self.data[name] = Statistic(name, value, unit=unit)
         else:
             self.data[name].add_value(value)
 
@@ -84,6 +283,25 @@ class Statistics(object):
         :func:`Statistic.get_value`. """
         return dict([value.get_value() for value in list(self.data.values())])
 
+    def histograms(self, window=None):
+        """ Return a dict of the histograms of all :class:`Statistic`
+        objects that have values in the given window.  Keys are the
+        statistic names, and values are the histogram data as
+        returned by :func:`Histogram.get_data`, with the
+        :attr:`Statistic.unit` added as ``unit``.
+
+        :param window: Only include values from the last ``window``
+                       minutes.  See :func:`Statistic.get_histogram`.
+        :type window: int
+        """
+        rv = dict()
+        for name, stat in list(self.data.items()):
+            histogram = stat.get_histogram(window)
+            if histogram.count:
+                rv[name] = histogram.get_data()
+                rv[name]['unit'] = stat.unit
+        return rv
+
 
 #: A module-level :class:`Statistics` objects used to track all
 #: execution time metrics for the server.
@@ -11,10 +11,25 @@ import shlex
 import sys
 import subprocess
 import threading
+import zlib
 from Bcfg2.Compat import input, any  # pylint: disable=W0622
 
 from typing import Optional
 
+try:
+    import zstandard
+    HAS_ZSTD = True
+except ImportError:
+    HAS_ZSTD = False
+
+#: The HTTP content codings supported by :func:`compress`,
+#: :func:`decompress`, :class:`Compressor`, and :class:`Decompressor`,
+#: most preferred first.
+if HAS_ZSTD:
+    content_encodings = ('zstd', 'gzip')  # pylint: disable=C0103
+else:
+    content_encodings = ('gzip', )  # pylint: disable=C0103
+
 
 class ClassName(object):
     """ This very simple descriptor class exists only to get the name
@@ -359,3 +374,163 @@ def is_string(strng, encoding):
             if ord(char) < 9 or ord(char) > 13 and ord(char) < 32:
                 return False
     return True
+
+
+class Compressor(object):
+    """ Incrementally compress data with an HTTP content coding, so
+    that large documents can be compressed as they are written rather
+    than all at once.  The interface is the same as that of the objects
+    returned by :func:`zlib.compressobj`. """
+
+    def __init__(self, encoding):
+        """
+        :param encoding: The content coding, one of
+                         :attr:`content_encodings`
+        :type encoding: string
+        :raises: ValueError if the content coding is not supported
+        """
+        self.encoding = encoding
+        if encoding == 'gzip':
+            # wbits of 31 writes a gzip header and trailer
+            self._obj = zlib.compressobj(6, zlib.DEFLATED, 31)
+        elif encoding == 'zstd' and HAS_ZSTD:
+            self._obj = zstandard.ZstdCompressor().compressobj()
+        else:
+            raise ValueError("Unsupported content coding %s" % encoding)
+
+    def compress(self, data):
+        """ Compress a piece of data.
+
+        :param data: The data to compress
+        :type data: bytes
+        :returns: bytes - Compressed data, which may be empty if the
+                  compressor is still buffering its input
+        """
+        return self._obj.compress(data)
+
+    def flush(self):
+        """ Finish the compressed stream.
+
+        :returns: bytes - The rest of the compressed data
+        """
+        return self._obj.flush()
+
+
+class Decompressor(object):
+    """ Incrementally decompress data with an HTTP content coding, so
+    that large documents can be decompressed as they are read rather
+    than all at once. """
+
+    def __init__(self, encoding):
+        """
+        :param encoding: The content coding, one of
+                         :attr:`content_encodings`
+        :type encoding: string
+        :raises: ValueError if the content coding is not supported
+        """
+        self.encoding = encoding
+        if encoding == 'gzip':
+            # wbits of 47 accepts a gzip or zlib header
+            self._obj = zlib.decompressobj(47)
+            self._errors = (zlib.error, )
+        elif encoding == 'zstd' and HAS_ZSTD:
+            self._obj = zstandard.ZstdDecompressor().decompressobj()
+            self._errors = (zstandard.ZstdError, )
+        else:
+            raise ValueError("Unsupported content coding %s" % encoding)
+
+    def decompress(self, data):
+        """ Decompress a piece of data.
+
+        :param data: The data to decompress
+        :type data: bytes
+        :returns: bytes
+        :raises: ValueError if the data cannot be decompressed
+        """
+        try:
+            return self._obj.decompress(data)
+        except self._errors:
+            raise ValueError("Failed to decompress %s data: %s" %
+                             (self.encoding, sys.exc_info()[1]))
+
+    def flush(self):
+        """ Finish decompressing the data.
+
+        :returns: bytes - The rest of the decompressed data
+        :raises: ValueError if the compressed data was truncated
+        """
+        try:
+            rv = self._obj.flush()
+        except self._errors:
+            raise ValueError("Failed to decompress %s data: %s" %
+                             (self.encoding, sys.exc_info()[1]))
+        if not getattr(self._obj, "eof", True):
+            raise ValueError("Failed to decompress %s data: Truncated "
+                             "data" % self.encoding)
+        return rv
+
+
+def compress(data, encoding):
+    """ Compress data with the given HTTP content coding.
+
+    :param data: The data to compress
+    :type data: bytes
+    :param encoding: The content coding, one of
+                     :attr:`content_encodings`
+    :type encoding: string
+    :returns: bytes
+    :raises: ValueError if the content coding is not supported
+    """
+    compressor = Compressor(encoding)
+    return compressor.compress(data) + compressor.flush()
+
+
+def decompress(data, encoding):
+    """ Decompress data with the given HTTP content coding.
+
+    :param data: The data to decompress
+    :type data: bytes
+    :param encoding: The content coding, one of
+                     :attr:`content_encodings`
+    :type encoding: string
+    :returns: bytes
+    :raises: ValueError if the content coding is not supported or the
+             data cannot be decompressed
+    """
+    decompressor = Decompressor(encoding)
+    return decompressor.decompress(data) + decompressor.flush()
+
+
+def negotiate_encoding(header):
+    """ Choose a content coding from an HTTP ``Accept-Encoding``
+    header.
+
+    :param header: The value of the ``Accept-Encoding`` header
+    :type header: string
+    :returns: string - The supported content coding with the highest
+              quality value, preferring codings that come first in
+              :attr:`content_encodings`; or None if none of them are
+              acceptable
+    """
+    accepted = dict()
+    for coding in (header or '').split(','):
+        params = coding.strip().split(';')
+        name = params[0].strip().lower()
+        quality = 1.0
+        for param in params[1:]:
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if name:
+            accepted[name] = quality
+    best = None
+    for encoding in content_encodings:
+        quality = accepted.get(encoding, accepted.get('*', 0.0))
+        if quality > 0 and (best is None or quality > best[1]):
+            best = (encoding, quality)
+    if best is None:
+        return None
+    return best[0]
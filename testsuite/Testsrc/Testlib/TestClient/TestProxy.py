@@ -0,0 +1,223 @@
+import os
+import sys
+import ssl
+import errno
+import socket
+from Bcfg2.Compat import httplib, xmlrpclib
+from Bcfg2.Client.Proxy import XMLRPCTransport, ProxyError, RetryMethod
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+
+
+class FakeResponse(object):
+    """ An HTTP response with an XML-RPC body """
+    def __init__(self, status=200, value="ok"):
+        self.status = status
+        self.reason = "OK" if status == 200 else "Error"
+        self.msg = dict()
+        self.data = xmlrpclib.dumps((value, ),
+                                    methodresponse=True).encode('utf-8')
+
+    def getheader(self, name, default=None):
+        return self.msg.get(name, default)
+
+    def read(self, size=-1):
+        rv = self.data[:size]
+        self.data = self.data[len(rv):]
+        return rv
+
+
+class FakeConnection(object):
+    """ A connection that is opened when a request is sent, like
+    :class:`httplib.HTTPConnection`.  Each request takes the next
+    result from :attr:`results`, which is shared by all connections:
+    a response to return, or an exception to raise when the response
+    is read.  The socket is one end of a socket pair, so that the
+    server closing the connection can be simulated by closing the
+    other end. """
+
+    results = []
+    instances = []
+
+    def __init__(self, host, **kwargs):
+        self.host = host
+        self.sock = None
+        self.peer = None
+        self.opened = 0
+        self.instances.append(self)
+
+    def putrequest(self, *args, **kwargs):
+        if self.sock is None:
+            self.sock, self.peer = socket.socketpair()
+            self.opened += 1
+
+    def putheader(self, *args):
+        pass
+
+    def endheaders(self, body=None):
+        pass
+
+    def getresponse(self):
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.peer.close()
+            self.sock = self.peer = None
+
+
+class TestXMLRPCTransport(Bcfg2TestCase):
+    def setUp(self):
+        Bcfg2TestCase.setUp(self)
+        FakeConnection.results = []
+        FakeConnection.instances = []
+        patcher = patch("Bcfg2.Client.Proxy.SSLHTTPConnection",
+                        FakeConnection)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.transport = XMLRPCTransport()
+        self.addCleanup(self.transport.close)
+
+    def request(self, *results):
+        """ Send a request that gets the given results """
+        FakeConnection.results.extend(results)
+        return self.transport.request("localhost", "/RPC2", b"<request/>")
+
+    def connections(self):
+        """ The number of connections that have been opened """
+        return sum(c.opened for c in FakeConnection.instances)
+
+    def test_reuse(self):
+        self.assertEqual(self.request(FakeResponse()), ("ok", ))
+        self.assertEqual(self.request(FakeResponse()), ("ok", ))
+        self.assertEqual(self.request(FakeResponse()), ("ok", ))
+        self.assertEqual(self.connections(), 1)
+        self.assertEqual(self.transport.handshakes, 1)
+        self.assertEqual(self.transport.reused, 2)
+
+    def test_dropped_idle_connection(self):
+        self.request(FakeResponse())
+        # the server closes the idle connection
+        FakeConnection.instances[0].peer.close()
+        self.assertEqual(self.request(FakeResponse()), ("ok", ))
+        self.assertEqual(self.connections(), 2)
+        self.assertEqual(self.transport.handshakes, 2)
+        self.assertEqual(self.transport.reused, 0)
+
+    def test_retry_stale(self):
+        stale = [httplib.BadStatusLine("''"),
+                 socket.error(errno.EPIPE, "Broken pipe"),
+                 socket.error(errno.ECONNRESET, "Connection reset")]
+        self.request(FakeResponse())
+        for i, err in enumerate(stale):
+            # the server closed the reused connection just as the
+            # request was sent, so it is retried once on a new
+            # connection
+            self.assertEqual(self.request(err, FakeResponse()), ("ok", ))
+            self.assertEqual(self.connections(), i + 2)
+            self.assertEqual(self.transport.handshakes, i + 2)
+            self.assertEqual(self.transport.reused, i + 1)
+            self.assertEqual(FakeConnection.results, [])
+
+    def test_no_retry_fresh(self):
+        # an error on a new connection is not retried
+        self.assertRaises(ProxyError, self.request,
+                          httplib.BadStatusLine("''"), FakeResponse())
+        self.assertEqual(self.connections(), 1)
+        self.assertIsNone(FakeConnection.instances[-1].sock)
+        self.assertEqual(len(FakeConnection.results), 1)
+
+        # nor is an error on a reused connection that can't be caused
+        # by the server closing it.  a failed request always closes
+        # the connection.
+        FakeConnection.results = []
+        self.request(FakeResponse())
+        self.assertRaises(ProxyError, self.request,
+                          socket.timeout("timed out"), FakeResponse())
+        self.assertEqual(self.connections(), 2)
+        self.assertIsNone(FakeConnection.instances[-1].sock)
+        self.assertEqual(len(FakeConnection.results), 1)
+
+        # nor is a second stale error
+        FakeConnection.results = []
+        self.request(FakeResponse())
+        self.assertRaises(ProxyError, self.request,
+                          httplib.BadStatusLine("''"),
+                          socket.error(errno.EPIPE, "Broken pipe"))
+        self.assertEqual(self.connections(), 4)
+        self.assertIsNone(FakeConnection.instances[-1].sock)
+
+    def test_close_on_error_status(self):
+        self.request(FakeResponse())
+        self.assertRaises(ProxyError, self.request, FakeResponse(status=500))
+        self.assertIsNone(FakeConnection.instances[-1].sock)
+        self.assertEqual(self.request(FakeResponse()), ("ok", ))
+        self.assertEqual(self.transport.handshakes, 2)
+
+    def test_is_stale(self):
+        self.assertTrue(self.transport._is_stale(httplib.BadStatusLine("")))
+        for code in [errno.EPIPE, errno.ECONNRESET, errno.ECONNABORTED]:
+            self.assertTrue(self.transport._is_stale(socket.error(code, "")))
+        self.assertFalse(self.transport._is_stale(
+            socket.error(errno.ECONNREFUSED, "")))
+        self.assertFalse(self.transport._is_stale(socket.timeout()))
+        for code in [ssl.SSL_ERROR_EOF, ssl.SSL_ERROR_ZERO_RETURN]:
+            self.assertTrue(self.transport._is_stale(ssl.SSLError(code, "")))
+        self.assertFalse(self.transport._is_stale(
+            ssl.SSLError(ssl.SSL_ERROR_SSL, "")))
+
+
+class TestRetryMethod(Bcfg2TestCase):
+    def busy(self, retry_after="5"):
+        """ The error raised when the server rejects a request """
+        headers = dict()
+        if retry_after is not None:
+            headers["Retry-After"] = retry_after
+        return ProxyError(xmlrpclib.ProtocolError("https://localhost:6789/",
+                                                  503, "Busy", headers))
+
+    @patch("random.uniform")
+    @patch("time.sleep")
+    def test_retry_after(self, mock_sleep, mock_uniform):
+        mock_uniform.side_effect = lambda low, high: high
+        send = MagicMock(side_effect=[self.busy(), self.busy(), "ok"])
+        self.assertEqual(RetryMethod(send, "Test")("foo"), "ok")
+        self.assertEqual(send.call_count, 3)
+        # the wait is doubled for each retry, plus jitter of up to
+        # the same amount
+        self.assertEqual(mock_uniform.call_args_list,
+                         [call(0, 5), call(0, 10)])
+        self.assertEqual(mock_sleep.call_args_list, [call(10), call(20)])
+
+        # the retries are limited
+        send = MagicMock(side_effect=[self.busy()] * 3)
+        self.assertRaises(ProxyError, RetryMethod(send, "Test"), "foo")
+        self.assertEqual(send.call_count, RetryMethod.max_retries)
+
+    @patch("random.uniform")
+    @patch("time.sleep")
+    def test_retry_delay(self, mock_sleep, mock_uniform):
+        # other errors, and 503 without a usable Retry-After, are
+        # retried after the fixed delay
+        errors = [self.busy(None), self.busy("soon"),
+                  ProxyError(xmlrpclib.ProtocolError(
+                      "https://localhost:6789/", 500, "Error", dict()))]
+        for err in errors:
+            mock_sleep.reset_mock()
+            send = MagicMock(side_effect=[err, "ok"])
+            self.assertEqual(RetryMethod(send, "Test")("foo"), "ok")
+            mock_sleep.assert_called_once_with(RetryMethod.retry_delay)
+        self.assertFalse(mock_uniform.called)
@@ -2,8 +2,12 @@
 import os
 import sys
 import copy
+import time
+import shutil
 import difflib
+import tempfile
 import lxml.etree
+from hashlib import sha256
 from Bcfg2.Compat import b64encode, u_str
 from mock import Mock, MagicMock, patch
 from Bcfg2.Client.Tools.POSIX.File import *
@@ -24,6 +28,11 @@ from common import *
 class TestPOSIXFile(TestPOSIXTool):
     test_obj = POSIXFile
 
+    def setUp(self):
+        TestPOSIXTool.setUp(self)
+        set_setup_default("posix_digest_cache", None)
+        set_setup_default("encoding", "UTF-8")
+
     def test_fully_specified(self):
         ptool = self.get_obj()
 
@@ -138,6 +147,82 @@ class TestPOSIXFile(TestPOSIXTool):
         ptool._exists.assert_called_with(entry)
         mock_open.assert_called_with(entry.get("name"))
 
+    def test_verify_digest(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            Bcfg2.Options.setup.posix_digest_cache = \
+                os.path.join(tmpdir, "digests")
+            fname = os.path.join(tmpdir, "test")
+            open(fname, "wb").write(b"test")
+            # make the file old enough for its digest to be cached
+            os.utime(fname, (time.time() - 60, time.time() - 60))
+            ondisk = os.lstat(fname)
+            digest = "sha256:%s" % sha256(b"test").hexdigest()
+
+            ptool = self.get_obj()
+            self.assertEqual(ptool._get_digest(fname, ondisk), digest)
+            ptool.save_digest_cache()
+
+            # a new tool object gets the digest from the cache,
+            # without reading the file
+            ptool = self.get_obj()
+            real_open = open
+            with patch("%s.open" % builtins) as mock_open:
+                mock_open.side_effect = real_open
+                self.assertEqual(ptool._get_digest(fname, ondisk), digest)
+                self.assertNotIn(fname, [c[0][0]
+                                         for c in mock_open.call_args_list])
+
+            # verify() uses the size and digest sent by the server,
+            # without decoding the entry data
+            entry = lxml.etree.Element("Path", name=fname, type="file")
+            entry.text = "test"
+            entry.set("digest", digest)
+            entry.set("size", "4")
+            ptool._get_digest = Mock(return_value=digest)
+            ptool._get_diffs = Mock()
+            ptool._get_data = Mock(side_effect=ptool._get_data)
+            with patch("Bcfg2.Client.Tools.POSIX.base.POSIXTool.verify") \
+                    as mock_verify:
+                mock_verify.return_value = True
+                self.assertTrue(ptool.verify(entry, []))
+                self.assertTrue(ptool._get_digest.called)
+                self.assertFalse(ptool._get_data.called)
+
+                # a size that does not match skips the digest
+                ptool._get_digest.reset_mock()
+                entry.set("size", "5")
+                entry.text = "test2"
+                self.assertFalse(ptool.verify(entry, []))
+                self.assertFalse(ptool._get_digest.called)
+                entry.set("size", "4")
+
+                # a digest that does not match falls back to comparing
+                # the content of text entries, since the digest
+                # depends on the encoding
+                entry.set("digest", "sha256:bogus")
+                entry.text = "test"
+                self.assertTrue(ptool.verify(entry, []))
+                entry.text = "tess"
+                self.assertFalse(ptool.verify(entry, []))
+
+                # binary entries whose size or digest does not match
+                # are different, and are not decoded to find that out
+                ptool._get_data.reset_mock()
+                entry.set("encoding", "base64")
+                entry.text = b64encode(b"tess").decode("ascii")
+                self.assertFalse(ptool.verify(entry, []))
+                entry.set("size", "5")
+                entry.text = b64encode(b"tests").decode("ascii")
+                self.assertFalse(ptool.verify(entry, []))
+                self.assertFalse(ptool._get_data.called)
+                ptool._get_diffs.assert_called_with(
+                    entry, interactive=False, sensitive=False,
+                    is_binary=True, content=None)
+        finally:
+            Bcfg2.Options.setup.posix_digest_cache = None
+            shutil.rmtree(tmpdir)
+
     @patch("os.fdopen")
     @patch("tempfile.mkstemp")
     def test_write_tmpfile(self, mock_mkstemp, mock_fdopen):
@@ -33,6 +33,7 @@ class TestTool(Bcfg2TestCase):
         set_setup_default('command_timeout')
         set_setup_default('interactive', False)
         set_setup_default('decision')
+        set_setup_default('inventory_workers', 1)
 
     def get_obj(self, config=None):
         if config is None:
@@ -178,6 +179,36 @@ class TestTool(Bcfg2TestCase):
         actual_states = t.Inventory()
         perform_assertions(actual_states)
 
+    def test_Inventory_parallel(self):
+        t = self.get_obj()
+        t.canVerify = Mock(return_value=True)
+        t.buildModlist = Mock()
+        t.FindExtra = Mock()
+        t.VerifyPath = Mock()
+        t.VerifyPath.side_effect = lambda e, m: e.get("name") != "/bad"
+        t.VerifyService = Mock()
+        t.VerifyService.side_effect = OSError
+
+        bundle = lxml.etree.Element("Bundle")
+        paths = [lxml.etree.SubElement(bundle, "Path", name="/foo%d" % i)
+                 for i in range(10)]
+        paths.append(lxml.etree.SubElement(bundle, "Path", name="/bad"))
+        lxml.etree.SubElement(bundle, "Service", name="foo")
+        expected_states = dict((e, e.get("name") != "/bad") for e in paths)
+
+        for parallel in [False, True]:
+            t.parallel_verify = parallel
+            t.VerifyPath.reset_mock()
+            Bcfg2.Options.setup.inventory_workers = 4
+            try:
+                self.assertEqual(t.Inventory(structures=[bundle]),
+                                 expected_states)
+            finally:
+                Bcfg2.Options.setup.inventory_workers = 1
+            self.assertItemsEqual(t.VerifyPath.call_args_list,
+                                  [call(e, t.buildModlist.return_value)
+                                   for e in paths])
+
     def test_Install(self):
         t = self.get_obj()
         t.InstallPath = Mock()
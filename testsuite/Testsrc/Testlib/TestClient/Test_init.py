@@ -0,0 +1,172 @@
+import os
+import sys
+import hashlib
+import argparse
+import tempfile
+import lxml.etree
+import Bcfg2.Options
+from Bcfg2.Compat import xmlrpclib
+from Bcfg2.Client import Client, Proxy
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+
+
+class TestClient(Bcfg2TestCase):
+    config = "<Configuration><Bundle name='test'/></Configuration>"
+
+    def setUp(self):
+        Bcfg2TestCase.setUp(self)
+        for option, value in dict(probe_timeout=None, bundle_quick=False,
+                                  remove="none", file=None, profile=None,
+                                  decision="none", cache=None,
+                                  server="https://localhost:6789").items():
+            setattr(Bcfg2.Options.setup, option, value)
+        fd, self.cachefile = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.unlink, self.cachefile)
+        self.addCleanup(setattr, Bcfg2.Options.setup, "cache", None)
+
+    def get_client(self, cache=True):
+        if cache:
+            Bcfg2.Options.setup.cache = \
+                argparse.FileType('ab+')(self.cachefile)
+            self.addCleanup(Bcfg2.Options.setup.cache.close)
+        else:
+            Bcfg2.Options.setup.cache = None
+        client = Client()
+        client._proxy = MagicMock()
+        client._proxy.GetConfig.return_value = self.config
+        client.run_probes = MagicMock()
+        return client
+
+    def write_cache(self, data):
+        with open(self.cachefile, 'wb') as cache:
+            cache.write(data.encode('utf-8'))
+
+    def read_cache(self):
+        with open(self.cachefile, 'rb') as cache:
+            return cache.read().decode('utf-8')
+
+    def test_get_config_no_cache(self):
+        client = self.get_client(cache=False)
+        self.assertEqual(client.get_config(), self.config.encode('utf-8'))
+        self.assertFalse(client.proxy.GetConfigIfChanged.called)
+        client.proxy.GetConfig.assert_called_with()
+
+    def test_get_config_empty_cache(self):
+        client = self.get_client()
+        self.assertEqual(client.get_config(), self.config.encode('utf-8'))
+        self.assertFalse(client.proxy.GetConfigIfChanged.called)
+        self.assertEqual(self.read_cache(), self.config)
+
+    def test_get_config_unchanged(self):
+        self.write_cache(self.config)
+        client = self.get_client()
+        client.proxy.GetConfigIfChanged.return_value = ""
+        self.assertEqual(client.get_config(), self.config.encode('utf-8'))
+        client.proxy.GetConfigIfChanged.assert_called_with(
+            hashlib.sha256(self.config.encode('utf-8')).hexdigest())
+        self.assertFalse(client.proxy.GetConfig.called)
+        self.assertEqual(self.read_cache(), self.config)
+
+    def test_get_config_changed(self):
+        # the new configuration is shorter than the cached one, so
+        # the cache must be truncated, not just overwritten
+        self.write_cache("<Configuration><Bundle name='old'/>"
+                         "<Bundle name='older'/></Configuration>")
+        client = self.get_client()
+        client.proxy.GetConfigIfChanged.return_value = self.config
+        self.assertEqual(client.get_config(), self.config.encode('utf-8'))
+        self.assertFalse(client.proxy.GetConfig.called)
+        self.assertEqual(self.read_cache(), self.config)
+
+    def test_get_config_fallback(self):
+        # servers that do not have GetConfigIfChanged, or that deny
+        # it, still send the full configuration
+        errors = [xmlrpclib.Fault(xmlrpclib.METHOD_NOT_FOUND,
+                                  "Unknown method"),
+                  xmlrpclib.ProtocolError("https://localhost:6789/", 401,
+                                          "Unauthorized", dict())]
+        for err in errors:
+            self.write_cache("<Configuration/>")
+            client = self.get_client()
+            client.proxy.GetConfigIfChanged.side_effect = \
+                Proxy.ProxyError(err)
+            self.assertEqual(client.get_config(),
+                             self.config.encode('utf-8'))
+            client.proxy.GetConfig.assert_called_with()
+            self.assertEqual(self.read_cache(), self.config)
+
+        # if GetConfig fails as well, the run fails
+        client = self.get_client()
+        client.proxy.GetConfigIfChanged.side_effect = \
+            Proxy.ProxyError(errors[-1])
+        client.proxy.GetConfig.side_effect = Proxy.ProxyError(errors[-1])
+        self.assertRaises(SystemExit, client.get_config)
+
+        # other errors are fatal without falling back
+        errors = [xmlrpclib.Fault(1, "Unexpected error"),
+                  xmlrpclib.ProtocolError("https://localhost:6789/", 500,
+                                          "Internal Server Error", dict())]
+        for err in errors:
+            client = self.get_client()
+            client.proxy.GetConfigIfChanged.side_effect = \
+                Proxy.ProxyError(err)
+            self.assertRaises(SystemExit, client.get_config)
+            self.assertFalse(client.proxy.GetConfig.called)
+
+    def test_get_config_cache_times(self):
+        # the caching time is recorded even if the cache is not
+        # rewritten because the configuration has not changed
+        self.write_cache(self.config)
+        client = self.get_client()
+        client.proxy.GetConfigIfChanged.return_value = ""
+        client.get_config()
+        self.assertIn("caching", client.times)
+
+    def test_fingerprint_probe(self):
+        client = self.get_client(cache=False)
+        probe = lxml.etree.Element("probe", name="test")
+        fingerprint = hashlib.sha256(b"result").hexdigest()
+
+        result = lxml.etree.Element("probe-data", name="test")
+        result.text = "result"
+        result = client.fingerprint_probe(probe, result)
+        self.assertEqual(result.get("fingerprint"), fingerprint)
+        self.assertEqual(result.text, "result")
+        self.assertIsNone(result.get("unchanged"))
+
+        # the result is omitted if it is unchanged
+        probe.set("fingerprint", fingerprint)
+        result = lxml.etree.Element("probe-data", name="test")
+        result.text = "result"
+        result = client.fingerprint_probe(probe, result)
+        self.assertEqual(result.get("fingerprint"), fingerprint)
+        self.assertIsNone(result.text)
+        self.assertEqual(result.get("unchanged"), "true")
+
+    @patch("Bcfg2.Options.setup.dry_run", False, create=True)
+    @patch("Bcfg2.Options.setup.only_important", False, create=True)
+    def test_GenerateStats(self):
+        client = self.get_client(cache=False)
+        client.config = lxml.etree.XML(self.config)
+        client.states = dict()
+        client.modified = []
+        client.extra = []
+        client.times = dict(start=1.0, finished=3.0)
+        client.durations = dict(probetime_test=0.5)
+        stats = client.GenerateStats().find("Statistics")
+        # durations are sent separately from the timestamps
+        self.assertEqual(dict(stats.find("OpStamps").attrib),
+                         dict(start="1.0", finished="3.0"))
+        self.assertEqual(dict(stats.find("Durations").attrib),
+                         dict(probetime_test="0.5"))
@@ -0,0 +1,66 @@
+import os
+import sys
+import logging
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+
+from Bcfg2.Server.Metrics import MetricFamily, MetricsServer
+
+try:
+    from Bcfg2.Server.BuiltinCore import BuiltinCore
+    HAS_BUILTIN = True
+except ImportError:
+    HAS_BUILTIN = False
+
+
+class FakeCore(object):
+    def collect_metrics(self):
+        family = MetricFamily("test", "gauge", "Test")
+        family.add_sample(1)
+        return [family]
+
+
+class TestBuiltinCore(Bcfg2TestCase):
+    @skipUnless(HAS_BUILTIN, "builtin core not available")
+    def setUp(self):
+        Bcfg2TestCase.setUp(self)
+        set_setup_default("daemon_uid")
+        set_setup_default("daemon_gid")
+        set_setup_default("umask", "0077")
+        set_setup_default("daemon")
+
+    @patch("Bcfg2.Server.BuiltinCore.BuiltinCore._logfilehandles")
+    @patch("daemon.DaemonContext")
+    def get_files_preserve(self, mock_DaemonContext, mock_logfilehandles,
+                           metrics_server=None):
+        """ Get a builtin core with the given metrics listener, and
+        return the files that its daemon context preserves """
+        def init(core):
+            core.logger = logging.getLogger("BuiltinCore")
+            core.metrics_server = metrics_server
+
+        mock_logfilehandles.return_value = [2]
+        with patch("Bcfg2.Server.Core.NetworkCore.__init__", init):
+            core = BuiltinCore()
+        self.assertIs(core.context, mock_DaemonContext.return_value)
+        return mock_DaemonContext.call_args[1]['files_preserve']
+
+    def test_files_preserve(self):
+        self.assertEqual(self.get_files_preserve(), [2])
+
+        # the metrics listener is bound before the core daemonizes, so
+        # its socket must be kept open
+        metrics_server = MetricsServer(("127.0.0.1", 0), FakeCore())
+        self.addCleanup(metrics_server.server_close)
+        self.assertItemsEqual(
+            self.get_files_preserve(metrics_server=metrics_server),
+            [2, metrics_server.fileno()])
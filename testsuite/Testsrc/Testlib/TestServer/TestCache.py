@@ -1,5 +1,8 @@
 import os
 import sys
+import time
+import shutil
+import tempfile
 
 # add all parent testsuite directories to sys.path to allow (most)
 # relative imports in python 2.4
@@ -13,6 +16,7 @@ while path != "/":
 from common import *
 
 from Bcfg2.Server.Cache import *
+from Bcfg2.Server.Cache import _CacheRegistry
 
 
 class TestCache(Bcfg2TestCase):
@@ -52,3 +56,132 @@ class TestCache(Bcfg2TestCase):
         probe_cache2 = Cache("Probes", "data")
         self.assertItemsEqual(list(iter(probe_cache)),
                               list(iter(probe_cache2)))
+
+    def test_index(self):
+        cache = Cache("Index", "test")
+        cache['foo'] = 'foo data'
+        cache['bar'] = 'bar data'
+        other = Cache("Index", "other")
+        other['foo'] = 'other foo data'
+        self.assertItemsEqual(
+            list(Bcfg2.Server.Cache._cache.iter_all("Index", "foo")),
+            [frozenset(["Index", "test", "foo"]),
+             frozenset(["Index", "other", "foo"])])
+
+        self.assertEqual(expire("Index", "foo"), 2)
+        self.assertItemsEqual(cache.keys(), ["bar"])
+        self.assertEqual(len(other), 0)
+        self.assertNotIn("foo", Bcfg2.Server.Cache._cache._index)
+
+        expire("Index")
+        self.assertNotIn("Index", Bcfg2.Server.Cache._cache._index)
+
+    @patch("time.time")
+    def test_ttl(self, mock_time):
+        mock_time.return_value = 100.0
+        cache = Cache("TTL", ttl=10)
+        cache['foo'] = 'foo data'
+        mock_time.return_value = 105.0
+        cache['bar'] = 'bar data'
+        self.assertEqual(cache['foo'], 'foo data')
+        self.assertItemsEqual(cache.keys(), ["foo", "bar"])
+
+        mock_time.return_value = 112.0
+        self.assertNotIn("foo", cache)
+        self.assertEqual(cache['bar'], 'bar data')
+        self.assertItemsEqual(cache.keys(), ["bar"])
+
+        mock_time.return_value = 120.0
+        self.assertEqual(len(cache), 0)
+        self.assertNotIn(frozenset(["TTL", "bar"]),
+                         Bcfg2.Server.Cache._cache)
+
+    def test_maxsize(self):
+        cache = Cache("LRU", maxsize=2)
+        cache['foo'] = 'foo data'
+        cache['bar'] = 'bar data'
+        self.assertEqual(cache['foo'], 'foo data')
+        cache['baz'] = 'baz data'
+        self.assertItemsEqual(cache.keys(), ["foo", "baz"])
+
+        # a second Cache object for the same tags shares the limits
+        cache2 = Cache("LRU")
+        cache2['quux'] = 'quux data'
+        self.assertItemsEqual(cache.keys(), ["baz", "quux"])
+
+        cache.expire()
+        self.assertEqual(len(cache), 0)
+
+    def test_shared(self):
+        path = tempfile.mkdtemp()
+        try:
+            set_shared_store(path)
+            cache = Cache("Shared", "test", shared=True)
+            cache['foo'] = ['foo', 'data']
+            cache['bar'] = 'bar data'
+            self.assertEqual(cache['foo'], ['foo', 'data'])
+            self.assertItemsEqual(cache.keys(), ["foo", "bar"])
+
+            # another process can load the items from the store
+            tags = frozenset(["Shared", "test"])
+            sibling = _CacheRegistry()
+            sibling.store = SharedStore(path)
+            sibling.shared.add(tags)
+            self.assertEqual(sibling.get_item(tags, 'foo'), ['foo', 'data'])
+            self.assertTrue(sibling.has_item(tags, 'bar'))
+            self.assertFalse(sibling.has_item(tags, 'baz'))
+
+            del cache['bar']
+            self.assertFalse(sibling.has_item(tags, 'bar'))
+
+            # expiring data removes items from the store, even those
+            # that this process never saw
+            sibling.set_item(tags, 'baz', 'baz data')
+            self.assertEqual(cache['baz'], 'baz data')
+            sibling.set_item(tags, 'quux', 'quux data')
+            self.assertEqual(expire("Shared"), 2)
+            self.assertEqual(len(cache), 0)
+            self.assertFalse(sibling.has_item(tags, 'quux'))
+            self.assertRaises(KeyError, sibling.get_item, tags, 'foo')
+        finally:
+            set_shared_store(None)
+            shutil.rmtree(path)
+
+    def test_shared_limits(self):
+        path = tempfile.mkdtemp()
+        try:
+            set_shared_store(path)
+            tags = frozenset(["SharedLimits"])
+            cache = Cache("SharedLimits", shared=True, ttl=60, maxsize=2)
+            store = Bcfg2.Server.Cache._cache.store
+            cache['foo'] = 'foo data'
+            cache['bar'] = 'bar data'
+            self.assertEqual(cache['foo'], 'foo data')
+            cache['baz'] = 'baz data'
+            # the least recently used item is evicted from the store
+            self.assertItemsEqual(cache.keys(), ["foo", "baz"])
+            self.assertNotIn((tags, 'bar'), store)
+
+            # items stored by another process count towards the limit
+            # once they have been looked up
+            sibling = _CacheRegistry()
+            sibling.store = SharedStore(path)
+            sibling.shared.add(tags)
+            sibling.set_item(tags, 'quux', 'quux data')
+            self.assertEqual(cache['quux'], 'quux data')
+            self.assertItemsEqual(cache.keys(), ["baz", "quux"])
+            self.assertNotIn((tags, 'foo'), store)
+
+            # the time-to-live counts from when the item was stored,
+            # even by another process
+            stored = time.time() - 120
+            os.utime(store._file(tags, 'quux'), (stored, stored))
+            self.assertFalse('quux' in cache)
+            self.assertRaises(KeyError, sibling.get_item, tags, 'quux')
+            self.assertNotIn((tags, 'quux'), store)
+            os.utime(store._file(tags, 'baz'), (stored, stored))
+            self.assertRaises(KeyError, cache.__getitem__, 'baz')
+            self.assertEqual(len(cache), 0)
+        finally:
+            set_shared_store(None)
+            shutil.rmtree(path)
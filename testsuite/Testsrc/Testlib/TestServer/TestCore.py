@@ -0,0 +1,251 @@
+import os
+import sys
+import hashlib
+import lxml.etree
+import Bcfg2.Server.Statistics
+from Bcfg2.Server.Core import Core
+from Bcfg2.Server.Statistics import Statistics
+from Bcfg2.Server.Plugin import Generator, Metadata, ClientACLs, \
+    PluginExecutionError
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+
+
+class FakePlugin(object):
+    experimental = False
+    deprecated = False
+
+    def __init__(self, name, sort_order=500):
+        self.name = name
+        self.sort_order = sort_order
+
+    def shutdown(self):
+        pass
+
+
+class FakeMetadata(FakePlugin, Metadata, ClientACLs):
+    pass
+
+
+class FakeGenerator(FakePlugin, Generator):
+    """ A generator plugin that lists the given entries """
+    def __init__(self, name, sort_order=500, entries=None, handles=False):
+        FakePlugin.__init__(self, name, sort_order=sort_order)
+        self.Entries = dict()
+        for tag, ename in entries or []:
+            self.Entries.setdefault(tag, dict())[ename] = \
+                MagicMock(return_value=name)
+        self.handles = handles
+
+    def HandlesEntry(self, entry, metadata):
+        return self.handles
+
+    def HandleEntry(self, entry, metadata):
+        return "%s:HandleEntry" % self.name
+
+
+class TestCore(Bcfg2TestCase):
+    def get_core(self, *plugins):
+        """ Get a core with the given plugins loaded, without
+        initializing the rest of the core """
+        core = Core.__new__(Core)
+        core.logger = MagicMock()
+        core.fam = MagicMock()
+        core.fam.dispatched = 0
+        core.plugins = dict((p.name, p) for p in plugins)
+        core._plugin_registry = dict()
+        core.plugin_registry_hits = 0
+        core.plugin_registry_misses = 0
+        core._bind_index = dict()
+        core._bind_index_serial = None
+        return core
+
+    def test_plugins_by_type(self):
+        gen1 = FakeGenerator("Gen1")
+        gen2 = FakeGenerator("Gen2", sort_order=100)
+        gen3 = FakeGenerator("Gen3", sort_order=100)
+        metadata = FakeMetadata("Metadata")
+        core = self.get_core(gen1, gen2, gen3, metadata)
+
+        generators = core.plugins_by_type(Generator)
+        self.assertEqual(generators, [gen2, gen3, gen1])
+        self.assertEqual(core.plugins_by_type(Metadata), [metadata])
+        self.assertEqual(core.plugin_registry_misses, 2)
+        self.assertEqual(core.plugin_registry_hits, 0)
+
+        # the cached list is returned
+        self.assertIs(core.plugins_by_type(Generator), generators)
+        self.assertEqual(core.plugin_registry_misses, 2)
+        self.assertEqual(core.plugin_registry_hits, 1)
+
+        core.expire_plugin_registry()
+        self.assertIsNot(core.plugins_by_type(Generator), generators)
+        self.assertEqual(core.plugins_by_type(Generator), generators)
+        self.assertEqual(core.plugin_registry_misses, 3)
+
+    def test_plugin_registry_expiry(self):
+        gen1 = FakeGenerator("Gen1")
+        metadata = FakeMetadata("Metadata")
+        core = self.get_core(gen1, metadata)
+        core.plugin_blacklist = dict()
+        core.expire_bind_index = MagicMock()
+        self.assertEqual(core.plugins_by_type(Generator), [gen1])
+
+        # loading a plugin
+        gen2 = FakeGenerator("Gen2")
+        plugin = MagicMock(conflicts=["Gen1"], return_value=gen2)
+        plugin.name = "Gen2"
+        core.init_plugin(plugin)
+        self.assertIs(core.plugins["Gen2"], gen2)
+        self.assertItemsEqual(core.plugins_by_type(Generator), [gen1, gen2])
+        self.assertTrue(core.expire_bind_index.called)
+
+        # unloading conflicting plugins
+        core.expire_bind_index.reset_mock()
+        with patch("Bcfg2.Options.setup.plugins", [], create=True):
+            core.load_plugins()
+        self.assertNotIn(gen1, core.plugins_by_type(Generator))
+        self.assertTrue(core.expire_bind_index.called)
+        self.assertIs(core.metadata, metadata)
+
+        # shutting down
+        core.expire_bind_index.reset_mock()
+        core._running = True
+        core._database_available = False
+        core.terminate = MagicMock()
+        core.name = "Core"
+        core._save_snapshot = MagicMock()
+        core.shutdown()
+        self.assertTrue(core.expire_bind_index.called)
+        self.assertEqual(core._plugin_registry, dict())
+
+    @patch("Bcfg2.Server.Statistics.stats", MagicMock())
+    def test_Bind(self):
+        gen1 = FakeGenerator("Gen1", entries=[("Path", "/test1"),
+                                              ("Path", "/test2")])
+        gen2 = FakeGenerator("Gen2", sort_order=100,
+                             entries=[("Path", "/test2")])
+        gen3 = FakeGenerator("Gen3", handles=True)
+        core = self.get_core(gen1, gen2, gen3)
+        metadata = MagicMock()
+
+        entry = lxml.etree.Element("Path", name="/test1")
+        self.assertEqual(core.Bind(entry, metadata), "Gen1")
+        gen1.Entries["Path"]["/test1"].assert_called_with(entry, metadata)
+
+        # an entry listed by several generators is an error, and is
+        # bound with HandlesEntry instead.  the generators are
+        # reported in sort order.
+        entry = lxml.etree.Element("Path", name="/test2")
+        self.assertEqual(core.Bind(entry, metadata), "Gen3:HandleEntry")
+        self.assertEqual(core._bind_index[("Path", "/test2")],
+                         (gen2, gen1))
+        self.assertIn("Gen2, Gen1", core.logger.error.call_args[0][0])
+
+        # an entry that no generator lists is cached as such
+        entry = lxml.etree.Element("Path", name="/test3")
+        self.assertEqual(core.Bind(entry, metadata), "Gen3:HandleEntry")
+        self.assertEqual(core._bind_index[("Path", "/test3")], ())
+
+        gen3.handles = False
+        entry = lxml.etree.Element("Path", name="/test3")
+        self.assertRaises(PluginExecutionError, core.Bind, entry, metadata)
+        self.assertEqual(entry.get("failure"), "no matching generator")
+
+    def test_bind_index(self):
+        gen1 = FakeGenerator("Gen1", entries=[("Path", "/test1")])
+        gen2 = FakeGenerator("Gen2")
+        core = self.get_core(gen1, gen2)
+
+        self.assertEqual(core._get_bind_generators("Path", "/test1"),
+                         (gen1, ))
+        self.assertEqual(core._get_bind_generators("Path", "/test2"), ())
+
+        # the index is used until the FAM handles an event
+        gen2.Entries["Path"] = dict(("/test%d" % i, MagicMock())
+                                    for i in range(1, 3))
+        self.assertEqual(core._get_bind_generators("Path", "/test1"),
+                         (gen1, ))
+        self.assertEqual(core._get_bind_generators("Path", "/test2"), ())
+        core.fam.dispatched += 1
+        self.assertEqual(core._get_bind_generators("Path", "/test1"),
+                         (gen1, gen2))
+        self.assertEqual(core._get_bind_generators("Path", "/test2"),
+                         (gen2, ))
+
+        # or the set of plugins changes
+        gen3 = FakeGenerator("Gen3", sort_order=1,
+                             entries=[("Path", "/test1")])
+        core.plugins["Gen3"] = gen3
+        self.assertEqual(core._get_bind_generators("Path", "/test1"),
+                         (gen1, gen2))
+        core.expire_plugin_registry()
+        self.assertEqual(core._get_bind_generators("Path", "/test1"),
+                         (gen3, gen1, gen2))
+
+        del core.plugins["Gen1"]
+        core.expire_plugin_registry()
+        self.assertEqual(core._get_bind_generators("Path", "/test1"),
+                         (gen3, gen2))
+
+        # or it is expired explicitly
+        self.assertEqual(core._get_bind_generators("Path", "/test3"), ())
+        gen2.Entries["Path"]["/test3"] = MagicMock()
+        self.assertEqual(core._get_bind_generators("Path", "/test3"), ())
+        core.expire_bind_index()
+        self.assertEqual(core._get_bind_generators("Path", "/test3"),
+                         (gen2, ))
+
+    @patch("Bcfg2.Server.Statistics.stats", Statistics())
+    def test_collect_metrics(self):
+        core = self.get_core()
+        core.fam.events = []
+        core.fam.coalesced = 0
+        Bcfg2.Server.Statistics.stats.add_value("Core:GetConfig", 0.5)
+        Bcfg2.Server.Statistics.stats.add_value("Core:Generator:Cfg", 0.1)
+        Bcfg2.Server.Statistics.stats.add_value("Core:config_unchanged", 1,
+                                                unit="")
+        families = dict((f.name, f) for f in core.collect_metrics())
+
+        def names(family):
+            return set(labels["name"] for _, labels, _ in family.samples
+                       if "name" in labels)
+
+        # only execution times are exported as times
+        self.assertEqual(families["bcfg2_server_call_seconds"].unit,
+                         "seconds")
+        self.assertEqual(names(families["bcfg2_server_call_seconds"]),
+                         set(["Core:GetConfig", "Core:Generator:Cfg"]))
+        self.assertEqual(families["bcfg2_server_samples"].unit, None)
+        self.assertEqual(names(families["bcfg2_server_samples"]),
+                         set(["Core:config_unchanged"]))
+        self.assertIn(("_total", dict(core="Core", plugin="Cfg"), 1),
+                      families["bcfg2_server_generator_binds"].samples)
+
+    @patch("Bcfg2.Server.Statistics.stats")
+    def test_GetConfigIfChanged(self, mock_stats):
+        config = "<Configuration><Bundle name='é'/></Configuration>"
+        core = MagicMock()
+        core.__class__.__name__ = "Core"
+        core.GetConfig.return_value = config
+        address = ("127.0.0.1", 12345)
+
+        digest = hashlib.sha256(config.encode('UTF-8')).hexdigest()
+        self.assertEqual(Core.GetConfigIfChanged(core, address, digest), "")
+        core.GetConfig.assert_called_with(address)
+        mock_stats.add_value.assert_called_with("Core:config_unchanged", 1,
+                                                unit="")
+
+        self.assertEqual(Core.GetConfigIfChanged(core, address, "0" * 64),
+                         config)
+        mock_stats.add_value.assert_called_with("Core:config_unchanged", 0,
+                                                unit="")
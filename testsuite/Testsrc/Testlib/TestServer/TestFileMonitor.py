@@ -0,0 +1,115 @@
+import os
+import sys
+from mock import Mock, MagicMock, patch
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+
+from Bcfg2.Server.FileMonitor import *
+
+
+class TestFileMonitor(Bcfg2TestCase):
+    def setUp(self):
+        Bcfg2TestCase.setUp(self)
+        set_setup_default("debug", False)
+        set_setup_default("ignore_files", ["*~"])
+        set_setup_default("fam_debounce", None)
+
+    def get_obj(self):
+        fam = FileMonitor()
+        fam.started = True
+        return fam
+
+    def test_coalesce(self):
+        fam = self.get_obj()
+        events = []
+        last = dict()
+        self.assertTrue(fam.coalesce(events, Event(1, "foo", "created"),
+                                     last))
+        self.assertFalse(fam.coalesce(events, Event(1, "foo", "changed"),
+                                      last))
+        self.assertTrue(fam.coalesce(events, Event(1, "bar", "changed"),
+                                     last))
+        self.assertFalse(fam.coalesce(events, Event(1, "bar", "changed"),
+                                      last))
+        self.assertTrue(fam.coalesce(events, Event(2, "bar", "changed"),
+                                     last))
+        self.assertTrue(fam.coalesce(events, Event(1, "foo", "deleted"),
+                                     last))
+        self.assertTrue(fam.coalesce(events, Event(1, "foo", "created"),
+                                     last))
+        self.assertFalse(fam.coalesce(events, Event(1, "foo", "changed"),
+                                      last))
+        self.assertEqual([(e.requestID, e.filename, e.action)
+                          for e in events],
+                         [(1, "foo", "created"), (1, "bar", "changed"),
+                          (2, "bar", "changed"), (1, "foo", "deleted"),
+                          (1, "foo", "created")])
+        self.assertEqual(fam.coalesced, 3)
+
+    def test_handle_event_set(self):
+        fam = self.get_obj()
+        batch = Mock()
+        single = Mock(spec=["HandleEvent"])
+        fam.handles = {1: batch, 2: single, 3: batch}
+        fam.events.extend([Event(1, "foo", "changed"),
+                           Event(2, "bar", "changed"),
+                           Event(1, "foo", "changed"),
+                           Event(3, "baz", "created"),
+                           Event(2, "bar", "changed"),
+                           Event(2, "bar~", "changed"),
+                           Event(4, "quux", "changed")])
+        lock = Mock()
+        fam.handle_event_set(lock)
+        self.assertFalse(fam.pending())
+        self.assertEqual(batch.HandleEvents.call_count, 1)
+        self.assertEqual(
+            [(e.requestID, e.filename)
+             for e in batch.HandleEvents.call_args[0][0]],
+            [(1, "foo"), (3, "baz")])
+        self.assertEqual(single.HandleEvent.call_count, 1)
+        self.assertEqual(single.HandleEvent.call_args[0][0].filename, "bar")
+        self.assertEqual(lock.acquire.call_count, 2)
+        self.assertEqual(lock.release.call_count, 2)
+        self.assertEqual(fam.dispatched, 3)
+        self.assertEqual(fam.coalesced, 2)
+
+    def test_handle_event_set_errors(self):
+        fam = self.get_obj()
+        handler = Mock(spec=["HandleEvent"])
+        handler.HandleEvent.side_effect = ValueError
+        fam.handles = {1: handler}
+        fam.events.extend([Event(1, "foo", "changed"),
+                           Event(1, "bar", "changed")])
+        fam.handle_event_set()
+        self.assertEqual(handler.HandleEvent.call_count, 2)
+        self.assertFalse(fam.pending())
+
+    @patch("Bcfg2.Server.FileMonitor.sleep")
+    def test_debounce(self, mock_sleep):
+        fam = self.get_obj()
+        fam.debounce = 0.1
+        handler = Mock()
+        fam.handles = {1: handler}
+        fam.events.append(Event(1, "foo", "changed"))
+
+        # simulate a burst of events that continues after the first
+        # set of events has been collected
+        def more_events(_):
+            if mock_sleep.call_count < 3:
+                fam.events.append(Event(1, "foo", "changed"))
+
+        mock_sleep.side_effect = more_events
+        fam.handle_event_set()
+        self.assertEqual(mock_sleep.call_count, 3)
+        self.assertEqual(handler.HandleEvents.call_count, 1)
+        self.assertEqual(len(handler.HandleEvents.call_args[0][0]), 1)
+        self.assertEqual(fam.coalesced, 2)
@@ -0,0 +1,46 @@
+import os
+import sys
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+
+from Bcfg2.Server.Metrics import *
+
+
+class TestMetricFamily(Bcfg2TestCase):
+    def test_render(self):
+        family = MetricFamily("test_seconds", "summary", "Test\nhelp",
+                              unit="seconds")
+        family.add_sample(0.5, labels=dict(name='a"b', quantile="0.5"))
+        family.add_sample(3, labels=dict(name='a"b'), suffix="_count")
+        self.assertEqual(family.render().splitlines(),
+                         ['# TYPE test_seconds summary',
+                          '# UNIT test_seconds seconds',
+                          '# HELP test_seconds Test\\nhelp',
+                          'test_seconds{name="a\\"b",quantile="0.5"} 0.5',
+                          'test_seconds_count{name="a\\"b"} 3'])
+
+    def test_render_all(self):
+        family = MetricFamily("test", "gauge", "Test")
+        family.add_sample(1)
+        self.assertEqual(render([family]),
+                         "# TYPE test gauge\n# HELP test Test\ntest 1\n"
+                         "# EOF\n")
+        self.assertEqual(render([]), "# EOF\n")
+
+
+class TestParseAddress(Bcfg2TestCase):
+    def test_parse_address(self):
+        self.assertEqual(parse_address("9213"), ("localhost", 9213))
+        self.assertEqual(parse_address(":9213"), ("localhost", 9213))
+        self.assertEqual(parse_address("0.0.0.0:9213"), ("0.0.0.0", 9213))
+        self.assertEqual(parse_address("[::1]:9213"), ("::1", 9213))
+        self.assertRaises(ValueError, parse_address, "localhost:foo")
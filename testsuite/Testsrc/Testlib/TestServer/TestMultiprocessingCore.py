@@ -0,0 +1,161 @@
+import os
+import sys
+import threading
+from itertools import cycle
+import Bcfg2.Options
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+
+try:
+    from Bcfg2.Server.MultiprocessingCore import RPCQueue, RPCError, \
+        MultiprocessingCore
+    HAS_MULTIPROCESSING = True
+except ImportError:
+    HAS_MULTIPROCESSING = False
+
+
+class TestRPCQueue(Bcfg2TestCase):
+    @skipUnless(HAS_MULTIPROCESSING, "multiprocessing core not available")
+    def setUp(self):
+        Bcfg2TestCase.setUp(self)
+        set_setup_default("debug", False)
+        self.queue = RPCQueue()
+        self.queue.poll_wait = 0.1
+
+    def tearDown(self):
+        self.queue.close()
+
+    def test_rpc(self):
+        pipe = self.queue.add_subscriber("child")
+        results = []
+
+        def respond():
+            # read two requests, then answer them in reverse order to
+            # ensure that responses are matched to the right caller
+            requests = [pipe.recv(), pipe.recv()]
+            for reqid, (method, args, kwargs) in reversed(requests):
+                pipe.send((reqid, True, (method, args[0])))
+
+        def call(arg):
+            results.append(self.queue.rpc("child", "echo", args=[arg]))
+
+        responder = threading.Thread(target=respond)
+        responder.start()
+        callers = [threading.Thread(target=call, args=[arg])
+                   for arg in ["foo", "bar"]]
+        for caller in callers:
+            caller.start()
+        for thread in callers + [responder]:
+            thread.join()
+        self.assertItemsEqual(results, [("echo", "foo"), ("echo", "bar")])
+
+    def test_rpc_error(self):
+        pipe = self.queue.add_subscriber("child")
+
+        def respond():
+            reqid = pipe.recv()[0]
+            pipe.send((reqid, False, "oops"))
+
+        responder = threading.Thread(target=respond)
+        responder.start()
+        self.assertRaises(RPCError, self.queue.rpc, "child", "echo")
+        responder.join()
+
+    def test_publish(self):
+        pipes = [self.queue.add_subscriber("child1"),
+                 self.queue.add_subscriber("child2")]
+        self.queue.publish("expire_cache", args=["Metadata"])
+        for pipe in pipes:
+            self.assertEqual(pipe.recv(),
+                             (None, ("expire_cache", ["Metadata"], dict())))
+
+
+class TestMultiprocessingCore(Bcfg2TestCase):
+    @skipUnless(HAS_MULTIPROCESSING, "multiprocessing core not available")
+    def setUp(self):
+        Bcfg2TestCase.setUp(self)
+        patcher = patch("Bcfg2.Options.setup.child_affinity", False,
+                        create=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_core(self, children=3):
+        """ Get a core with the given number of children, without
+        starting them """
+        core = MultiprocessingCore.__new__(MultiprocessingCore)
+        core.logger = MagicMock()
+        core.rpc_q = MagicMock()
+        core.resolve_client = lambda address: (address[0], None)
+        core._all_children = ["Child-%d" % i for i in range(children)]
+        core.children = cycle(core._all_children)
+        core.in_flight = dict((c, 0) for c in core._all_children)
+        core._in_flight_lock = threading.Lock()
+        core._affinity = dict()
+        return core
+
+    def test_select_child(self):
+        core = self.get_core()
+
+        # idle children are used round-robin
+        self.assertEqual([core._select_child("foo") for _ in range(4)],
+                         ["Child-0", "Child-1", "Child-2", "Child-0"])
+
+        # the least loaded child is used
+        core.in_flight.update({"Child-0": 2, "Child-1": 1, "Child-2": 3})
+        self.assertEqual(core._select_child("foo"), "Child-1")
+        core.in_flight["Child-1"] = 3
+        self.assertEqual(core._select_child("foo"), "Child-0")
+
+        # ties are broken round-robin
+        core.in_flight.update({"Child-0": 1, "Child-1": 1, "Child-2": 1})
+        self.assertItemsEqual([core._select_child("foo") for _ in range(3)],
+                              core._all_children)
+
+    def test_select_child_affinity(self):
+        Bcfg2.Options.setup.child_affinity = True
+        core = self.get_core()
+        self.assertEqual(core._select_child("foo"), "Child-0")
+        self.assertEqual(core._select_child("bar"), "Child-1")
+
+        # a client goes back to the same child while it is no busier
+        # than the others
+        self.assertEqual(core._select_child("foo"), "Child-0")
+        self.assertEqual(core._select_child("bar"), "Child-1")
+        core.in_flight.update({"Child-0": 1, "Child-1": 1, "Child-2": 1})
+        self.assertEqual(core._select_child("foo"), "Child-0")
+        self.assertEqual(core._select_child("bar"), "Child-1")
+
+        # but not if it is busier
+        core.in_flight["Child-0"] = 2
+        self.assertNotEqual(core._select_child("foo"), "Child-0")
+        self.assertEqual(core._affinity["foo"],
+                         core._select_child("foo"))
+
+    @patch("Bcfg2.Server.Statistics.stats", MagicMock())
+    def test_GetConfig(self):
+        core = self.get_core(children=2)
+        address = ("foo", 12345)
+
+        def rpc(childname, method, args=None):
+            self.assertEqual(core.in_flight[childname], 1)
+            return "<Configuration/>"
+
+        core.rpc_q.rpc.side_effect = rpc
+        self.assertEqual(core.GetConfig(address), "<Configuration/>")
+        core.rpc_q.rpc.assert_called_with("Child-0", "GetConfig",
+                                          args=["foo"])
+        self.assertEqual(core.in_flight, {"Child-0": 0, "Child-1": 0})
+
+        # the count is decremented if the call fails
+        core.rpc_q.rpc.side_effect = RPCError("failed")
+        self.assertRaises(RPCError, core.GetConfig, address)
+        self.assertEqual(core.in_flight, {"Child-0": 0, "Child-1": 0})
@@ -1,9 +1,12 @@
 import os
 import sys
 import copy
+import shutil
 import genshi
+import tempfile
 import lxml.etree
 import Bcfg2.Server
+import Bcfg2.Server.Snapshot
 import genshi.core
 from Bcfg2.Compat import reduce
 from mock import Mock, MagicMock, patch
@@ -613,6 +616,45 @@ class TestXMLFileBacked(TestFileBacked):
         self.assertItemsEqual([tostring(e) for e in xfb.entries],
                               [tostring(e) for e in children])
 
+    @patch("Bcfg2.Server.FileMonitor.get_fam", Mock())
+    def test_snapshot(self):
+        set_setup_default("snapshot", None)
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, "test.xml")
+        incdir = os.path.join(tmpdir, "inc")
+        os.mkdir(incdir)
+        open(path, "w").write(
+            '<Test xmlns:xi="http://www.w3.org/2001/XInclude" name="test">'
+            '<xi:include href="inc/*.xml"/></Test>')
+        open(os.path.join(incdir, "test2.xml"), "w").write(
+            '<Test name="test2"><Foo/></Test>')
+        key = ("XMLFileBacked", path)
+        try:
+            Bcfg2.Server.Snapshot.load(os.path.join(tmpdir, "snapshot"))
+            xfb = XMLFileBacked(path, should_monitor=False)
+            xfb.HandleEvent()
+            self.assertItemsEqual(xfb.signatures.keys(),
+                                  [path, incdir, os.path.join(incdir, "*.xml"),
+                                   os.path.join(incdir, "test2.xml")])
+            self.assertIsNotNone(Bcfg2.Server.Snapshot.get(key))
+
+            # a file that changes while the data is being built is
+            # not stored
+            Bcfg2.Server.Snapshot.load(os.path.join(tmpdir, "snapshot"))
+            xfb = XMLFileBacked(path, should_monitor=False)
+            follow = xfb._follow_xincludes
+
+            def follow_xincludes(*args, **kwargs):
+                follow(*args, **kwargs)
+                open(os.path.join(incdir, "test3.xml"), "w").write(
+                    '<Test name="test3"/>')
+            xfb._follow_xincludes = follow_xincludes
+            xfb.HandleEvent()
+            self.assertIsNone(Bcfg2.Server.Snapshot.get(key))
+        finally:
+            Bcfg2.Server.Snapshot.load()
+            shutil.rmtree(tmpdir)
+
     @patch("Bcfg2.Server.FileMonitor.get_fam", Mock())
     def test_add_monitor(self):
         xfb = self.get_obj()
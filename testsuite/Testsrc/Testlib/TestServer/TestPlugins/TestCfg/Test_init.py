@@ -2,11 +2,15 @@ import os
 import sys
 import errno
 import lxml.etree
+from hashlib import sha256
 import Bcfg2.Options
+import Bcfg2.Server.Cache
 from Bcfg2.Compat import walk_packages, ConfigParser
 from mock import Mock, MagicMock, patch
 from Bcfg2.Server.Plugins.Cfg import *
-from Bcfg2.Server.Plugin import PluginExecutionError, Specificity
+from Bcfg2.Server.Plugin import PluginExecutionError, Specificity, \
+    OnDemandDict
+from Bcfg2.Server.Plugins.Packages import Packages
 
 # add all parent testsuite directories to sys.path to allow (most)
 # relative imports in python 2.4
@@ -348,6 +352,9 @@ class TestCfgEntrySet(TestEntrySet):
         TestEntrySet.setUp(self)
         set_setup_default("cfg_validation", False)
         set_setup_default("cfg_handlers", [])
+        set_setup_default("cfg_template_cache", "off")
+        set_setup_default("cfg_template_cache_size", None)
+        set_setup_default("cfg_template_cache_ttl", None)
 
     def test__init(self):
         pass
@@ -493,6 +500,10 @@ class TestCfgEntrySet(TestEntrySet):
         mock_u_str.side_effect = lambda x: x
 
         Bcfg2.Options.setup.cfg_validation = False
+        set_setup_default("encoding", "UTF-8")
+
+        def digest(data):
+            return "sha256:%s" % sha256(data.encode("UTF-8")).hexdigest()
         eset = self.get_obj()
         eset.bind_info_to_entry = Mock()
         eset._generate_data = Mock()
@@ -519,7 +530,9 @@ class TestCfgEntrySet(TestEntrySet):
         eset.bind_info_to_entry.assert_called_with(entry, metadata)
         eset._generate_data.assert_called_with(entry, metadata)
         self.assertFalse(eset._validate_data.called)
-        expected = lxml.etree.Element("Path", name="/test.txt")
+        expected = lxml.etree.Element("Path", name="/test.txt",
+                                      digest=digest("data"),
+                                      size=str(len("data")))
         expected.text = "data"
         self.assertXMLEqual(bound, expected)
         self.assertEqual(bound, entry)
@@ -552,7 +565,9 @@ class TestCfgEntrySet(TestEntrySet):
         filters[1].modify_data.assert_called_with(entry, metadata,
                                                   "modified data")
         self.assertFalse(eset._validate_data.called)
-        expected = lxml.etree.Element("Path", name="/test.txt")
+        expected = lxml.etree.Element("Path", name="/test.txt",
+                                      digest=digest("final data"),
+                                      size=str(len("final data")))
         expected.text = "final data"
         self.assertXMLEqual(bound, expected)
 
@@ -569,7 +584,9 @@ class TestCfgEntrySet(TestEntrySet):
         mock_b64encode.assert_called_with("data")
         self.assertFalse(mock_u_str.called)
         expected = lxml.etree.Element("Path", name="/test.txt",
-                                      encoding="base64")
+                                      encoding="base64",
+                                      digest=digest("data"),
+                                      size=str(len("data")))
         expected.text = "base64 data"
         self.assertXMLEqual(bound, expected)
         self.assertEqual(bound, entry)
@@ -581,7 +598,9 @@ class TestCfgEntrySet(TestEntrySet):
         eset.bind_info_to_entry.assert_called_with(entry, metadata)
         eset._generate_data.assert_called_with(entry, metadata)
         eset._validate_data.assert_called_with(entry, metadata, "data")
-        expected = lxml.etree.Element("Path", name="/test.txt")
+        expected = lxml.etree.Element("Path", name="/test.txt",
+                                      digest=digest("data"),
+                                      size=str(len("data")))
         expected.text = "data"
         self.assertXMLEqual(bound, expected)
         self.assertEqual(bound, entry)
@@ -655,6 +674,73 @@ class TestCfgEntrySet(TestEntrySet):
             if hasattr(entry.specific.matches, "called"):
                 self.assertFalse(entry.specific.matches.called)
 
+    def test_get_handlers_indexed(self):
+        eset = self.get_obj()
+        eset.entries['test.txt'] = \
+            CfgGenerator("test.txt", Specificity(all=True))
+        eset.entries['test.txt.G10_group1'] = \
+            CfgGenerator("test.txt.G10_group1",
+                         Specificity(group="group1", prio=10))
+        eset.entries['test.txt.G20_group2'] = \
+            CfgGenerator("test.txt.G20_group2",
+                         Specificity(group="group2", prio=20))
+        eset.entries['test.txt.H_foo.example.com'] = \
+            CfgGenerator("test.txt.H_foo.example.com",
+                         Specificity(hostname="foo.example.com"))
+        eset.entries['info.xml'] = CfgInfo("info.xml")
+
+        foo = Mock()
+        foo.hostname = "foo.example.com"
+        foo.groups = set(["group1", "group3"])
+        self.assertEqual(eset.get_handlers(foo, CfgGenerator),
+                         [eset.entries['test.txt'],
+                          eset.entries['test.txt.G10_group1'],
+                          eset.entries['test.txt.H_foo.example.com']])
+        self.assertEqual(eset.get_handlers(foo, CfgInfo),
+                         [eset.entries['info.xml']])
+
+        bar = Mock()
+        bar.hostname = "bar.example.com"
+        bar.groups = set(["group1", "group2", "group4"])
+        self.assertEqual(eset.get_handlers(bar, CfgGenerator),
+                         [eset.entries['test.txt'],
+                          eset.entries['test.txt.G10_group1'],
+                          eset.entries['test.txt.G20_group2']])
+        self.assertEqual(eset.best_matching(bar,
+                                            eset.get_handlers(bar,
+                                                              CfgGenerator)),
+                         eset.entries['test.txt.G20_group2'])
+
+        # modifying the returned list doesn't affect later results
+        eset.get_handlers(bar, CfgGenerator).pop()
+        self.assertEqual(len(eset.get_handlers(bar, CfgGenerator)), 3)
+
+        # test that the index is rebuilt when entries change
+        evt = Mock()
+        evt.code2str.return_value = "deleted"
+        evt.filename = 'test.txt.G20_group2'
+        eset.handle_event(evt)
+        self.assertEqual(eset.get_handlers(bar, CfgGenerator),
+                         [eset.entries['test.txt'],
+                          eset.entries['test.txt.G10_group1']])
+
+        # a list built from an index that is replaced while it is
+        # being built must not end up in the new cache
+        get_handler_index = eset._get_handler_index
+
+        def expire_during_build(handler_type):
+            rv = get_handler_index(handler_type)
+            del eset.entries['test.txt']
+            eset.expire_handler_index()
+            return rv
+
+        eset._get_handler_index = expire_during_build
+        self.assertEqual(len(eset.get_handlers(foo, CfgGenerator)), 3)
+        eset._get_handler_index = get_handler_index
+        self.assertEqual(eset.get_handlers(foo, CfgGenerator),
+                         [eset.entries['test.txt.G10_group1'],
+                          eset.entries['test.txt.H_foo.example.com']])
+
     @patch("Bcfg2.Server.Plugins.Cfg.CfgDefaultInfo")
     def test_bind_info_to_entry(self, mock_DefaultInfo):
         eset = self.get_obj()
@@ -770,6 +856,180 @@ class TestCfgEntrySet(TestEntrySet):
                                               eset.get_handlers.return_value)
         eset._create_data.assert_called_with(entry, metadata)
 
+    def test_render_data(self):
+        Bcfg2.Server.Cache.expire("Cfg", "render")
+        eset = self.get_obj()
+        generator = Mock()
+        generator.name = os.path.join(datastore, "test.txt.genshi")
+        generator.cacheable = True
+        generator.get_data.side_effect = lambda e, m: "data for %s" % \
+            m.hostname
+        entry = lxml.etree.Element("Path", name="/test.txt", mode="0640")
+
+        def get_metadata(hostname, groups):
+            metadata = Mock()
+            metadata.hostname = hostname
+            metadata.groups = set(groups)
+            metadata.bundles = set()
+            metadata.profile = groups[0]
+            metadata.categories = dict()
+            metadata.aliases = set()
+            metadata.addresses = set()
+            metadata.connectors = []
+            metadata.version = None
+            return metadata
+
+        foo = get_metadata("foo.example.com", ["group1", "group2"])
+        bar = get_metadata("bar.example.com", ["group1", "group2"])
+        baz = get_metadata("baz.example.com", ["group1"])
+
+        # test with the cache disabled
+        Bcfg2.Options.setup.cfg_template_cache = "off"
+        self.assertEqual(eset._render_data(generator, entry, foo),
+                         "data for foo.example.com")
+        self.assertEqual(eset._render_data(generator, entry, foo),
+                         "data for foo.example.com")
+        self.assertEqual(generator.get_data.call_count, 2)
+
+        # test per-client caching
+        generator.get_data.reset_mock()
+        Bcfg2.Options.setup.cfg_template_cache = "client"
+        self.assertEqual(eset._render_data(generator, entry, foo),
+                         "data for foo.example.com")
+        self.assertEqual(eset._render_data(generator, entry, foo),
+                         "data for foo.example.com")
+        self.assertEqual(eset._render_data(generator, entry, bar),
+                         "data for bar.example.com")
+        self.assertEqual(generator.get_data.call_count, 2)
+
+        # test caching by group set
+        generator.get_data.reset_mock()
+        Bcfg2.Options.setup.cfg_template_cache = "groups"
+        self.assertEqual(eset._render_data(generator, entry, foo),
+                         "data for foo.example.com")
+        self.assertEqual(eset._render_data(generator, entry, bar),
+                         "data for foo.example.com")
+        self.assertEqual(eset._render_data(generator, entry, baz),
+                         "data for baz.example.com")
+        self.assertEqual(generator.get_data.call_count, 2)
+
+        # test that different entry attributes are cached separately
+        generator.get_data.reset_mock()
+        altentry = lxml.etree.Element("Path", name="/test2.txt",
+                                      altsrc="/test.txt", mode="0640")
+        eset._render_data(generator, altentry, foo)
+        self.assertEqual(generator.get_data.call_count, 1)
+
+        # test that connector data that can't be fingerprinted
+        # disables caching
+        generator.get_data.reset_mock()
+        qux = get_metadata("qux.example.com", ["group1"])
+        qux.connectors = ["Ldap"]
+        qux.Ldap = dict(query=lambda: None)
+        eset._render_data(generator, entry, qux)
+        eset._render_data(generator, entry, qux)
+        self.assertEqual(generator.get_data.call_count, 2)
+
+        # test that non-cacheable generators are not cached
+        generator.get_data.reset_mock()
+        generator.cacheable = False
+        eset._render_data(generator, entry, foo)
+        self.assertEqual(generator.get_data.call_count, 1)
+        generator.cacheable = True
+
+        # test expiring the cache
+        generator.get_data.reset_mock()
+        generator.__class__ = CfgGenerator
+        eset.entries = {"test.txt.genshi": generator}
+        eset.expire_render_cache("test.txt.genshi")
+        eset._render_data(generator, entry, foo)
+        self.assertEqual(generator.get_data.call_count, 1)
+        Bcfg2.Options.setup.cfg_template_cache = "off"
+
+    @patch("Bcfg2.Server.Snapshot.signature")
+    def test_render_data_connectors(self, mock_signature):
+        Bcfg2.Server.Cache.expire("Cfg", "render")
+        eset = self.get_obj()
+        generator = Mock()
+        generator.name = os.path.join(datastore, "test.txt.genshi")
+        generator.cacheable = True
+        generator.get_data.side_effect = lambda e, m: "data for %s" % \
+            m.hostname
+        entry = lxml.etree.Element("Path", name="/test.txt", mode="0640")
+
+        packages = Packages.__new__(Packages)
+        packages.name = "Packages"
+        helper = HelperModule(os.path.join(datastore, "TemplateHelper",
+                                           "helper.py"), Mock())
+        sources = [dict(url="http://example.com/repo", arches=["x86_64"],
+                        components=["main"])]
+        mock_signature.return_value = (1, 2, 3)
+
+        def get_metadata(hostname):
+            metadata = Mock()
+            metadata.hostname = hostname
+            metadata.groups = set(["group1"])
+            metadata.bundles = set()
+            metadata.profile = "group1"
+            metadata.categories = dict()
+            metadata.aliases = set()
+            metadata.addresses = set()
+            metadata.version = None
+            metadata.connectors = ["Packages", "TemplateHelper"]
+            metadata.Packages = OnDemandDict(
+                sources=lambda: sources,
+                get_config=lambda: packages.get_config)
+            metadata.TemplateHelper = dict(helper=helper)
+            return metadata
+
+        Bcfg2.Options.setup.cfg_template_cache = "groups"
+        self.assertEqual(eset._render_data(generator, entry,
+                                           get_metadata("foo.example.com")),
+                         "data for foo.example.com")
+        self.assertEqual(eset._render_data(generator, entry,
+                                           get_metadata("bar.example.com")),
+                         "data for foo.example.com")
+        self.assertEqual(generator.get_data.call_count, 1)
+
+        # changing the helper module re-renders the template
+        mock_signature.return_value = (4, 5, 6)
+        self.assertEqual(eset._render_data(generator, entry,
+                                           get_metadata("bar.example.com")),
+                         "data for bar.example.com")
+        self.assertEqual(generator.get_data.call_count, 2)
+        mock_signature.assert_called_with(helper.name)
+
+        # changing the Packages sources re-renders the template
+        sources[0]['url'] = "http://example.com/other"
+        self.assertEqual(eset._render_data(generator, entry,
+                                           get_metadata("foo.example.com")),
+                         "data for foo.example.com")
+        self.assertEqual(generator.get_data.call_count, 3)
+        Bcfg2.Options.setup.cfg_template_cache = "off"
+
+    @patch("Bcfg2.Server.Plugins.Cfg._UNFINGERPRINTABLE", set())
+    @patch("Bcfg2.Server.Plugins.Cfg.LOGGER")
+    def test_get_metadata_fingerprint(self, mock_logger):
+        metadata = Mock()
+        metadata.groups = set(["group1"])
+        metadata.bundles = set()
+        metadata.profile = "group1"
+        metadata.categories = dict()
+        metadata.version = None
+        metadata.connectors = ["Ldap"]
+        metadata.Ldap = dict(query=lambda: None)
+
+        Bcfg2.Options.setup.cfg_template_cache = "groups"
+        self.assertIsNone(get_metadata_fingerprint(metadata))
+        self.assertTrue(mock_logger.warning.called)
+
+        # the connector is only logged once
+        mock_logger.reset_mock()
+        metadata = Mock(connectors=["Ldap"], Ldap=dict(query=lambda: None),
+                        groups=set(), bundles=set(), categories=dict())
+        self.assertIsNone(get_metadata_fingerprint(metadata))
+        self.assertFalse(mock_logger.warning.called)
+        Bcfg2.Options.setup.cfg_template_cache = "off"
 
     def test_validate_data(self):
         class MockChild1(Mock):
@@ -5,6 +5,7 @@ import time
 import socket
 import lxml.etree
 import Bcfg2.Server
+import Bcfg2.Server.Cache
 import Bcfg2.Server.Plugin
 from mock import Mock, MagicMock, patch
 
@@ -475,6 +476,31 @@ class TestClientMetadata(Bcfg2TestCase):
         self.assertFalse(cm.inGroup("group3"))
 
 
+class TestSessionCache(Bcfg2TestCase):
+    def test_expire(self):
+        cache = SessionCache()
+        now = time.time()
+        cache[('1.2.3.3', None)] = (now - 100, 'client3')
+        cache[('1.2.3.3', 6789)] = (now, 'client3')
+        cache[('1.2.3.4', None)] = (now - 100, 'client4')
+        cache.expire('1.2.3.3', 90)
+        self.assertEqual(cache, {('1.2.3.3', 6789): (now, 'client3'),
+                                 ('1.2.3.4', None): (now - 100, 'client4')})
+
+        # refreshed entries are not expired by their old timestamps
+        cache[('1.2.3.4', None)] = (now, 'client4')
+        cache.expire('1.2.3.4', 90)
+        self.assertIn(('1.2.3.4', None), cache)
+
+        cache[('1.2.3.4', None)] = (now - 100, 'client4')
+        cache.expire('1.2.3.4', 90)
+        self.assertNotIn(('1.2.3.4', None), cache)
+
+        # expiring an unknown address is a no-op
+        cache.expire('1.2.3.5', 90)
+        self.assertEqual(list(cache.keys()), [('1.2.3.3', 6789)])
+
+
 class TestMetadata(_TestMetadata, TestClientRunHooks, TestDatabaseBacked):
     test_obj = Metadata
 
@@ -1036,6 +1062,87 @@ class TestMetadata(_TestMetadata, TestClientRunHooks, TestDatabaseBacked):
                          (set(["group1", "group8", "group9", "group10"]),
                           dict(group1="category1")))
 
+    @patch("Bcfg2.Server.Plugins.Metadata.XMLMetadataConfig.load_xml", Mock())
+    def test_merge_groups_rules(self):
+        xdata = lxml.etree.XML("""
+<Groups>
+  <Group name="base"/>
+  <Group name="web" category="role"/>
+  <Group name="db" category="role"/>
+  <Group name="ssl"/>
+  <Group name="apache"/>
+  <Group name="nginx"/>
+  <Group name="dmz"/>
+  <Group name="monitored"/>
+  <Group name="unmonitored"/>
+  <Group name="retired"/>
+  <Group name="legacy"/>
+  <Group name="modern"/>
+  <Client name="client1">
+    <Group name="base">
+      <Group name="ssl"/>
+    </Group>
+  </Client>
+  <Group name="web">
+    <Group name="apache"/>
+    <Client name="client2" negate="true">
+      <Group name="nginx"/>
+    </Client>
+  </Group>
+  <Group name="dmz">
+    <Group name="monitored" negate="true"/>
+    <Group name="monitored" negate="true">
+      <Group name="unmonitored"/>
+    </Group>
+  </Group>
+  <Group name="retired">
+    <Group name="web" negate="true"/>
+  </Group>
+  <Group name="base">
+    <Group name="db"/>
+  </Group>
+  <Group name="legacy" negate="true">
+    <Group name="modern"/>
+  </Group>
+</Groups>""").getroottree()
+        metadata = self.load_groups_data(xdata=xdata)
+
+        def merge(client, groups, categories=None):
+            return metadata._merge_groups(client, set(groups),
+                                          categories=categories)
+
+        # nested Client and Group conditions
+        self.assertEqual(merge("client1", ["base"]),
+                         (set(["base", "ssl", "db", "modern"]),
+                          dict(role="db")))
+        self.assertEqual(merge("client3", ["base"]),
+                         (set(["base", "db", "modern"]), dict(role="db")))
+        self.assertEqual(merge("client2", ["web"], dict(role="web")),
+                         (set(["web", "apache", "modern"]), dict(role="web")))
+        self.assertEqual(merge("client3", ["web"], dict(role="web")),
+                         (set(["web", "apache", "nginx", "modern"]),
+                          dict(role="web")))
+
+        # removing a negated group enables rules that depend on the
+        # client not being a member of it
+        self.assertEqual(merge("client3", ["dmz", "monitored", "legacy"]),
+                         (set(["dmz", "unmonitored", "legacy"]), dict()))
+        self.assertEqual(merge("client3", ["dmz"]),
+                         (set(["dmz", "unmonitored", "modern"]), dict()))
+
+        # removing a negated group frees its category for another
+        # group that was excluded by it
+        self.assertEqual(
+            merge("client3", ["base", "web", "retired"], dict(role="web")),
+            (set(["base", "retired", "apache", "nginx", "db", "modern"]),
+             dict(role="db")))
+
+        # rules with only negative conditions apply to all clients
+        # that do not match them
+        self.assertEqual(merge("client3", []), (set(["modern"]), dict()))
+        self.assertEqual(merge("client3", ["legacy"]),
+                         (set(["legacy"]), dict()))
+
     @patch("Bcfg2.Server.Plugins.Metadata.XMLMetadataConfig.load_xml", Mock())
     def test_get_all_group_names(self):
         metadata = self.load_groups_data()
@@ -1075,6 +1182,51 @@ class TestMetadata(_TestMetadata, TestClientRunHooks, TestDatabaseBacked):
                               [c.get("name")
                                for c in get_clients_test_tree().findall("//Client[@profile='group2']")])
 
+    @patch("Bcfg2.Server.Plugins.Metadata.XMLMetadataConfig.load_xml", Mock())
+    def test_get_client_names_indexed(self):
+        metadata = self.load_clients_data(metadata=self.load_groups_data())
+        metadata.core.build_metadata = Mock()
+        metadata.core.build_metadata.side_effect = \
+            lambda c: metadata.get_initial_metadata(c)
+        # get the expected results by building metadata for every
+        # client, since clients in the database have no profiles
+        metadata.core.metadata_cache_mode = 'off'
+        profile = metadata.get_initial_metadata(
+            sorted(metadata.list_clients())[0]).profile
+        expected = metadata.get_client_names_by_groups([profile])
+        self.assertItemsEqual(
+            metadata.get_client_names_by_profiles([profile]), expected)
+
+        metadata.core.metadata_cache_mode = 'cautious'
+        metadata.core.build_metadata.reset_mock()
+        self.assertItemsEqual(metadata.get_client_names_by_groups([profile]),
+                              expected)
+        self.assertEqual(metadata.core.build_metadata.call_count,
+                         len(metadata.list_clients()))
+
+        # further queries are answered from the index
+        metadata.core.build_metadata.reset_mock()
+        self.assertItemsEqual(
+            metadata.get_client_names_by_profiles([profile]), expected)
+        self.assertItemsEqual(metadata.get_client_names_by_groups([]),
+                              metadata.list_clients())
+        self.assertItemsEqual(metadata.get_client_names_by_profiles([]), [])
+        self.assertFalse(metadata.core.build_metadata.called)
+
+        # expiring a client's cached metadata rebuilds only that client
+        Bcfg2.Server.Cache.expire("Metadata", expected[0], exact=True)
+        self.assertItemsEqual(metadata.get_client_names_by_groups([profile]),
+                              expected)
+        metadata.core.build_metadata.assert_called_once_with(expected[0])
+
+        # expiring all cached metadata rebuilds every client
+        metadata.core.build_metadata.reset_mock()
+        Bcfg2.Server.Cache.expire("Metadata")
+        self.assertItemsEqual(metadata.get_client_names_by_groups([profile]),
+                              expected)
+        self.assertEqual(metadata.core.build_metadata.call_count,
+                         len(metadata.list_clients()))
+
     @patch("Bcfg2.Server.Plugins.Metadata.XMLMetadataConfig.load_xml", Mock())
     def test_merge_additional_groups(self):
         metadata = self.load_clients_data(metadata=self.load_groups_data())
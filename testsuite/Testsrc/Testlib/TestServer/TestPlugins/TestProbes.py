@@ -92,9 +92,17 @@ class TestProbeData(Bcfg2TestCase):
 class TestProbeSet(TestEntrySet):
     test_obj = ProbeSet
     basenames = ["test", "_test", "test-test"]
-    ignore = ["foo~", ".#foo", ".foo.swp", ".foo.swx", "probed.xml"]
+    ignore = ["foo~", ".#foo", ".foo.swp", ".foo.swx", "probed.xml",
+              "probed.xml.journal"]
     bogus_names = ["test.py"]
 
+    def setUp(self):
+        TestEntrySet.setUp(self)
+        Bcfg2.Server.Cache.expire("Probes")
+
+    def tearDown(self):
+        Bcfg2.Server.Cache.expire("Probes")
+
     def get_obj(self, path=datastore, encoding=None,
                 plugin_name="Probes", basename=None):
         # get_obj() accepts the basename argument, accepted by the
@@ -127,6 +135,12 @@ class TestProbeSet(TestEntrySet):
         ps.HandleEvent(evt)
         self.assertFalse(ps.handle_event.called)
 
+        # test that events on the probe data journal are skipped
+        evt.reset_mock()
+        evt.filename = "probed.xml.journal"
+        ps.HandleEvent(evt)
+        self.assertFalse(ps.handle_event.called)
+
         # test that other events are processed appropriately
         evt.reset_mock()
         evt.filename = "fooprobe"
@@ -165,7 +179,11 @@ group-specific"""
         p3 = Mock()
         p3.specific = Bcfg2.Server.Plugin.Specificity(all=True)
         p3.name = "barprobe"
-        p3.data = "#! /usr/bin/env python"
+        p3.data = """#! /usr/bin/env python
+# a probe that takes a while
+# timeout: 120
+# timeout: 60
+"""
         matching.append(p3)
 
         p4 = Mock()
@@ -192,14 +210,49 @@ group-specific"""
             if probe.get("name") == "fooprobe":
                 self.assertIn("group-specific", probe.text)
                 self.assertEqual(probe.get("interpreter"), "/bin/bash")
+                self.assertIsNone(probe.get("timeout"))
             elif probe.get("name") == "barprobe":
                 self.assertEqual(probe.get("interpreter"),
                                  "/usr/bin/env python")
+                self.assertEqual(probe.get("timeout"), "120")
             elif probe.get("name") == "bazprobe":
                 self.assertIsNotNone(probe.get("interpreter"))
+                self.assertIsNone(probe.get("timeout"))
             else:
                 assert False, "Strange probe found in get_probe_data() return"
 
+    def test_get_probe_data_cached(self):
+        ps = self.get_obj()
+        p1 = Mock()
+        p1.specific = Bcfg2.Server.Plugin.Specificity(all=True)
+        p1.name = "fooprobe"
+        p1.data = "#!/bin/bash\nfoo"
+        ps.get_matching = Mock()
+        ps.get_matching.side_effect = lambda m: [p1]
+        metadata = Mock()
+        metadata.version_info = \
+            Bcfg2.version.Bcfg2VersionInfo(Bcfg2.version.__version__)
+
+        pdata = ps.get_probe_data(metadata)
+        self.assertEqual([p.get("name") for p in pdata], ["fooprobe"])
+
+        # a second client with the same probes gets a copy of the
+        # cached probe list
+        pdata[0].set("fingerprint", "abc")
+        p1.data = "#!/bin/bash\nbar"
+        pdata2 = ps.get_probe_data(metadata)
+        self.assertEqual(pdata2[0].text, "#!/bin/bash\nfoo")
+        self.assertIsNone(pdata2[0].get("fingerprint"))
+        self.assertIsNot(pdata[0], pdata2[0])
+
+        # changes to probes expire the cache
+        evt = Mock()
+        evt.filename = "fooprobe"
+        ps.handle_event = Mock()
+        ps.HandleEvent(evt)
+        self.assertEqual(ps.get_probe_data(metadata)[0].text,
+                         "#!/bin/bash\nbar")
+
 
 class TestProbes(TestDatabaseBacked):
     test_obj = Probes
@@ -230,6 +283,8 @@ group:      group:with:colons
     def setUp(self):
         Bcfg2TestCase.setUp(self)
         set_setup_default("probes_db")
+        set_setup_default("probes_journal", False)
+        set_setup_default("probes_journal_size", 1000)
         set_setup_default("probes_allowed_groups", [re.compile(".*")])
         self.datastore = None
         Bcfg2.Server.Cache.expire("Probes")
@@ -260,8 +315,9 @@ group:      group:with:colons
     def test_GetProbes(self):
         p = self.get_obj()
         p.probes = Mock()
+        p.probes.get_probe_data.return_value = []
         metadata = Mock()
-        p.GetProbes(metadata)
+        self.assertEqual(p.GetProbes(metadata), [])
         p.probes.get_probe_data.assert_called_with(metadata)
 
     def additionalDataEqual(self, actual, expected):
@@ -274,6 +330,83 @@ group:      group:with:colons
         Bcfg2.Options.setup.probes_db = False
         self._perform_tests()
 
+    def test_probes_journal(self):
+        """ Set and retrieve probe data with the journal enabled """
+        Bcfg2.Options.setup.probes_db = False
+        Bcfg2.Options.setup.probes_journal = True
+        try:
+            self._perform_tests()
+            p = self.get_obj()
+            journal = os.path.join(p.data, "probed.xml.journal")
+            self.assertTrue(os.path.getsize(journal) > 0)
+
+            # merge the journal into probed.xml, and check that the
+            # data survives a restart without the journal
+            p.shutdown()
+            self.assertEqual(os.path.getsize(journal), 0)
+            Bcfg2.Options.setup.probes_journal = False
+            p = self.get_obj()
+            Bcfg2.Server.Cache.expire("Probes")
+            self.assertItemsEqual(
+                p.get_additional_groups(Mock(hostname="foo.example.com")),
+                ["group"])
+            self.assertItemsEqual(
+                p.get_additional_groups(Mock(hostname="bar.example.com")),
+                ["other_group"])
+        finally:
+            Bcfg2.Options.setup.probes_journal = False
+
+    def test_probes_fingerprints(self):
+        """ Skip unchanged probe results declared by the client """
+        Bcfg2.Options.setup.probes_db = False
+        p = self.get_obj()
+        p.probes = Mock()
+        p.probes.get_probe_data.side_effect = lambda m: [
+            lxml.etree.Element("probe", name=n, source="Probes")
+            for n in ["foo", "bar"]]
+        metadata = Mock(hostname="foo.example.com")
+
+        def probe_data(name, text=None, fingerprint=None, unchanged=False):
+            rv = lxml.etree.Element("probe-data", name=name,
+                                    source="Probes")
+            rv.text = text
+            if fingerprint is not None:
+                rv.set("fingerprint", fingerprint)
+            if unchanged:
+                rv.set("unchanged", "true")
+            return rv
+
+        # no fingerprints are sent before results have been received
+        self.assertItemsEqual([pr.get("fingerprint")
+                               for pr in p.GetProbes(metadata)],
+                              [None, None])
+
+        p.ReceiveData(metadata,
+                      [probe_data("foo", "group:foogroup\nfoo", "1"),
+                       probe_data("bar", "group:bargroup\nbar")])
+        self.assertEqual(dict((pr.get("name"), pr.get("fingerprint"))
+                              for pr in p.GetProbes(metadata)),
+                         dict(foo="1", bar=None))
+
+        # unchanged results keep the data and groups received earlier
+        p.ReceiveData(metadata,
+                      [probe_data("foo", fingerprint="1", unchanged=True),
+                       probe_data("bar", "bar2")])
+        self.assertItemsEqual(p.get_additional_groups(metadata),
+                              ["foogroup"])
+        self.additionalDataEqual(p.get_additional_data(metadata),
+                                 dict(foo="foo", bar="bar2"))
+
+        # results with unknown fingerprints keep the stored data
+        Bcfg2.Server.Cache.expire("Probes", "fingerprints")
+        p.ReceiveData(metadata,
+                      [probe_data("foo", fingerprint="1", unchanged=True),
+                       probe_data("bar", "group:bargroup\nbar3")])
+        self.assertItemsEqual(p.get_additional_groups(metadata),
+                              ["foogroup", "bargroup"])
+        self.additionalDataEqual(p.get_additional_data(metadata),
+                                 dict(foo="foo", bar="bar3"))
+
     @skipUnless(HAS_DJANGO, "Django not found")
     def test_probes_db(self):
         """ Set and retrieve probe data with database enabled """
@@ -281,6 +414,61 @@ group:      group:with:colons
         self.syncdb(TestProbesDB)
         self._perform_tests()
 
+    @skipUnless(HAS_DJANGO, "Django not found")
+    def test_probes_db_update(self):
+        """ Update existing probe records with database enabled """
+        Bcfg2.Options.setup.probes_db = True
+        self.syncdb(TestProbesDB)
+        p = self.get_obj()
+        hostname = "foo.example.com"
+        ProbesDataModel.objects.all().delete()
+        ProbesGroupsModel.objects.all().delete()
+        for probe, data in [("same", "same"), ("changed", "old"),
+                            ("dup", "dup"), ("dup", "dup"),
+                            ("removed", "removed")]:
+            ProbesDataModel.objects.create(hostname=hostname, probe=probe,
+                                           data=data)
+        for group in ["group", "group", "removed"]:
+            ProbesGroupsModel.objects.create(hostname=hostname, group=group)
+        ProbesDataModel.objects.create(hostname="bar.example.com",
+                                       probe="same", data="bar")
+        same = ProbesDataModel.objects.get(hostname=hostname, probe="same")
+
+        p.core.metadata_cache.expire.reset_mock()
+        p.probestore.set_data(hostname,
+                              dict(same=ProbeData("same"),
+                                   changed=ProbeData("new"),
+                                   dup=ProbeData("dup"),
+                                   added=ProbeData("added")))
+        p.core.metadata_cache.expire.assert_called_with(hostname)
+        self.assertItemsEqual(
+            [(r.probe, r.data)
+             for r in ProbesDataModel.objects.filter(hostname=hostname)],
+            [("same", "same"), ("changed", "new"), ("dup", "dup"),
+             ("added", "added")])
+        self.assertEqual(
+            ProbesDataModel.objects.get(hostname=hostname,
+                                        probe="same").timestamp,
+            same.timestamp)
+        self.assertEqual(
+            ProbesDataModel.objects.get(hostname="bar.example.com").data,
+            "bar")
+
+        p.probestore.set_groups(hostname, ["group", "added"])
+        self.assertItemsEqual(
+            [r.group
+             for r in ProbesGroupsModel.objects.filter(hostname=hostname)],
+            ["group", "added"])
+
+        # setting the same data again changes nothing
+        p.core.metadata_cache.expire.reset_mock()
+        p.probestore.set_data(hostname,
+                              dict(same=ProbeData("same"),
+                                   changed=ProbeData("new"),
+                                   dup=ProbeData("dup"),
+                                   added=ProbeData("added")))
+        self.assertFalse(p.core.metadata_cache.expire.called)
+
     def test_allowed_cgroups(self):
         """ Test option to only allow probes to set certain groups """
         probes = self.get_obj()
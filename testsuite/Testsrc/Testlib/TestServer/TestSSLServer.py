@@ -0,0 +1,168 @@
+import os
+import sys
+import time
+import socket
+import threading
+from Bcfg2.Compat import SimpleXMLRPCServer, SocketServer
+from Bcfg2.Server.SSLServer import XMLRPCRequestHandler, WorkerPoolMixIn
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+
+
+class TestXMLRPCRequestHandler(Bcfg2TestCase):
+    def get_handler(self):
+        handler = XMLRPCRequestHandler.__new__(XMLRPCRequestHandler)
+        handler.logger = MagicMock()
+        handler.requests = 0
+        handler.client_address = ("127.0.0.1", 12345)
+        handler.request = MagicMock()
+        handler.server = MagicMock()
+        handler.server.timeout = 10
+        handler.server.idle_timeout = 1
+        return handler
+
+    @patch.object(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler,
+                  "handle_one_request")
+    def test_handle_one_request(self, mock_handle_one_request):
+        handler = self.get_handler()
+
+        # the first request on a connection gets the full timeout
+        handler.handle_one_request()
+        mock_handle_one_request.assert_called_with(handler)
+        self.assertFalse(handler.request.settimeout.called)
+
+        # the worker only waits briefly for later requests
+        handler.requests = 1
+        handler.handle_one_request()
+        handler.request.settimeout.assert_called_with(1)
+
+    @patch.object(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler,
+                  "parse_request")
+    def test_parse_request(self, mock_parse_request):
+        # once the request line has been read, the rest of the
+        # request gets the full timeout
+        handler = self.get_handler()
+        mock_parse_request.return_value = False
+        self.assertFalse(handler.parse_request())
+        handler.request.settimeout.assert_called_with(10)
+
+    @patch.object(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler, "log_error")
+    def test_log_error(self, mock_log_error):
+        handler = self.get_handler()
+
+        # a connection that times out before its first request is
+        # logged as usual
+        handler.log_error("Request timed out: %r", socket.timeout())
+        self.assertTrue(mock_log_error.called)
+        self.assertFalse(handler.logger.debug.called)
+
+        # a keep-alive connection that times out between requests is
+        # only logged at debug level
+        mock_log_error.reset_mock()
+        handler.requests = 2
+        handler.log_error("Request timed out: %r", socket.timeout())
+        self.assertFalse(mock_log_error.called)
+        self.assertTrue(handler.logger.debug.called)
+
+        # other errors are always logged
+        handler.log_error("code %d, message %s", 400, "Bad request")
+        mock_log_error.assert_called_with(handler, "code %d, message %s",
+                                          400, "Bad request")
+
+
+class PoolServer(WorkerPoolMixIn, SocketServer.TCPServer):
+    workers = 1
+    queue_size = 1
+    retry_after = 7
+    timeout = 5
+
+    def __init__(self, RequestHandlerClass):
+        SocketServer.TCPServer.__init__(self, ("127.0.0.1", 0),
+                                        RequestHandlerClass)
+
+
+class TestWorkerPoolMixIn(Bcfg2TestCase):
+    def setUp(self):
+        Bcfg2TestCase.setUp(self)
+        self.release = threading.Event()
+        release = self.release
+
+        class Handler(SocketServer.StreamRequestHandler):
+            def handle(self):
+                release.wait(5)
+                self.wfile.write(b"ok")
+
+        self.server = PoolServer(Handler)
+        self.addCleanup(self.server.server_close)
+        self.server._start_workers()
+        self.addCleanup(self.server._stop_workers)
+        self.addCleanup(self.release.set)
+
+    def connect(self):
+        """ Hand a new connection to the server, and return the
+        client end """
+        client, request = socket.socketpair()
+        client.settimeout(5)
+        self.addCleanup(client.close)
+        self.server.process_request(request, ("127.0.0.1", 12345))
+        return client
+
+    def wait_for(self, func):
+        deadline = time.time() + 5
+        while not func() and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(func())
+
+    def read(self, client):
+        data = b""
+        while True:
+            chunk = client.recv(1024)
+            if not chunk:
+                return data
+            data += chunk
+
+    def test_reject(self):
+        self.assertFalse(self.server.saturated())
+
+        # the first request is handled by the only worker, and the
+        # second waits for it
+        busy = self.connect()
+        self.wait_for(lambda: self.server.active == 1)
+        queued = self.connect()
+        self.assertEqual(self.server.queued(), 1)
+        self.assertTrue(self.server.saturated())
+
+        # the third does not fit in the queue, and is rejected
+        rejected = self.connect()
+        rejected.sendall(b"POST /RPC2 HTTP/1.1\r\n"
+                         b"Content-Length: 9\r\n\r\n<request/>")
+        response = self.read(rejected)
+        self.assertTrue(response.startswith(b"HTTP/1.1 503 "))
+        self.assertIn(b"Retry-After: 7\r\n", response)
+        self.assertIn(b"Connection: close\r\n", response)
+        self.assertEqual(self.server.rejected, 1)
+        self.assertEqual(self.server.active, 1)
+
+        # once the worker is released, it handles the queued request
+        self.release.set()
+        self.assertEqual(self.read(busy), b"ok")
+        self.assertEqual(self.read(queued), b"ok")
+        self.wait_for(lambda: self.server.active == 0)
+        self.assertEqual(self.server.queued(), 0)
+        self.assertFalse(self.server.saturated())
+
+    def test_stop_workers(self):
+        self.release.set()
+        client = self.connect()
+        self.server._stop_workers()
+        self.assertEqual(self.read(client), b"ok")
+        self.assertEqual(self.server._workers, [])
@@ -0,0 +1,94 @@
+import os
+import sys
+import shutil
+import tempfile
+from mock import Mock, MagicMock, patch
+
+# add all parent testsuite directories to sys.path to allow (most)
+# relative imports in python 2.4
+path = os.path.dirname(__file__)
+while path != "/":
+    if os.path.basename(path).lower().startswith("test"):
+        sys.path.append(path)
+    if os.path.basename(path) == "testsuite":
+        break
+    path = os.path.dirname(path)
+from common import *
+
+import Bcfg2.Server.Snapshot
+
+
+class TestSnapshot(Bcfg2TestCase):
+    def setUp(self):
+        Bcfg2TestCase.setUp(self)
+        set_setup_default("snapshot", None)
+        self.tmpdir = tempfile.mkdtemp()
+        self.snapfile = os.path.join(self.tmpdir, "snapshot")
+        self.datafile = os.path.join(self.tmpdir, "data")
+        open(self.datafile, "w").write("foo")
+
+    def tearDown(self):
+        Bcfg2.Server.Snapshot.load()
+        shutil.rmtree(self.tmpdir)
+
+    def test_disabled(self):
+        Bcfg2.Server.Snapshot.load()
+        Bcfg2.Server.Snapshot.store(
+            "test", Bcfg2.Server.Snapshot.signatures([self.datafile]), "data")
+        self.assertIsNone(Bcfg2.Server.Snapshot.get("test"))
+        Bcfg2.Server.Snapshot.save()
+        self.assertFalse(os.path.exists(self.snapfile))
+
+    def test_snapshot(self):
+        missing = os.path.join(self.tmpdir, "missing")
+        Bcfg2.Server.Snapshot.load(self.snapfile)
+        self.assertIsNone(Bcfg2.Server.Snapshot.get("test"))
+        Bcfg2.Server.Snapshot.store(
+            "test", Bcfg2.Server.Snapshot.signatures([self.datafile, missing]),
+            dict(foo="bar"))
+        Bcfg2.Server.Snapshot.store(
+            "unused", Bcfg2.Server.Snapshot.signatures([self.datafile]),
+            "unused")
+        self.assertEqual(Bcfg2.Server.Snapshot.get("test"), dict(foo="bar"))
+        Bcfg2.Server.Snapshot.save()
+        self.assertTrue(os.path.exists(self.snapfile))
+
+        # reload the snapshot; only items that are used after loading
+        # are saved again
+        Bcfg2.Server.Snapshot.load(self.snapfile)
+        self.assertEqual(Bcfg2.Server.Snapshot.get("test"), dict(foo="bar"))
+        Bcfg2.Server.Snapshot.save()
+        Bcfg2.Server.Snapshot.load(self.snapfile)
+        self.assertEqual(Bcfg2.Server.Snapshot.get("test"), dict(foo="bar"))
+        self.assertIsNone(Bcfg2.Server.Snapshot.get("unused"))
+
+        # creating a file that was missing invalidates the item
+        open(missing, "w").write("")
+        self.assertIsNone(Bcfg2.Server.Snapshot.get("test"))
+        os.unlink(missing)
+        self.assertEqual(Bcfg2.Server.Snapshot.get("test"), dict(foo="bar"))
+
+        # so does changing a file
+        open(self.datafile, "w").write("foobar")
+        self.assertIsNone(Bcfg2.Server.Snapshot.get("test"))
+
+    def test_store_changed(self):
+        Bcfg2.Server.Snapshot.load(self.snapfile)
+        sigs = Bcfg2.Server.Snapshot.signatures([self.datafile])
+        # the file changes after the signatures are taken, while the
+        # item is being built, so the item is not stored
+        open(self.datafile, "w").write("foobar")
+        Bcfg2.Server.Snapshot.store("test", sigs, "data")
+        self.assertIsNone(Bcfg2.Server.Snapshot.get("test"))
+
+    def test_load_errors(self):
+        open(self.snapfile, "w").write("garbage")
+        Bcfg2.Server.Snapshot.load(self.snapfile)
+        self.assertIsNone(Bcfg2.Server.Snapshot.get("test"))
+
+        Bcfg2.Server.Snapshot.store(
+            "test", Bcfg2.Server.Snapshot.signatures([self.datafile]), "data")
+        Bcfg2.Server.Snapshot.save()
+        with patch("Bcfg2.Server.Snapshot.__version__", "0.0.0"):
+            Bcfg2.Server.Snapshot.load(self.snapfile)
+        self.assertIsNone(Bcfg2.Server.Snapshot.get("test"))
@@ -28,6 +28,27 @@ class TestStatistic(Bcfg2TestCase):
         self.assertEqual(stat.get_value(), ("test", (1.0, 100.0, 30.83625, 4)))
         stat.add_value(0.655)
         self.assertEqual(stat.get_value(), ("test", (0.655, 100.0, 24.8, 5)))
+        self.assertEqual(stat.get_histogram().count, 5)
+        self.assertEqual(stat.get_histogram().min, 0.655)
+
+    @patch("time.time")
+    def test_windows(self, mock_time):
+        mock_time.return_value = 6000.0
+        stat = Statistic("test", 1)
+        mock_time.return_value = 6000.0 + 3 * 60
+        stat.add_value(2)
+        mock_time.return_value = 6000.0 + 10 * 60
+        stat.add_value(3)
+        self.assertEqual(stat.get_histogram(1).count, 1)
+        self.assertEqual(stat.get_histogram(5).count, 1)
+        self.assertEqual(stat.get_histogram(15).count, 3)
+        self.assertEqual(stat.get_histogram().count, 3)
+
+        mock_time.return_value = 6000.0 + 20 * 60
+        stat.add_value(4)
+        self.assertEqual(stat.get_histogram(15).count, 2)
+        self.assertEqual(stat.get_histogram(15).min, 3.0)
+        self.assertEqual(stat.get_histogram().count, 4)
 
 
 class TestStatistics(Bcfg2TestCase):
@@ -42,3 +63,66 @@ class TestStatistics(Bcfg2TestCase):
         stats.add_value("test1", 10)
         self.assertEqual(stats.display(), dict(test1=(1.0, 10.0, 5.5, 2),
                                                test2=(1.23, 1.23, 1.23, 1)))
+
+    def test_histograms(self):
+        stats = Statistics()
+        self.assertEqual(stats.histograms(), dict())
+        stats.add_value("test1", 1)
+        stats.add_value("test1", 3)
+        hists = stats.histograms()
+        self.assertItemsEqual(hists.keys(), ["test1"])
+        hist = Histogram.from_data(hists["test1"])
+        self.assertEqual(hist.count, 2)
+        self.assertEqual(hist.sum, 4.0)
+        self.assertEqual(hists["test1"]["unit"], "seconds")
+
+        stats.add_value("test2", 5, unit="")
+        self.assertEqual(stats.histograms()["test2"]["unit"], "")
+
+
+class TestHistogram(Bcfg2TestCase):
+    def test_percentile(self):
+        hist = Histogram()
+        self.assertIsNone(hist.percentile(50))
+        for i in range(1, 1001):
+            hist.add_value(i / 1000.0)
+        self.assertEqual(hist.count, 1000)
+        self.assertEqual(hist.min, 0.001)
+        self.assertEqual(hist.max, 1.0)
+        for pct in [1, 50, 95, 99]:
+            self.assertAlmostEqual(hist.percentile(pct), pct / 100.0,
+                                   delta=pct / 100.0 * 0.01)
+        self.assertEqual(hist.percentile(100), 1.0)
+        self.assertEqual(hist.percentile(0), 0.001)
+
+    def test_zero(self):
+        hist = Histogram()
+        hist.add_value(0)
+        hist.add_value(0)
+        hist.add_value(5)
+        self.assertEqual(hist.percentile(50), 0.0)
+        self.assertAlmostEqual(hist.percentile(99), 5.0, delta=0.05)
+
+    def test_merge(self):
+        hist1 = Histogram()
+        hist2 = Histogram()
+        whole = Histogram()
+        for i in range(1, 101):
+            hist1.add_value(i)
+            whole.add_value(i)
+        for i in range(1000, 1101):
+            hist2.add_value(i)
+            whole.add_value(i)
+        hist1.merge(Histogram.from_data(hist2.get_data()))
+        self.assertEqual(hist1.get_data(), whole.get_data())
+        self.assertEqual(hist1.min, 1.0)
+        self.assertEqual(hist1.max, 1100.0)
+
+    def test_data(self):
+        hist = Histogram()
+        self.assertEqual(Histogram.from_data(hist.get_data()).min, None)
+        for val in [0.5, 0.25, 7]:
+            hist.add_value(val)
+        hist2 = Histogram.from_data(hist.get_data())
+        self.assertEqual(hist2.buckets, hist.buckets)
+        self.assertEqual(hist2.percentile(50), hist.percentile(50))
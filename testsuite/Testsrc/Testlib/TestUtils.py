@@ -57,3 +57,47 @@ class TestIsString(Bcfg2TestCase):
         if not inPy3k:
             self.assertFalse(is_string("foo" + chr(128) + "bar", 'ascii'))
             self.assertFalse(is_string(ustr, 'ascii'))
+
+
+class TestCompression(Bcfg2TestCase):
+    def test_compress(self):
+        data = "<methodResponse>Ãbc</methodResponse>".encode('utf-8') * 100
+        for encoding in content_encodings:
+            compressed = compress(data, encoding)
+            self.assertLess(len(compressed), len(data))
+            self.assertEqual(decompress(compressed, encoding), data)
+        self.assertRaises(ValueError, compress, data, "bogus")
+        self.assertRaises(ValueError, decompress, data, "bogus")
+        self.assertRaises(ValueError, decompress, data, "gzip")
+
+    def test_incremental(self):
+        data = "<methodResponse>Ãbc</methodResponse>".encode('utf-8') * 100
+        for encoding in content_encodings:
+            compressor = Compressor(encoding)
+            compressed = b''.join(compressor.compress(data[i:i + 7])
+                                  for i in range(0, len(data), 7))
+            compressed += compressor.flush()
+            self.assertEqual(decompress(compressed, encoding), data)
+
+            decompressor = Decompressor(encoding)
+            rv = b''.join(decompressor.decompress(compressed[i:i + 5])
+                          for i in range(0, len(compressed), 5))
+            self.assertEqual(rv + decompressor.flush(), data)
+
+            decompressor = Decompressor(encoding)
+            decompressor.decompress(compressed[:-4])
+            self.assertRaises(ValueError, decompressor.flush)
+        self.assertRaises(ValueError, Compressor, "bogus")
+        self.assertRaises(ValueError, Decompressor, "bogus")
+
+    def test_negotiate_encoding(self):
+        self.assertEqual(negotiate_encoding(None), None)
+        self.assertEqual(negotiate_encoding(""), None)
+        self.assertEqual(negotiate_encoding("identity"), None)
+        self.assertEqual(negotiate_encoding("gzip"), "gzip")
+        self.assertEqual(negotiate_encoding("deflate, GZIP;q=0.5"), "gzip")
+        self.assertEqual(negotiate_encoding("gzip;q=0"), None)
+        self.assertEqual(negotiate_encoding("*"), content_encodings[0])
+        if HAS_ZSTD:
+            self.assertEqual(negotiate_encoding("zstd, gzip"), "zstd")
+            self.assertEqual(negotiate_encoding("zstd;q=0.1, gzip"), "gzip")
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+""" Benchmark building initial client metadata against a large,
+synthetic ``groups.xml``.  This compares the indexed group rule
+evaluation in :func:`Bcfg2.Server.Plugins.Metadata.Metadata._merge_groups`
+with a full evaluation of every rule in every pass, which is how
+group membership was calculated before, and checks that both give the
+same results. """
+
+import sys
+import time
+import random
+import logging
+import argparse
+import lxml.etree
+import Bcfg2.Options
+from Bcfg2.Server.Cache import Cache
+from Bcfg2.Server.Plugins.Metadata import Metadata
+
+
+def legacy_merge_groups(self, client, groups, categories=None):
+    """ Evaluate every group rule in every pass """
+    numgroups = -1
+    if categories is None:
+        categories = dict()
+    while numgroups != len(groups):
+        numgroups = len(groups)
+        newgroups = set()
+        removegroups = set()
+        for grpname in self.ordered_groups:
+            if grpname in groups:
+                continue
+            if any(p(client, groups, categories)
+                   for p in self.group_membership[grpname]):
+                newgroups.add(grpname)
+                if (grpname in self.groups and
+                        self.groups[grpname].category):
+                    categories[self.groups[grpname].category] = grpname
+        groups.update(newgroups)
+        for grpname, predicates in list(self.negated_groups.items()):
+            if grpname not in groups:
+                continue
+            if any(p(client, groups, categories) for p in predicates):
+                removegroups.add(grpname)
+                if (grpname in self.groups and
+                        self.groups[grpname].category):
+                    del categories[self.groups[grpname].category]
+        groups.difference_update(removegroups)
+    return (groups, categories)
+
+
+def generate_groups(numgroups, numclients, numprofiles, rand):
+    """ Generate a groups.xml tree """
+    groups = ["group%d" % i for i in range(numgroups)]
+    root = lxml.etree.Element("Groups")
+    for i, name in enumerate(groups):
+        attrs = dict(name=name)
+        if i < numprofiles:
+            attrs["profile"] = "true"
+            attrs["public"] = "true"
+        elif rand.random() < 0.1:
+            attrs["category"] = "category%d" % rand.randint(0, 20)
+        lxml.etree.SubElement(root, "Group", **attrs)
+
+    # each profile group pulls in a handful of other groups
+    for profile in groups[:numprofiles]:
+        parent = lxml.etree.SubElement(root, "Group", name=profile)
+        for name in rand.sample(groups[numprofiles:], 10):
+            lxml.etree.SubElement(parent, "Group", name=name)
+
+    for _ in range(numgroups // 2):
+        # each declaration adds (or, rarely, removes) a group based on
+        # membership in one or two other groups, or on the client name
+        roll = rand.random()
+        if roll < 0.05:
+            parent = lxml.etree.SubElement(
+                root, "Client",
+                name="client%d" % rand.randint(0, numclients - 1))
+        else:
+            parent = lxml.etree.SubElement(root, "Group",
+                                           name=rand.choice(groups))
+            if roll < 0.1:
+                parent.set("negate", "true")
+            if rand.random() < 0.3:
+                parent = lxml.etree.SubElement(parent, "Group",
+                                               name=rand.choice(groups))
+        child = lxml.etree.SubElement(parent, "Group",
+                                      name=rand.choice(groups[numprofiles:]))
+        if rand.random() < 0.05:
+            child.set("negate", "true")
+    return root
+
+
+def get_metadata(xdata, numclients, numprofiles, rand):
+    """ Create a Metadata plugin object from the given groups.xml
+    tree, without a server core or repository """
+    metadata = Metadata.__new__(Metadata)
+    metadata.logger = logging.getLogger("Metadata")
+    metadata.debug_flag = False
+    metadata.core = type("Core", (object, ), dict(metadata_cache_mode="off"))
+    metadata.states = dict()
+    metadata.groups_xml = type("GroupsXML", (object, ), dict(xdata=xdata))
+    metadata.cache = Cache("Metadata")
+    metadata.default = None
+    metadata.query = None
+    metadata.uuid = dict()
+    metadata.versions = dict()
+    metadata.passwords = dict()
+    metadata.aliases = dict()
+    metadata.raliases = dict()
+    metadata.raddresses = dict()
+    metadata.clients = ["client%d" % i for i in range(numclients)]
+    metadata.clientgroups = dict(
+        (client, ["group%d" % rand.randint(0, numprofiles - 1)])
+        for client in metadata.clients)
+    metadata._handle_groups_xml_event(None)  # pylint: disable=W0212
+    return metadata
+
+
+def run(name, metadata, clients):
+    """ Build initial metadata for all clients """
+    start = time.time()
+    rv = dict()
+    for client in clients:
+        imd = metadata.get_initial_metadata(client)
+        rv[client] = (imd.groups, imd.categories)
+    elapsed = time.time() - start
+    print("%-8s %6d clients %8.3fs %8.3fms per client" %
+          (name, len(clients), elapsed, 1000 * elapsed / len(clients)))
+    return rv
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--groups", type=int, default=3000,
+                        help="Number of groups in groups.xml")
+    parser.add_argument("--clients", type=int, default=500,
+                        help="Number of clients")
+    parser.add_argument("--profiles", type=int, default=20,
+                        help="Number of profile groups")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Random seed used to generate groups.xml")
+    args = parser.parse_args()
+    Bcfg2.Options.setup.debug = False
+    logging.basicConfig(level=logging.ERROR)
+
+    rand = random.Random(args.seed)
+    xdata = generate_groups(args.groups, args.clients, args.profiles, rand)
+    metadata = get_metadata(xdata, args.clients, args.profiles, rand)
+    indexed = run("indexed", metadata, metadata.clients)
+    metadata._merge_groups = \
+        lambda *a, **kw: legacy_merge_groups(metadata, *a, **kw)
+    legacy = run("legacy", metadata, metadata.clients)
+
+    differ = [c for c in metadata.clients if indexed[c] != legacy[c]]
+    if differ:
+        print("Group membership differs for %d clients: %s" %
+              (len(differ), differ[:10]))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+""" Benchmark storing probe data received from many clients.  This
+simulates every client uploading probe data once, and compares the
+default :class:`Bcfg2.Server.Plugins.Probes.XMLProbeStore`, which
+rewrites all of ``probed.xml`` for each client, with the
+:class:`Bcfg2.Server.Plugins.Probes.JournalProbeStore`, which appends
+only the reporting client's data to a journal.  Both stores are then
+reloaded from disk to check that they hold the same data. """
+
+import os
+import sys
+import time
+import random
+import shutil
+import logging
+import argparse
+import tempfile
+import Bcfg2.Options
+import Bcfg2.Server.Cache
+from Bcfg2.Server.Plugins.Probes import XMLProbeStore, JournalProbeStore, \
+    ProbeData
+
+
+class FakeCore(object):
+    """ The parts of the server core used by probe stores """
+    metadata_cache = Bcfg2.Server.Cache.Cache("Metadata")
+
+
+def generate_data(numclients, numprobes, rand):
+    """ Generate probe data and groups for each client """
+    rv = []
+    for i in range(numclients):
+        data = dict()
+        for j in range(numprobes):
+            data["probe%d" % j] = ProbeData(
+                "\n".join("line %d of probe %d: %s" %
+                          (k, j, rand.randint(0, 1000000))
+                          for k in range(rand.randint(1, 10))))
+        groups = ["group%d" % rand.randint(0, 100) for _ in range(3)]
+        rv.append(("client%d.example.com" % i, data, groups))
+    return rv
+
+
+def run(name, store_class, datadir, clients, limit):
+    """ Upload probe data for the given clients, as
+    :func:`Bcfg2.Server.Plugins.Probes.Probes.ReceiveData` does """
+    Bcfg2.Server.Cache.expire("Probes")
+    store = store_class(FakeCore(), datadir)
+    start = time.time()
+    count = 0
+    for hostname, data, groups in clients:
+        store.set_groups(hostname, groups)
+        store.set_data(hostname, data)
+        store.commit()
+        count += 1
+        if limit and time.time() - start > limit:
+            break
+    elapsed = time.time() - start
+    store.shutdown()
+    print("%-8s %6d clients %8.3fs %8.3fms per client" %
+          (name, count, elapsed, 1000 * elapsed / count))
+    return count
+
+
+def load(store_class, datadir, clients):
+    """ Load the stored probe data for the given clients """
+    Bcfg2.Server.Cache.expire("Probes")
+    store = store_class(FakeCore(), datadir)
+    return dict((hostname, (dict(store.get_data(hostname)),
+                            sorted(store.get_groups(hostname))))
+                for hostname, _, _ in clients)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--clients", type=int, default=10000,
+                        help="Number of clients")
+    parser.add_argument("--probes", type=int, default=10,
+                        help="Number of probes per client")
+    parser.add_argument("--journal-size", type=int, default=1000,
+                        help="Number of journal records between merges")
+    parser.add_argument("--time-limit", type=float, default=60,
+                        help="Stop each benchmark after this many seconds "
+                        "(0 for no limit)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Random seed used to generate probe data")
+    args = parser.parse_args()
+    Bcfg2.Options.setup.debug = False
+    Bcfg2.Options.setup.probes_journal_size = args.journal_size
+    logging.basicConfig(level=logging.ERROR)
+
+    clients = generate_data(args.clients, args.probes,
+                            random.Random(args.seed))
+    tmpdir = tempfile.mkdtemp()
+    try:
+        rv = 0
+        results = dict()
+        for name, store_class in [("journal", JournalProbeStore),
+                                  ("xml", XMLProbeStore)]:
+            datadir = os.path.join(tmpdir, name)
+            os.makedirs(datadir)
+            count = run(name, store_class, datadir, clients, args.time_limit)
+            results[name] = load(XMLProbeStore, datadir, clients[:count])
+        common = min(len(r) for r in results.values())
+        differ = [c for c, _, _ in clients[:common]
+                  if results["journal"][c] != results["xml"][c]]
+        if differ:
+            print("Probe data differs for %d clients: %s" %
+                  (len(differ), differ[:10]))
+            rv = 1
+        return rv
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
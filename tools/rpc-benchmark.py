@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+""" Benchmark the RPC channel used by the multiprocessing server core
+against the previous implementation, which opened a new
+:class:`multiprocessing.connection.Listener` for every call.  Each
+child process simply echoes back a payload of the given size, so this
+measures only the cost of the RPC channel itself. """
+
+import sys
+import time
+import argparse
+import threading
+import multiprocessing
+from multiprocessing.connection import Listener, Client
+import Bcfg2.Options
+from Bcfg2.Server.MultiprocessingCore import RPCQueue
+
+
+def listener_child(queue, terminate):
+    """ Child process for the Listener-per-call channel """
+    while not terminate.is_set():
+        try:
+            address, data = queue.get(timeout=0.5)
+        except Exception:  # pylint: disable=W0703
+            continue
+        client = Client(address)
+        client.send(data[1][0])
+        client.close()
+
+
+def listener_rpc(queue, payload):
+    """ Make a single call over the Listener-per-call channel """
+    listener = Listener()
+    try:
+        queue.put((listener.address, ("echo", [payload], dict())))
+        conn = listener.accept()
+        try:
+            return conn.recv()
+        finally:
+            conn.close()
+    finally:
+        listener.close()
+
+
+def pipe_child(pipe, terminate):
+    """ Child process for the persistent pipe channel """
+    while not terminate.is_set():
+        if pipe.poll(0.5):
+            reqid, data = pipe.recv()
+            pipe.send((reqid, True, data[1][0]))
+
+
+def run(name, call, threads, calls, payload):
+    """ Make ``calls`` calls from each of ``threads`` threads, and
+    print the throughput and mean latency """
+    latencies = []
+
+    def worker():
+        for _ in range(calls):
+            start = time.time()
+            call(payload)
+            latencies.append(time.time() - start)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    start = time.time()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.time() - start
+    print("%-10s %8d calls %8.3fs %10.1f calls/s %8.3fms mean latency" %
+          (name, len(latencies), elapsed, len(latencies) / elapsed,
+           1000 * sum(latencies) / len(latencies)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--threads", type=int, default=8,
+                        help="Number of concurrent callers")
+    parser.add_argument("--calls", type=int, default=250,
+                        help="Number of calls made by each caller")
+    parser.add_argument("--size", type=int, default=64 * 1024,
+                        help="Size of the payload in bytes")
+    args = parser.parse_args()
+    Bcfg2.Options.setup.debug = False
+    payload = "x" * args.size
+
+    terminate = multiprocessing.Event()
+    queue = multiprocessing.Queue()
+    child = multiprocessing.Process(target=listener_child,
+                                    args=(queue, terminate))
+    child.start()
+    try:
+        run("listener", lambda p: listener_rpc(queue, p), args.threads,
+            args.calls, payload)
+    finally:
+        terminate.set()
+        child.join()
+
+    terminate = multiprocessing.Event()
+    rpc_q = RPCQueue()
+    child = multiprocessing.Process(target=pipe_child,
+                                    args=(rpc_q.add_subscriber("child"),
+                                          terminate))
+    child.start()
+    try:
+        run("pipe", lambda p: rpc_q.rpc("child", "echo", args=[p]),
+            args.threads, args.calls, payload)
+    finally:
+        rpc_q.close()
+        terminate.set()
+        child.join()
+
+
+if __name__ == "__main__":
+    sys.exit(main())